@@ -1,21 +1,15 @@
 import logging
-import sys, operator
+import sys, json, threading, time
 
 from uuid import uuid4
 from datetime import datetime
-from typing import Tuple
-
-import math, colorsys
-import traceback 
-from typing import Callable, TypeVar
-
-CALLABLE_T = TypeVar('CALLABLE_T', bound=Callable)  # noqa pylint: disable=invalid-name
+import traceback
 
 class Registry(dict):
     """Registry of items."""
-    def register(self, name: str) -> Callable[[CALLABLE_T], CALLABLE_T]:
+    def register(self, name: str):
         """Return decorator to register item with a specific name."""
-        def decorator(func: CALLABLE_T) -> CALLABLE_T:
+        def decorator(func):
             """Register decorated function."""
             self[name] = func
             return func
@@ -24,15 +18,23 @@ class Registry(dict):
 
 INTERFACES = Registry()
 
+# Interned endpoint-less interfaces, see AlexaInterface.shared
+_SHARED_INTERFACES = {}
+
 class AlexaEndpoint(object):
+    # Endpoints are numerous: no per instance __dict__, tuples instead of lists
+    # and no cookies dict until one is added. Subclasses must declare __slots__ too.
+    __slots__ = ('_endpointId', '_friendlyName', '_description', '_manufacturerName',
+                 '_capabilities', '_displayCategories', '_cookies')
+
     def __init__(self, endpointId, friendlyName="", description="", manufacturerName=""):
         self._endpointId = endpointId
         self._friendlyName = friendlyName
         self._description = description
         self._manufacturerName = manufacturerName
-        self._capabilities = []
-        self._displayCategories = []
-        self._cookies = {}
+        self._capabilities = ()
+        self._displayCategories = ()
+        self._cookies = None
 
     def endpointId(self):
         return self._endpointId
@@ -53,22 +55,37 @@ class AlexaEndpoint(object):
         return self._capabilities
 
     def cookies(self):
-        return self._cookies
+        return self._cookies if self._cookies is not None else {}
 
     def getProperty(self, name):
         return None
 
+    async def loadProperties(self):
+        """Read what getProperty() needs, with an asyncio handler (nothing by default)."""
+
+    def uncertaintyInMilliseconds(self):
+        """How old the properties may be (served from a last known state)."""
+        return 0
+
     def addDisplayCategories(self, category):
-        self._displayCategories.append(category)
+        self._displayCategories += (category,)
 
     def addCapability(self, interface):
-        self._capabilities.append(interface)
+        self._capabilities += (interface,)
 
     def addCookie(self, dict):
-        for k, v in dict.items():
-            self._cookies[k] = v
+        # Copied, never updated in place: the cookies may be shared (see shareCookies)
+        cookies = {} if self._cookies is None else self._cookies.copy()
+        cookies.update(dict)
+        self._cookies = cookies
+
+    def shareCookies(self, cookies):
+        """Use cookies, a dict other endpoints may use too: it is not modified."""
+        self._cookies = cookies
 
 class AlexaInterface:
+    __slots__ = ('_endpoint', '_name', '_properties', '_proactivelyReported', '_retrievable',
+                 '_modesSupported', '_deactivationSupported', '_discovery', '_shared')
 
     def __init__(self, endpoint, name = 'Alexa', properties = [], proactivelyReported = True, retrievable = True, modesSupported = None, deactivationSupported = None):
         self._endpoint = endpoint
@@ -78,6 +95,23 @@ class AlexaInterface:
         self._retrievable = retrievable
         self._modesSupported = modesSupported
         self._deactivationSupported = deactivationSupported
+        self._discovery = None
+        self._shared = False
+
+    @classmethod
+    def shared(cls, **config):
+        """Return the interned interface for this class and config.
+
+        The instance is not bound to an endpoint (serializeProperties takes it)
+        and can't be modified (TypeError), it is shared by all endpoints.
+        """
+        key = (cls, repr(sorted(config.items())))
+        interface = _SHARED_INTERFACES.get(key)
+        if interface is None:
+            interface = cls(None, **config)
+            interface._shared = True
+            interface = _SHARED_INTERFACES.setdefault(key, interface)
+        return interface
 
     def name(self):
         return self._name
@@ -107,9 +141,19 @@ class AlexaInterface:
         return self._modesSupported
 
     def setModesSupported(self, modesSupported):
+        if self._shared:
+            raise TypeError("%s is shared by several endpoints, use %s.shared(modesSupported=...)"
+                            % (self.name(), type(self).__name__))
         self._modesSupported = modesSupported
+        self._discovery = None
 
     def serializeDiscovery(self):
+        """Return the discovery capability, computed once per interface."""
+        if self._discovery is None:
+            self._discovery = self.buildDiscovery()
+        return self._discovery
+
+    def buildDiscovery(self):
         result = {
             'type': 'AlexaInterface',
             'interface': self.name(),
@@ -127,21 +171,25 @@ class AlexaInterface:
             result['supportsDeactivation'] = supports_deactivation
         return result
 
-    def serializeProperties(self):
+    def serializeProperties(self, endpoint=None):
+        if endpoint is None:
+            endpoint = self._endpoint
         for prop in self.propertiesSupported():
             prop_name = prop['name']
-            prop_value = self._endpoint.getProperty(prop_name)
+            prop_value = endpoint.getProperty(prop_name)
             if prop_value is not None:
                 yield {
                     'name': prop_name,
                     'namespace': self.name(),
                     'value': prop_value,
                     'timeOfSample': datetime.now().replace(microsecond=0).isoformat()+"Z",
-                    'uncertaintyInMilliseconds': 0,
+                    'uncertaintyInMilliseconds': endpoint.uncertaintyInMilliseconds(),
                 }
 
 @INTERFACES.register('Alexa.PowerController')
 class AlexaPowerController(AlexaInterface):
+    __slots__ = ()
+
     def name(self):
         return 'Alexa.PowerController'
 
@@ -150,6 +198,8 @@ class AlexaPowerController(AlexaInterface):
 
 @INTERFACES.register('Alexa.LockController')
 class AlexaLockController(AlexaInterface):
+    __slots__ = ()
+
     def name(self):
         return 'Alexa.LockController'
 
@@ -158,10 +208,12 @@ class AlexaLockController(AlexaInterface):
 
 @INTERFACES.register('Alexa.SceneController')
 class AlexaSceneController(AlexaInterface):
+    __slots__ = ()
+
     def name(self):
         return 'Alexa.SceneController'
 
-    def serializeDiscovery(self):
+    def buildDiscovery(self):
         result = {
             'type': 'AlexaInterface',
             'interface': self.name(),
@@ -173,6 +225,8 @@ class AlexaSceneController(AlexaInterface):
 
 @INTERFACES.register('Alexa.BrightnessController')
 class AlexaBrightnessController(AlexaInterface):
+    __slots__ = ()
+
     def name(self):
         return 'Alexa.BrightnessController'
 
@@ -181,41 +235,57 @@ class AlexaBrightnessController(AlexaInterface):
 
 @INTERFACES.register('Alexa.ColorController')
 class AlexaColorController(AlexaInterface):
+    __slots__ = ()
+
     def name(self):
         return 'Alexa.ColorController'
 
 @INTERFACES.register('Alexa.ColorTemperatureController')
 class AlexaColorTemperatureController(AlexaInterface):
+    __slots__ = ()
+
     def name(self):
         return 'Alexa.ColorTemperatureController'
 
 @INTERFACES.register('Alexa.PercentageController')
 class AlexaPercentageController(AlexaInterface):
+    __slots__ = ()
+
     def name(self):
         return 'Alexa.PercentageController'
 
 @INTERFACES.register('Alexa.Speaker')
 class AlexaSpeaker(AlexaInterface):
+    __slots__ = ()
+
     def name(self):
         return 'Alexa.Speaker'
 
 @INTERFACES.register('Alexa.StepSpeaker')
 class AlexaStepSpeaker(AlexaInterface):
+    __slots__ = ()
+
     def name(self):
         return 'Alexa.StepSpeaker'
 
 @INTERFACES.register('Alexa.PlaybackController')
 class AlexaPlaybackController(AlexaInterface):
+    __slots__ = ()
+
     def name(self):
         return 'Alexa.PlaybackController'
 
 @INTERFACES.register('Alexa.InputController')
 class AlexaInputController(AlexaInterface):
+    __slots__ = ()
+
     def name(self):
         return 'Alexa.InputController'
 
 @INTERFACES.register('Alexa.TemperatureSensor')
 class AlexaTemperatureSensor(AlexaInterface):
+    __slots__ = ()
+
     def name(self):
         return 'Alexa.TemperatureSensor'
 
@@ -224,6 +294,8 @@ class AlexaTemperatureSensor(AlexaInterface):
 
 @INTERFACES.register('Alexa.ThermostatController')
 class AlexaThermostatController(AlexaInterface):
+    __slots__ = ()
+
     def name(self):
         return 'Alexa.ThermostatController'
 
@@ -241,6 +313,8 @@ class AlexaThermostatController(AlexaInterface):
 
 @INTERFACES.register('Alexa.ContactSensor')
 class AlexaContactSensor(AlexaInterface):
+    __slots__ = ()
+
     def name(self):
         return 'Alexa.ContactSensor'
 
@@ -256,6 +330,171 @@ API_PAYLOAD = 'payload'
 
 _LOGGER = logging.getLogger(__name__)
 
+# Tracing: stage timings of each directive, one summary line per directive
+# on the trace logger. Off unless enableTracing(), spans are then no-ops.
+_TRACE_LOGGER = logging.getLogger(__name__ + '.trace')
+_tracing = False
+
+# Deadlines: a directive has a time budget (Alexa waits about 8 seconds), the
+# Domoticz calls it makes get the time left as timeout
+DIRECTIVE_TIMEOUT = 7.0
+
+try:
+    from contextvars import ContextVar
+    _currentTrace = ContextVar('trace', default=None)
+    _currentDeadline = ContextVar('deadline', default=None)
+    _TASK_TRACES = True
+except ImportError:
+    # Python 3.6: one trace/deadline per thread, asyncio directives are not traced
+    class _ThreadValue(threading.local):
+        value = None
+
+        def get(self):
+            return self.value
+
+        def set(self, value):
+            self.value = value
+
+    _currentTrace = _ThreadValue()
+    _currentDeadline = _ThreadValue()
+    _TASK_TRACES = False
+
+class DeadlineExceeded(Exception):
+    """The directive ran out of time waiting for a Domoticz call."""
+
+class BridgeUnreachable(Exception):
+    """Domoticz could not be reached (or is known to be down, the call was not even tried)."""
+
+def startDeadline(timeout):
+    """Give the current directive timeout seconds (unless an earlier deadline
+    is running), return what endDeadline must restore."""
+    previous = _currentDeadline.get()
+    deadline = time.monotonic() + timeout
+    if previous is None or deadline < previous:
+        _currentDeadline.set(deadline)
+    return previous
+
+def endDeadline(previous):
+    _currentDeadline.set(previous)
+
+def remainingTime():
+    """Seconds left before the current deadline, None without deadline."""
+    deadline = _currentDeadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def enableTracing(enabled=True):
+    global _tracing
+    _tracing = bool(enabled)
+    if _tracing:
+        _TRACE_LOGGER.setLevel(logging.INFO)
+
+class Trace(object):
+    """Wall time and call count of the stages of one directive."""
+    __slots__ = ('namespace', 'name', 'correlationToken', 'start', 'stages', 'lock')
+
+    def __init__(self, request):
+        header = request[API_HEADER]
+        self.namespace = header.get('namespace')
+        self.name = header.get('name')
+        self.correlationToken = header.get('correlationToken')
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, elapsed):
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                self.stages[stage] = [1, elapsed]
+            else:
+                entry[0] += 1
+                entry[1] += elapsed
+
+    def summary(self):
+        return {
+            'namespace': self.namespace,
+            'name': self.name,
+            'correlationToken': self.correlationToken,
+            'ms': round((time.perf_counter() - self.start) * 1000, 3),
+            'stages': dict((stage, {'count': count, 'ms': round(elapsed * 1000, 3)})
+                           for stage, (count, elapsed) in self.stages.items()),
+        }
+
+class _Span(object):
+    __slots__ = ('trace', 'stage', 'start')
+
+    def __init__(self, trace, stage):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add(self.stage, time.perf_counter() - self.start)
+        return False
+
+class _NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+def span(stage):
+    """Context manager adding its duration to stage of the current trace."""
+    if not _tracing:
+        return _NO_SPAN
+    trace = _currentTrace.get()
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, stage)
+
+def mark(stage):
+    """Count an event (no duration) in stage of the current trace."""
+    trace = _currentTrace.get() if _tracing else None
+    if trace is not None:
+        trace.add(stage, 0.0)
+
+def bindContext(function):
+    """Return function running in the current trace and deadline (for worker threads)."""
+    trace = _currentTrace.get() if _tracing else None
+    deadline = _currentDeadline.get()
+    if trace is None and deadline is None:
+        return function
+    def bound(*args, **kwargs):
+        previous = _currentTrace.get(), _currentDeadline.get()
+        _currentTrace.set(trace)
+        _currentDeadline.set(deadline)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _currentTrace.set(previous[0])
+            _currentDeadline.set(previous[1])
+    return bound
+
+def startTrace(request):
+    """Start the trace of request, None when not tracing or already traced."""
+    if not _tracing or _currentTrace.get() is not None:
+        return None
+    trace = Trace(request)
+    _currentTrace.set(trace)
+    return trace
+
+def endTrace(trace):
+    """Log the summary line of trace (started by startTrace)."""
+    if trace is None:
+        return
+    _currentTrace.set(None)
+    _TRACE_LOGGER.info("trace %s", json.dumps(trace.summary(), separators=(',', ':')))
+
 def api_message(request,
                 name='Response',
                 namespace='Alexa',
@@ -263,6 +502,10 @@ def api_message(request,
                 context=None):
     """Create a API formatted response message.
     """
+    with span('api_message'):
+        return _api_message(request, name, namespace, payload, context)
+
+def _api_message(request, name, namespace, payload, context):
     payload = payload or {}
 
     response = {
@@ -314,6 +557,71 @@ def api_error(request,
 
 def handle_message(handler, message):
     """Handle incoming API messages."""
+    trace = startTrace(message[API_DIRECTIVE])
+    deadline = startDeadline(getattr(handler, 'directiveTimeout', DIRECTIVE_TIMEOUT))
+    try:
+        request, response = dispatch_message(handler, message)
+        return decode_response(request, response)
+    finally:
+        endDeadline(deadline)
+        endTrace(trace)
+
+def decode_response(request, response):
+    """Decode the already JSON encoded parts of response (RawJSON)."""
+    try:
+        with span('serialize'):
+            payload = response[API_EVENT][API_PAYLOAD]
+            for key, value in payload.items():
+                if isinstance(value, RawJSON):
+                    payload[key] = json.loads(value.data)
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        return api_error(request)
+    return response
+
+def encode_message(handler, message):
+    """Handle incoming API messages, return the JSON encoded response (a bytearray).
+
+    Already encoded parts of the response (Discover endpoints) are copied as
+    is, they never exist as objects.
+    """
+    trace = startTrace(message[API_DIRECTIVE])
+    deadline = startDeadline(getattr(handler, 'directiveTimeout', DIRECTIVE_TIMEOUT))
+    try:
+        request, response = dispatch_message(handler, message)
+        out = bytearray()
+        try:
+            with span('serialize'):
+                write_json(out, response)
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            out = bytearray()
+            write_json(out, api_error(request))
+        return out
+    finally:
+        endDeadline(deadline)
+        endTrace(trace)
+
+async def async_handle_message(handler, message):
+    """Handle incoming API messages with an asyncio handler (DomoticzHandler.AsyncDomoticz).
+
+    The directives reading or commanding devices await the handler
+    coroutines (AsyncAlexa), the others are invoked as by handle_message.
+    """
+    trace = startTrace(message[API_DIRECTIVE]) if _TASK_TRACES else None
+    deadline = startDeadline(getattr(handler, 'directiveTimeout', DIRECTIVE_TIMEOUT))
+    try:
+        request = message[API_DIRECTIVE]
+        namespace = request[API_HEADER]['namespace']
+        name = request[API_HEADER]['name']
+        response = await async_invoke(namespace, name, handler, request)
+        return decode_response(request, response)
+    finally:
+        endDeadline(deadline)
+        endTrace(trace)
+
+def dispatch_message(handler, message):
+    """Invoke the message directive, return (request, response)."""
     #assert message[API_DIRECTIVE][API_HEADER]['payloadVersion'] == '3'
 
     # Read head data
@@ -323,7 +631,55 @@ def handle_message(handler, message):
 
     #entity_id = request[API_ENDPOINT]['endpointId'].replace('#', '.')
 
-    return invoke(namespace, name, handler, message)
+    return message, invoke(namespace, name, handler, message)
+
+_encode_json = json.JSONEncoder(separators=(',', ':')).encode
+
+class RawJSON(object):
+    """An already JSON encoded value (bytes-like data)."""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+def write_json(out, value):
+    """Append the JSON encoding of value to the bytearray out."""
+    if isinstance(value, RawJSON):
+        out += value.data
+    elif isinstance(value, dict):
+        out += b'{'
+        separator = b''
+        for key, item in value.items():
+            out += separator
+            out += _encode_json(key).encode()
+            out += b':'
+            write_json(out, item)
+            separator = b','
+        out += b'}'
+    else:
+        out += _encode_json(value).encode()
+
+def iterDiscovery(endpoints):
+    """Yield the Discover.Response payload endpoints of endpoints."""
+    for endpoint in endpoints:
+        discovery_endpoint = {
+            'endpointId': endpoint.endpointId(),
+            'friendlyName': endpoint.friendlyName(),
+            'description': endpoint.description(),
+            'manufacturerName': endpoint.manufacturerName(),
+            'displayCategories': endpoint.displayCategories(),
+            'additionalApplianceDetails': {},
+        }
+        discovery_endpoint['capabilities'] = [
+            i.serializeDiscovery() for i in endpoint.capabilities()]
+        if not discovery_endpoint['capabilities']:
+            _LOGGER.debug("Not exposing %s because it has no capabilities", endpoint.endpointId())
+            continue
+        # Sent back by Alexa with every directive for the endpoint
+        cookies = endpoint.cookies()
+        if cookies:
+            discovery_endpoint['cookie'] = cookies
+        yield discovery_endpoint
 
 class AlexaSmartHomeCall(object):
     def __init__(self, namespace, name, handler):
@@ -331,38 +687,43 @@ class AlexaSmartHomeCall(object):
         self.name = name
         self.handler = handler
 
-    def invoke(self, name, request):
+    def invoke(self, function, request):
         try:
-            return operator.attrgetter(name)(self)(request)
-        except Exception:
-            traceback.print_exc(file=sys.stdout)
-            return api_error(request)
+            with span('call'):
+                return function(self, request)
+        except Exception as e:
+            return self.error(request, e)
+
+    async def invokeAsync(self, function, request):
+        try:
+            with span('call'):
+                return await function(self, request)
+        except Exception as e:
+            return self.error(request, e)
+
+    def error(self, request, error):
+        """The error response of the exception being handled."""
+        if isinstance(error, DeadlineExceeded):
+            return api_error(request, error_type='ENDPOINT_UNREACHABLE',
+                             error_message="Domoticz did not answer in time")
+        if isinstance(error, BridgeUnreachable):
+            return api_error(request, error_type='BRIDGE_UNREACHABLE',
+                             error_message="Domoticz is unreachable")
+        traceback.print_exc(file=sys.stdout)
+        return api_error(request)
 
 class Alexa(object):
 
     class Discovery(AlexaSmartHomeCall):
 
         def Discover(self, request):
-            discovery_endpoints = []
-            endpoints = self.handler.getEndpoints()
-            for endpoint in endpoints:
-                discovery_endpoint = {
-                    'endpointId': endpoint.endpointId(),
-                    'friendlyName': endpoint.friendlyName(),
-                    'description': endpoint.description(),
-                    'manufacturerName': endpoint.manufacturerName(),
-                    'displayCategories': endpoint.displayCategories(),
-                    'additionalApplianceDetails': {},
-                }
-                discovery_endpoint['capabilities'] = [
-                    i.serializeDiscovery() for i in endpoint.capabilities()]
-                if not discovery_endpoint['capabilities']:
-                    _LOGGER.debug("Not exposing %s because it has no capabilities", endpoint.endpointId())
-                    continue
-                discovery_endpoints.append(discovery_endpoint)
+            discovery_endpoints = self.handler.getDiscoveryEndpoints()
 
             _LOGGER.debug("Request %s/%s", request[API_HEADER]['namespace'], request[API_HEADER]['name'])
 
+            return self.discoverResponse(request, discovery_endpoints)
+
+        def discoverResponse(self, request, discovery_endpoints):
             return api_message(
                 request, name='Discover.Response', namespace='Alexa.Discovery',
                 payload={'endpoints': discovery_endpoints})
@@ -385,6 +746,9 @@ class Alexa(object):
 
         def setbrightness(self, request, endpoint, brightness):
             endpoint.setBrightness(brightness)
+            return self.brightnessResponse(request, brightness)
+
+        def brightnessResponse(self, request, brightness):
             properties = [{
                 'name': 'brightness',
                 'namespace': 'Alexa.BrightnessController',
@@ -435,6 +799,7 @@ class Alexa(object):
         def DecreaseColorTemperature(self, request):
             _LOGGER.debug("Request %s/%s",
                         request[API_HEADER]['namespace'], request[API_HEADER]['name'])
+            endpoint = self.handler.getEndpoint(request)
             kelvin = endpoint.getProperty('colorTemperature') - 500
             endpoint.setColorTemperature(kelvin)
             return api_message(request)
@@ -442,6 +807,7 @@ class Alexa(object):
         def IncreaseColorTemperature(self, request):
             _LOGGER.debug("Request %s/%s",
                         request[API_HEADER]['namespace'], request[API_HEADER]['name'])
+            endpoint = self.handler.getEndpoint(request)
             kelvin = endpoint.getProperty('colorTemperature') + 500
             endpoint.setColorTemperature(kelvin)
             return api_message(request)
@@ -449,27 +815,24 @@ class Alexa(object):
     class SceneController(AlexaSmartHomeCall):
 
         def Activate(self, request):
-            payload = {
-                'cause': {'type': 'VOICE_INTERACTION'},
-                'timestamp': '%sZ' % (datetime.utcnow().isoformat(),)
-            }
             _LOGGER.debug("Request %s/%s", request[API_HEADER]['namespace'], request[API_HEADER]['name'])
             endpoint = self.handler.getEndpoint(request)
             endpoint.activate()
-            return api_message(request,
-                name='ActivationStarted', namespace='Alexa.SceneController',
-                payload=payload)
+            return self.activationResponse(request, 'ActivationStarted')
 
         def Deactivate(self, request):
+            _LOGGER.debug("Request %s/%s", request[API_HEADER]['namespace'], request[API_HEADER]['name'])
+            endpoint = self.handler.getEndpoint(request)
+            endpoint.deactivate()
+            return self.activationResponse(request, 'DeactivationStarted')
+
+        def activationResponse(self, request, name):
             payload = {
                 'cause': {'type': 'VOICE_INTERACTION'},
                 'timestamp': '%sZ' % (datetime.utcnow().isoformat(),)
             }
-            _LOGGER.debug("Request %s/%s", request[API_HEADER]['namespace'], request[API_HEADER]['name'])
-            endpoint = self.handler.getEndpoint(request)
-            endpoint.deactivate()
             return api_message(request,
-                name='DeactivationStarted', namespace='Alexa.SceneController',
+                name=name, namespace='Alexa.SceneController',
                 payload=payload)
 
     class PercentageController(AlexaSmartHomeCall):
@@ -486,9 +849,7 @@ class Alexa(object):
                         request[API_HEADER]['namespace'], request[API_HEADER]['name'],
                         percentage)
             endpoint = self.handler.getEndpoint(request)
-            if   (percentage < 0):   percentage = 0
-            elif (percentage > 100): percentage = 100
-            endpoint.setPercentage(percentage)
+            endpoint.setPercentage(self.clamp(percentage))
             return api_message(request)
 
         def AdjustPercentage(self, request):
@@ -497,13 +858,17 @@ class Alexa(object):
                         request[API_HEADER]['namespace'], request[API_HEADER]['name'],
                         percentage_delta)
             endpoint = self.handler.getEndpoint(request)
-            percentage = endpoint.getProperty(percentage)
-            target_percentage = int(percentage) + percentage_delta
-            if   (target_percentage < 0):   target_percentage = 0
-            elif (target_percentage > 100): target_percentage = 100
-            endpoint.setPercentage(percentage)
+            percentage = endpoint.getProperty('percentage')
+            target_percentage = self.clamp(int(percentage) + percentage_delta)
+            endpoint.setPercentage(target_percentage)
             return api_message(request)
 
+        @staticmethod
+        def clamp(percentage):
+            if   (percentage < 0):   percentage = 0
+            elif (percentage > 100): percentage = 100
+            return percentage
+
     class LockController(AlexaSmartHomeCall):
 
         def Lock(self, request):
@@ -588,6 +953,9 @@ class Alexa(object):
                 endpoint = self.handler.getEndpoint(request)
                 endpoint.setTargetSetPoint(temp)
 
+            return self.targetSetpointResponse(request, temp, tempScale)
+
+        def targetSetpointResponse(self, request, temp, tempScale="CELSIUS"):
             properties = [{
                 'name': 'targetSetpoint',
                 'namespace': 'Alexa.ThermostatController',
@@ -612,15 +980,7 @@ class Alexa(object):
             target_temp = temp + temp_delta
             endpoint.setTargetSetPoint(target_temp)
 
-            properties = [{
-                'name': 'targetSetpoint',
-                'namespace': 'Alexa.ThermostatController',
-                "value": {
-                    "value": target_temp,
-                    "scale": tempScale
-                }
-            }]
-            return api_message(request, context={'properties': properties})
+            return self.targetSetpointResponse(request, target_temp, tempScale)
 
         def SetThermostatMode(self, request):
             mode = request[API_PAYLOAD]['thermostatMode']
@@ -631,6 +991,9 @@ class Alexa(object):
 
             endpoint = self.handler.getEndpoint(request)
             endpoint.setThermostatMode(mode)
+            return self.thermostatModeResponse(request, mode)
+
+        def thermostatModeResponse(self, request, mode):
             properties = [{
                 'name': 'targetSetthermostatModepoint',
                 'namespace': 'Alexa.ThermostatController',
@@ -641,10 +1004,15 @@ class Alexa(object):
     class ReportState(AlexaSmartHomeCall):
 
         def ReportState(self, request):
+            # Devices Domoticz does not return in time (or while it is unreachable)
+            # are reported from their last known state
+            endpoint = self.handler.getEndpoint(request, allowStale=True)
+            return self.stateReport(request, endpoint)
+
+        def stateReport(self, request, endpoint):
             properties = []
-            endpoint = self.handler.getEndpoint(request)
             for interface in endpoint.capabilities():
-                properties.extend(interface.serializeProperties())
+                properties.extend(interface.serializeProperties(endpoint))
 
             _LOGGER.debug("Request %s/%s properties %s", 
                         request[API_HEADER]['namespace'], request[API_HEADER]['name'], str(properties))
@@ -652,20 +1020,212 @@ class Alexa(object):
                 name='StateReport',
                 context={'properties': properties})
 
-def invoke(namespace, name, handler, request):
-    try:
+async def awaitResult(result):
+    """Await result if it is awaitable: endpoint methods return the coroutine
+    of an asyncio handler call, the result of a blocking one."""
+    if hasattr(result, '__await__'):
+        return await result
+    return result
+
+class AsyncAlexa(object):
+    """The directives reading or commanding devices, with an asyncio handler.
+
+    Endpoint methods return coroutines, properties are loaded (loadProperties)
+    before getProperty is called. Responses are built as by Alexa.
+    """
+
+    class Discovery(Alexa.Discovery):
+
+        async def Discover(self, request):
+            discovery_endpoints = await self.handler.getDiscoveryEndpoints()
+            _LOGGER.debug("Request %s/%s", request[API_HEADER]['namespace'], request[API_HEADER]['name'])
+            return self.discoverResponse(request, discovery_endpoints)
+
+    class PowerController(Alexa.PowerController):
+
+        async def TurnOn(self, request):
+            _LOGGER.debug("Request %s/%s", request[API_HEADER]['namespace'], request[API_HEADER]['name'])
+            endpoint = self.handler.getEndpoint(request)
+            await awaitResult(endpoint.turnOn())
+            return api_message(request)
+
+        async def TurnOff(self, request):
+            _LOGGER.debug("Request %s/%s", request[API_HEADER]['namespace'], request[API_HEADER]['name'])
+            endpoint = self.handler.getEndpoint(request)
+            await awaitResult(endpoint.turnOff())
+            return api_message(request)
+
+    class BrightnessController(Alexa.BrightnessController):
+
+        async def SetBrightness(self, request):
+            brightness = int(request[API_PAYLOAD]['brightness'])
+            _LOGGER.debug("Request %s/%s brightness %d",
+                        request[API_HEADER]['namespace'], request[API_HEADER]['name'], brightness)
+            endpoint = self.handler.getEndpoint(request)
+            await awaitResult(endpoint.setBrightness(brightness))
+            return self.brightnessResponse(request, brightness)
+
+        async def AdjustBrightness(self, request):
+            brightness_delta = int(request[API_PAYLOAD]['brightnessDelta'])
+            _LOGGER.debug("Request %s/%s brightness_delta %d",
+                        request[API_HEADER]['namespace'], request[API_HEADER]['name'], brightness_delta)
+            endpoint = self.handler.getEndpoint(request)
+            await endpoint.loadProperties()
+            brightness = endpoint.getProperty('brightness') + brightness_delta
+            await awaitResult(endpoint.setBrightness(brightness))
+            return self.brightnessResponse(request, brightness)
+
+    class ColorController(Alexa.ColorController):
+
+        async def SetColor(self, request):
+            h = float(request[API_PAYLOAD]['color']['hue'])
+            s = float(request[API_PAYLOAD]['color']['saturation'])
+            b = float(request[API_PAYLOAD]['color']['brightness'])
+            _LOGGER.debug("Request %s/%s", request[API_HEADER]['namespace'], request[API_HEADER]['name'])
+            endpoint = self.handler.getEndpoint(request)
+            await awaitResult(endpoint.setColor(h,s,b))
+            return api_message(request)
+
+    class ColorTemperatureController(Alexa.ColorTemperatureController):
+
+        async def SetColorTemperature(self, request):
+            kelvin = int(request[API_PAYLOAD]['colorTemperatureInKelvin'])
+            _LOGGER.debug("Request %s/%s kelvin %d",
+                        request[API_HEADER]['namespace'], request[API_HEADER]['name'], kelvin)
+            endpoint = self.handler.getEndpoint(request)
+            await awaitResult(endpoint.setColorTemperature(kelvin))
+            return api_message(request)
+
+        async def DecreaseColorTemperature(self, request):
+            return await self.adjustColorTemperature(request, -500)
+
+        async def IncreaseColorTemperature(self, request):
+            return await self.adjustColorTemperature(request, 500)
+
+        async def adjustColorTemperature(self, request, delta):
+            _LOGGER.debug("Request %s/%s", request[API_HEADER]['namespace'], request[API_HEADER]['name'])
+            endpoint = self.handler.getEndpoint(request)
+            await endpoint.loadProperties()
+            kelvin = endpoint.getProperty('colorTemperature') + delta
+            await awaitResult(endpoint.setColorTemperature(kelvin))
+            return api_message(request)
+
+    class SceneController(Alexa.SceneController):
+
+        async def Activate(self, request):
+            _LOGGER.debug("Request %s/%s", request[API_HEADER]['namespace'], request[API_HEADER]['name'])
+            endpoint = self.handler.getEndpoint(request)
+            await awaitResult(endpoint.activate())
+            return self.activationResponse(request, 'ActivationStarted')
+
+        async def Deactivate(self, request):
+            _LOGGER.debug("Request %s/%s", request[API_HEADER]['namespace'], request[API_HEADER]['name'])
+            endpoint = self.handler.getEndpoint(request)
+            await awaitResult(endpoint.deactivate())
+            return self.activationResponse(request, 'DeactivationStarted')
+
+    class PercentageController(Alexa.PercentageController):
+
+        async def SetPercentage(self, request):
+            percentage = int(request[API_PAYLOAD]['percentage'])
+            _LOGGER.debug("Request %s/%s percentage %d",
+                        request[API_HEADER]['namespace'], request[API_HEADER]['name'], percentage)
+            endpoint = self.handler.getEndpoint(request)
+            await awaitResult(endpoint.setPercentage(self.clamp(percentage)))
+            return api_message(request)
+
+        async def AdjustPercentage(self, request):
+            percentage_delta = int(request[API_PAYLOAD]['percentageDelta'])
+            _LOGGER.debug("Request %s/%s percentage_delta %d",
+                        request[API_HEADER]['namespace'], request[API_HEADER]['name'], percentage_delta)
+            endpoint = self.handler.getEndpoint(request)
+            await endpoint.loadProperties()
+            target_percentage = self.clamp(int(endpoint.getProperty('percentage')) + percentage_delta)
+            await awaitResult(endpoint.setPercentage(target_percentage))
+            return api_message(request)
+
+    class ThermostatController(Alexa.ThermostatController):
+
+        async def SetTargetTemperature(self, request):
+            temp = 20.0
+            payload = request[API_PAYLOAD]
+            if 'targetSetpoint' in payload:
+                temp = temperature_from_object(payload['targetSetpoint'])
+                _LOGGER.debug("Request %s/%s targetSetpoint %.2f",
+                            request[API_HEADER]['namespace'], request[API_HEADER]['name'], temp)
+                endpoint = self.handler.getEndpoint(request)
+                await awaitResult(endpoint.setTargetSetPoint(temp))
+            return self.targetSetpointResponse(request, temp)
+
+        async def AdjustTargetTemperature(self, request):
+            temp_delta = temperature_from_object(request[API_PAYLOAD]['targetSetpointDelta'])
+            _LOGGER.debug("Request %s/%s targetSetpoint temp_delta %.2f",
+                        request[API_HEADER]['namespace'], request[API_HEADER]['name'], temp_delta)
+            endpoint = self.handler.getEndpoint(request)
+            await endpoint.loadProperties()
+            target_temp = endpoint.getProperty('targetSetpoint')['value'] + temp_delta
+            await awaitResult(endpoint.setTargetSetPoint(target_temp))
+            return self.targetSetpointResponse(request, target_temp)
+
+        async def SetThermostatMode(self, request):
+            mode = request[API_PAYLOAD]['thermostatMode']
+            mode = mode if isinstance(mode, str) else mode['value']
+            _LOGGER.debug("Request %s/%s targetSetpoint mode %s",
+                        request[API_HEADER]['namespace'], request[API_HEADER]['name'], str(mode))
+            endpoint = self.handler.getEndpoint(request)
+            await awaitResult(endpoint.setThermostatMode(mode))
+            return self.thermostatModeResponse(request, mode)
+
+    class ReportState(Alexa.ReportState):
+
+        async def ReportState(self, request):
+            endpoint = self.handler.getEndpoint(request, allowStale=True)
+            # Endpoints without properties (scenes) are not read
+            if any(interface.propertiesSupported() for interface in endpoint.capabilities()):
+                await endpoint.loadProperties()
+            return self.stateReport(request, endpoint)
+
+# Directive dispatch tables: (namespace, name) -> (AlexaSmartHomeCall class, method)
+DIRECTIVES = {}
+# The directives async_handle_message awaits, the others are invoked as by handle_message
+ASYNC_DIRECTIVES = {}
+
+# Namespaces directives may come from: the interfaces, discovery and state report
+SUPPORTED_NAMESPACES = frozenset(INTERFACES) | {'Alexa', 'Alexa.Discovery'}
+
+def _registerDirectives(calls, directives):
+    for callName, call in vars(calls).items():
+        if not (isinstance(call, type) and issubclass(call, AlexaSmartHomeCall)):
+            continue
         # Special case report
-        if namespace == "Alexa" and name == "ReportState":
-            namespace = "Alexa.ReportState"
-        class allowed(object):
-            Alexa = Alexa
-        make_class = operator.attrgetter(namespace)
-        obj = make_class(allowed)(namespace, name, handler)
-        return obj.invoke(name, request)
+        namespace = 'Alexa' if callName == 'ReportState' else 'Alexa.' + callName
+        if namespace not in SUPPORTED_NAMESPACES:
+            _LOGGER.error("Not registering %s directives: unsupported interface", namespace)
+            continue
+        # Directives are the capitalized methods
+        for name, function in vars(call).items():
+            if callable(function) and name[:1].isupper():
+                directives[(namespace, name)] = (call, function)
+
+_registerDirectives(Alexa, DIRECTIVES)
+_registerDirectives(AsyncAlexa, ASYNC_DIRECTIVES)
 
-    except Exception:
-        _LOGGER.error("Can't process %s/%s", namespace, name)
-        return api_error(request, error_type='INTERNAL_ERROR')
+def invoke(namespace, name, handler, request):
+    directive = DIRECTIVES.get((namespace, name))
+    if directive is None:
+        return api_error(request, error_type='INVALID_DIRECTIVE',
+                         error_message="Unsupported directive %s/%s" % (namespace, name))
+    call, function = directive
+    with span('invoke'):
+        return call(namespace, name, handler).invoke(function, request)
+
+async def async_invoke(namespace, name, handler, request):
+    directive = ASYNC_DIRECTIVES.get((namespace, name))
+    if directive is None:
+        return invoke(namespace, name, handler, request)
+    call, function = directive
+    with span('invoke'):
+        return await call(namespace, name, handler).invokeAsync(function, request)
 
 def fahrenheit_to_celsius(fahrenheit: float, interval: bool = False) -> float:
     if interval:
@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+#
+# Proactive state reporting: Domoticz device changes are sent to Alexa as
+# ChangeReport events, so Alexa does not have to poll ReportState
+#
+# Runs next to Domoticz (not in the lambda), with the skill configuration:
+# python3 ChangeReport.py configdz.json
+#
+# configdz.json keys: eventGateway, eventToken (or eventClientId, eventClientSecret
+# and eventRefreshToken to have it refreshed), changeReportInterval,
+# changeReportDebounce, changeReportRefresh
+#
+# Changes following a command are not reported, Alexa got the new state in the
+# directive response. Only the commands sent through the reporter Domoticz
+# client are known (its OptimisticState log): a reporter embedded in the
+# process answering the directives skips them, this standalone script reports
+# the changes the lambda commands cause as physical interactions too.
+#
+
+import sys, json, threading, time
+import logging
+from uuid import uuid4
+
+import AlexaSmartHome, DomoticzHandler
+from AlexaSmartHome import API_EVENT, API_HEADER, API_ENDPOINT, API_PAYLOAD, API_CONTEXT
+
+EVENT_GATEWAY = 'https://api.amazonalexa.com/v3/events'
+
+LWA_TOKEN_URL = 'https://api.amazon.com/auth/o2/token'
+
+# Seconds before its expiry an access token is refreshed
+TOKEN_MARGIN = 60
+
+_LOGGER = logging.getLogger(__name__)
+
+class LastUpdateSource(object):
+    """Changed devices, polled with lastupdate=<ActTime> device queries."""
+
+    def __init__(self, domoticz, query=DomoticzHandler.DEVICES_QUERY):
+        self.domoticz = domoticz
+        self.query = query
+        self.actTime = None
+
+    def poll(self):
+        """Return the devices changed since the previous poll (all of them the first time)."""
+        query = self.query
+        if self.actTime is not None:
+            query += '&lastupdate=%s' % self.actTime
+        response = self.domoticz.api(query)
+        self.actTime = response.get('ActTime', self.actTime)
+        return response.get('result', [])
+
+class PushSource(object):
+    """Changed devices pushed by a local bridge (MQTT domoticz/out, websocket...).
+
+    push() takes the device, or only its idx: the device is then read on the
+    next poll().
+    """
+
+    def __init__(self, domoticz):
+        self.domoticz = domoticz
+        self._pushed = {}
+        self._lock = threading.Lock()
+
+    def push(self, idx, device=None):
+        with self._lock:
+            self._pushed[str(idx)] = device
+
+    def poll(self):
+        with self._lock:
+            pushed, self._pushed = self._pushed, {}
+        return [device if device is not None else self.domoticz.getDevice(idx)
+                for idx, device in pushed.items()]
+
+class ListSink(object):
+    """Keeps the events sent (tests, dry runs)."""
+
+    def __init__(self):
+        self.events = []
+
+    def send(self, events):
+        self.events.extend(events)
+
+class EventToken(object):
+    """Access token of the Alexa event gateway.
+
+    With clientId, clientSecret and refreshToken (the Login with Amazon grant
+    of the skill, see the AcceptGrant directive) the token is refreshed before
+    it expires. Otherwise token is used as is: an LWA token expires after an
+    hour, the gateway then refuses the events (401).
+    """
+
+    def __init__(self, token=None, clientId=None, clientSecret=None, refreshToken=None,
+                 url=LWA_TOKEN_URL, timeout=10):
+        self.token = token
+        self.clientId = clientId
+        self.clientSecret = clientSecret
+        self.refreshToken = refreshToken
+        self.url = url
+        self.timeout = timeout
+        self.expiresAt = None
+
+    def refreshable(self):
+        return bool(self.clientId and self.clientSecret and self.refreshToken)
+
+    def get(self):
+        if self.refreshable() and (self.expiresAt is None or time.monotonic() >= self.expiresAt):
+            self.refresh()
+        return self.token
+
+    def invalidate(self):
+        """Have the token refreshed on next get() (the gateway refused it)."""
+        self.expiresAt = None
+
+    def refresh(self):
+        from urllib.parse import urlencode
+        from urllib.request import urlopen
+        body = urlencode({'grant_type': 'refresh_token', 'refresh_token': self.refreshToken,
+                          'client_id': self.clientId, 'client_secret': self.clientSecret}).encode()
+        with urlopen(self.url, body, self.timeout) as response:
+            grant = json.load(response)
+        self.token = grant['access_token']
+        # LWA may hand out a new refresh token
+        self.refreshToken = grant.get('refresh_token', self.refreshToken)
+        self.expiresAt = time.monotonic() + grant.get('expires_in', 3600) - TOKEN_MARGIN
+        _LOGGER.info("Alexa event gateway token refreshed")
+
+class GatewaySink(object):
+    """Posts events to the Alexa event gateway, one keep-alive connection per batch.
+
+    token is an EventToken (or a static token), it also goes to the scope of
+    the events.
+    """
+
+    def __init__(self, url=EVENT_GATEWAY, token=None, timeout=10):
+        self.url = url
+        self.token = token if isinstance(token, EventToken) else EventToken(token)
+        self.timeout = timeout
+
+    def send(self, events):
+        import http.client
+        from urllib.parse import urlsplit
+        parts = urlsplit(self.url)
+        if parts.scheme == 'https':
+            conn = http.client.HTTPSConnection(parts.hostname, parts.port, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=self.timeout)
+        try:
+            for event in events:
+                response = self.post(conn, parts.path or '/', event)
+                if response.status == 401 and self.token.refreshable():
+                    # Revoked or expired early: refreshed and sent again, once
+                    self.token.invalidate()
+                    response = self.post(conn, parts.path or '/', event)
+                if response.status == 401:
+                    _LOGGER.error("ChangeReport refused, the event gateway token expired or is invalid "
+                                  "(eventClientId, eventClientSecret and eventRefreshToken have it refreshed)")
+                elif response.status >= 300:
+                    _LOGGER.warning("ChangeReport for %s rejected: %d %s",
+                                    event[API_EVENT][API_ENDPOINT]['endpointId'], response.status, response.reason)
+        finally:
+            conn.close()
+
+    def post(self, conn, path, event):
+        headers = {'Content-Type': 'application/json'}
+        token = self.token.get()
+        if token:
+            headers['Authorization'] = 'Bearer %s' % token
+            event[API_EVENT][API_ENDPOINT]['scope']['token'] = token
+        conn.request('POST', path, body=json.dumps(event).encode(), headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return response
+
+class ChangeReporter(object):
+    """Turns device changes into ChangeReport events.
+
+    Changes are debounced: they are sent together once debounce seconds have
+    passed since the first pending one, a device changing several times in
+    between is reported once with its last state. Only the properties whose
+    value changed since the last report are in the change, the others go to
+    the event context.
+
+    A change less than commandWindow seconds after a command sent to the device
+    through domoticz is not reported, only recorded. The discovered endpoints
+    are refreshed every refreshInterval seconds (0: only when primed).
+    """
+
+    def __init__(self, domoticz, source, sink, debounce=1.0, token=None, commandWindow=5.0, refreshInterval=300):
+        self.domoticz = domoticz
+        self.source = source
+        self.sink = sink
+        self.debounce = debounce
+        self.token = token
+        self.commandWindow = commandWindow
+        self.refreshInterval = refreshInterval
+        self.endpoints = {}
+        self.refreshedAt = None
+        self._reported = {}
+        self._pending = {}
+        self._firstPending = None
+
+    def refreshEndpoints(self):
+        """(Re)build the idx -> device endpoints map (the discovered ones).
+
+        The state of a new endpoint is recorded, not reported. What was
+        reported of the endpoints no longer discovered is forgotten.
+        """
+        devices, scenes = self.domoticz.getDiscoveryItems()
+        known = set(endpoint.endpointId() for endpoints in self.endpoints.values() for endpoint in endpoints)
+        devicesByIdx = dict((device['idx'], device) for device in devices)
+        endpoints = {}
+        for endpoint in self.domoticz.getEndpoints(devices, ()):
+            idx = endpoint.endpointId().split('-')[1]
+            endpoints.setdefault(idx, []).append(endpoint)
+            if endpoint.endpointId() not in known:
+                self.recordState(endpoint, devicesByIdx[idx])
+        endpointIds = set(endpoint.endpointId() for idxEndpoints in endpoints.values() for endpoint in idxEndpoints)
+        self._reported = dict((key, value) for key, value in self._reported.items() if key[0] in endpointIds)
+        self.endpoints = endpoints
+        self.refreshedAt = time.monotonic()
+
+    def recordState(self, endpoint, device):
+        """Record the properties of endpoint as reported."""
+        try:
+            for prop in self.properties(endpoint, device):
+                self._reported[(endpoint.endpointId(), prop['namespace'], prop['name'])] = prop['value']
+        except Exception:
+            _LOGGER.exception("Can't read the properties of %s", endpoint.endpointId())
+
+    def followsCommand(self, idx):
+        """Whether device idx was sent a command less than commandWindow seconds ago."""
+        commandedAt = self.domoticz.optimistic.lastCommand(idx)
+        return commandedAt is not None and time.monotonic() - commandedAt < self.commandWindow
+
+    def properties(self, endpoint, device):
+        """The reported properties of the discovered endpoint capabilities, read from device."""
+        target = self.domoticz.getEndpoint({API_ENDPOINT: {'endpointId': endpoint.endpointId(), 'cookie': endpoint.cookies()}})
+        target.setHandler(self.domoticz, DomoticzHandler.DeviceContext(self.domoticz, {device['idx']: device}))
+        properties = []
+        for interface in endpoint.capabilities():
+            if interface.propertiesProactivelyReported():
+                properties.extend(interface.serializeProperties(target))
+        return properties
+
+    def deviceChanged(self, device):
+        if device['idx'] in self.endpoints:
+            self._pending[device['idx']] = device
+            if self._firstPending is None:
+                self._firstPending = time.monotonic()
+
+    def flush(self, force=False):
+        """Send the pending changes if their debounce delay is over (or force), return the events sent."""
+        if not self._pending:
+            return []
+        if not force and time.monotonic() - self._firstPending < self.debounce:
+            return []
+        pending, self._pending, self._firstPending = self._pending, {}, None
+        events = []
+        for idx, device in pending.items():
+            for endpoint in self.endpoints.get(idx, ()):
+                event = self.changeReport(endpoint, device)
+                if event is not None:
+                    events.append(event)
+        if events:
+            self.sink.send(events)
+        return events
+
+    def changeReport(self, endpoint, device):
+        endpointId = endpoint.endpointId()
+        try:
+            properties = self.properties(endpoint, device)
+        except Exception:
+            _LOGGER.exception("Can't read the properties of %s", endpointId)
+            return None
+        changed, unchanged = [], []
+        for prop in properties:
+            key = (endpointId, prop['namespace'], prop['name'])
+            if key not in self._reported or self._reported[key] != prop['value']:
+                changed.append(prop)
+            else:
+                unchanged.append(prop)
+            self._reported[key] = prop['value']
+        if not changed:
+            return None
+        if self.followsCommand(device['idx']):
+            _LOGGER.debug("%s changed by a command, not reported", endpointId)
+            return None
+        return {
+            API_EVENT: {
+                API_HEADER: {
+                    'namespace': 'Alexa',
+                    'name': 'ChangeReport',
+                    'payloadVersion': '3',
+                    'messageId': str(uuid4()),
+                },
+                API_ENDPOINT: {
+                    'scope': {'type': 'BearerToken', 'token': self.token},
+                    'endpointId': endpointId,
+                },
+                API_PAYLOAD: {
+                    'change': {
+                        'cause': {'type': 'PHYSICAL_INTERACTION'},
+                        'properties': changed,
+                    },
+                },
+            },
+            API_CONTEXT: {'properties': unchanged},
+        }
+
+    def prime(self):
+        """Record the current state of every endpoint without reporting it."""
+        self.refreshEndpoints()
+        for device in self.source.poll():
+            for endpoint in self.endpoints.get(device['idx'], ()):
+                self.recordState(endpoint, device)
+
+    def process(self, devices):
+        for device in devices:
+            self.deviceChanged(device)
+        return self.flush()
+
+    def run(self, interval=2.0, stop=None):
+        """Poll the source every interval seconds until stop (a threading.Event) is set."""
+        stop = stop or threading.Event()
+        self.prime()
+        while not stop.is_set():
+            try:
+                if self.refreshInterval > 0 and time.monotonic() - self.refreshedAt >= self.refreshInterval:
+                    self.refreshEndpoints()
+                self.process(self.source.poll())
+            except Exception:
+                _LOGGER.exception("ChangeReport poll failed")
+            wait = interval
+            if self._firstPending is not None:
+                wait = min(wait, max(0, self._firstPending + self.debounce - time.monotonic()))
+            stop.wait(wait)
+
+if __name__ == '__main__':
+    import importlib
+    logging.basicConfig(level=logging.INFO)
+    awslambda = importlib.import_module('lambda')
+    config = awslambda.Configuration(sys.argv[1] if len(sys.argv) > 1 else awslambda.CONFIG_FILE)
+    if config.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    dz = DomoticzHandler.Domoticz(config.url, config.username, config.password)
+    dz.configure(config)
+    token = EventToken(config.eventToken, config.eventClientId, config.eventClientSecret, config.eventRefreshToken)
+    reporter = ChangeReporter(dz, LastUpdateSource(dz), GatewaySink(config.eventGateway or EVENT_GATEWAY, token),
+                              debounce=config.changeReportDebounce, refreshInterval=config.changeReportRefresh)
+    try:
+        reporter.run(interval=config.changeReportInterval)
+    except KeyboardInterrupt:
+        pass
@@ -1,28 +1,111 @@
-import os, json, urllib, ssl, base64
-from urllib.request import urlopen, Request
-import re
+import os, json, codecs, ssl, base64, re
+import http.client, socket, threading, time
+from collections import namedtuple
+from functools import lru_cache
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
 from AlexaSmartHome import *
 
-import math, colorsys
+import math
 import logging
 
+# Cold start: asyncio, hashlib and concurrent.futures are imported where used
+# (asyncio client, Discover fingerprint, parallel fetches), a TurnOn needs none of them
+
 SKILL_NAME = 'Alexicz'
 
 ENDPOINT_ADAPTERS = Registry()
 
 _LOGGER = logging.getLogger(__name__)
 
+class DeviceContext(object):
+    """Devices read while handling one directive, each one is fetched at most once.
+
+    With allowStale, a device Domoticz does not return (deadline, circuit
+    breaker open) is served from its last known state, uncertainty
+    (milliseconds) is its age. static holds the device fields known without
+    reading the device (endpoint descriptor), by idx. With an asyncio handler
+    the devices are read with load() first.
+    """
+
+    def __init__(self, handler, devices=None, allowStale=False, static=None):
+        self.handler = handler
+        self._devices = devices if devices is not None else {}
+        self.allowStale = allowStale
+        self.static = static if static is not None else {}
+        self.uncertainty = 0
+
+    def staticFields(self, idx, names):
+        """A dict with the static fields names of device idx, None when they are not all known."""
+        static = self.static.get(idx)
+        if static is not None and all(name in static for name in names):
+            return static
+        return None
+
+    def getDevice(self, idx):
+        device = self._devices.get(idx)
+        if device is None:
+            if self.handler.isAsync:
+                raise RuntimeError("Device %s was not loaded" % idx)
+            try:
+                device = self.handler.getDevice(idx)
+            except UNAVAILABLE_ERRORS as e:
+                device = self.lastKnown(idx, e)
+            self._devices[idx] = device
+        return device
+
+    async def load(self, idx):
+        """Read device idx with an asyncio handler, getDevice() then returns it."""
+        device = self._devices.get(idx)
+        if device is None:
+            try:
+                device = await self.handler.getDevice(idx)
+            except UNAVAILABLE_ERRORS as e:
+                device = self.lastKnown(idx, e)
+            self._devices[idx] = device
+        return device
+
+    def lastKnown(self, idx, error):
+        """The last known state of device idx Domoticz did not return (error), if allowStale."""
+        known = self.handler.deviceCache.lastKnown(idx) if self.allowStale else None
+        if known is None:
+            raise error
+        device, age = known
+        self.uncertainty = max(self.uncertainty, int(age * 1000))
+        mark('stale.device')
+        _LOGGER.warning("Domoticz device %s unavailable (%s), reporting its state of %.1f s ago",
+                        idx, type(error).__name__, age)
+        return device
+
 class DomoticzEndpoint(AlexaEndpoint):
+    __slots__ = ('handler', 'context')
 
-    _device_ = None
     def getDevice(self):
-        if self._device_ is None:
-            self._device_ = self.handler.getDevice(self._endpointId)
-        return self._device_
-
-    def setHandler(self, handler):
+        return self.context.getDevice(self._endpointId)
+
+    async def loadProperties(self):
+        await self.context.load(self._endpointId)
+
+    def withDevice(self, function, names=None):
+        """Return function(device) called with the endpoint device, or with its
+        static fields when names are all known. With an asyncio handler a
+        coroutine is returned, the device is read first."""
+        idx = self._endpointId
+        static = self.context.staticFields(idx, names) if names else None
+        if not self.handler.isAsync:
+            return function(static if static is not None else self.getDevice())
+        async def call():
+            device = static if static is not None else await self.context.load(idx)
+            return await function(device)
+        return call()
+
+    def setHandler(self, handler, context=None):
         self.handler = handler
-    
+        self.context = context if context is not None else DeviceContext(handler)
+
+    def uncertaintyInMilliseconds(self):
+        return self.context.uncertainty
+
     def getProperty(self, name):
         #device = self.handler.getDevice(self._endpointId)
         device = self.getDevice()
@@ -81,101 +164,113 @@ class DomoticzEndpoint(AlexaEndpoint):
         return None
 
 class OnOffAlexaEndpoint(DomoticzEndpoint):
+    __slots__ = ()
 
     def __init__(self, endpointId, friendlyName="", description="", manufacturerName=""):
         super().__init__(endpointId, friendlyName, description, manufacturerName)
-        self.addCapability(AlexaPowerController(self, 'Alexa.PowerController',[{'name': 'powerState'}]))
+        self.addCapability(AlexaPowerController.shared())
 
     def turnOn(self):
-        self.handler.setSwitch(self._endpointId, 'On')
+        return self.handler.setSwitch(self._endpointId, 'On')
 
     def turnOff(self):
-        self.handler.setSwitch(self._endpointId, 'Off')
+        return self.handler.setSwitch(self._endpointId, 'Off')
 
 @ENDPOINT_ADAPTERS.register('Scene')
 class SceneAlexaEndpoint(DomoticzEndpoint):
+    __slots__ = ()
 
     def __init__(self, endpointId, friendlyName="", description="", manufacturerName=""):
         super().__init__(endpointId, friendlyName, description, manufacturerName)
-        self.addCapability(AlexaSceneController(self, 'Alexa.AlexaSceneController', deactivationSupported=False))
+        self.addCapability(AlexaSceneController.shared(deactivationSupported=False))
 
     def activate(self):
-        self.handler.setSceneSwitch(self._endpointId, 'On')
+        return self.handler.setSceneSwitch(self._endpointId, 'On')
 
     def deactivate(self):
-        self.handler.setSceneSwitch(self._endpointId, 'Off')
+        return self.handler.setSceneSwitch(self._endpointId, 'Off')
 
 @ENDPOINT_ADAPTERS.register('Group')
 class GroupAlexaEndpoint(SceneAlexaEndpoint):
+    __slots__ = ()
 
     def __init__(self, endpointId, friendlyName="", description="", manufacturerName=""):
         super().__init__(endpointId, friendlyName, description, manufacturerName)
-        self.addCapability(AlexaSceneController(self, 'Alexa.AlexaSceneController', deactivationSupported=True))
+        self.addCapability(AlexaSceneController.shared(deactivationSupported=True))
 
 @ENDPOINT_ADAPTERS.register('SwitchLight')
 class SwitchLightAlexaEndpoint(OnOffAlexaEndpoint):
+    __slots__ = ()
 
     def setPercentage(self, percentage):
-        self.handler.setLevel(self._endpointId, percentage)
+        return self.handler.setLevel(self._endpointId, percentage)
 
     def setBrightness(self, brightness):
-        self.handler.setLevel(self._endpointId, brightness)
+        return self.handler.setLevel(self._endpointId, brightness)
 
     def setColor(self, hue, saturation, brigthness):
         rgb = color_hsb_to_RGB(hue, saturation, brigthness)
-        device = self.getDevice()
-        self.handler.setColor(self._endpointId, rgb, device['Level'])
+        return self.withDevice(lambda device: self.handler.setColor(self._endpointId, rgb, device['Level']))
 
     def setColorTemperature(self, kelvin):
+        if self.cookies().get(WHITE_TEMPERATURE_COOKIE) == 'true':
+            # Native white temperature, no RGB and no Level read
+            return self.handler.setKelvinLevel(self._endpointId, kelvin_to_level(kelvin))
         rgb = convert_K_to_RGB(kelvin)
-        device = self.getDevice()
-        self.handler.setColor(self._endpointId, rgb, device['Level'])
+        return self.withDevice(lambda device: self.handler.setColor(self._endpointId, rgb, device['Level']))
 
 @ENDPOINT_ADAPTERS.register('Blind')
 class BlindAlexaEndpoint(OnOffAlexaEndpoint):
+    __slots__ = ()
 
     def turnOn(self):
-        self.handler.setSwitch(self._endpointId, 'Off')
+        return self.handler.setSwitch(self._endpointId, 'Off')
 
     def turnOff(self):
-        self.handler.setSwitch(self._endpointId, 'On')
+        return self.handler.setSwitch(self._endpointId, 'On')
 
     def setPercentage(self, percentage):
-        self.handler.setLevel(self._endpointId, percentage)
+        return self.handler.setLevel(self._endpointId, percentage)
 
 @ENDPOINT_ADAPTERS.register('RFY')
 class RFYAlexaEndpoint(OnOffAlexaEndpoint):
+    __slots__ = ()
 
     def turnOn(self):
-        self.handler.setSwitch(self._endpointId, 'Off')
+        return self.handler.setSwitch(self._endpointId, 'Off')
 
     def turnOff(self):
-        self.handler.setSwitch(self._endpointId, 'On')
+        return self.handler.setSwitch(self._endpointId, 'On')
 
     def setPercentage(self, percentage):
-        self.handler.setLevel(self._endpointId, percentage)
+        return self.handler.setLevel(self._endpointId, percentage)
 
 class LockableAlexaEndpoint(DomoticzEndpoint):
+    __slots__ = ()
+
     def __init__(self, endpointId, friendlyName="", description="", manufacturerName=""):
         super().__init__(endpointId, friendlyName, description, manufacturerName)
-        self.addCapability(AlexaLockController(self, 'Alexa.LockController',[{'name': 'lockState'}]))              
+        self.addCapability(AlexaLockController.shared())
 
 @ENDPOINT_ADAPTERS.register('Lock')
 class LockAlexaEndpoint(LockableAlexaEndpoint):
-    pass
+    __slots__ = ()
 
 @ENDPOINT_ADAPTERS.register('Contact')
 class ContactAlexaEndpoint(DomoticzEndpoint):
+    __slots__ = ()
+
     def __init__(self, endpointId, friendlyName="", description="", manufacturerName=""):
         super().__init__(endpointId, friendlyName, description, manufacturerName)
-        self.addCapability(AlexaContactSensor(self, 'Alexa.ContactSensor',[{'name': 'detectionState'}]))
+        self.addCapability(AlexaContactSensor.shared())
 
 @ENDPOINT_ADAPTERS.register('TemperatureSensor')
 class TemperatureSensorAlexaEndpoint(DomoticzEndpoint):
+    __slots__ = ()
 
     def __init__(self, endpointId, friendlyName="", description="", manufacturerName=""):
         super().__init__(endpointId, friendlyName, description, manufacturerName)
-        self.addCapability(AlexaTemperatureSensor(self, 'Alexa.TemperatureSensor',[{'name': 'temperature'}]))
+        self.addCapability(AlexaTemperatureSensor.shared())
 
     def setTargetSetPoint(self, targetSetPoint):
         pass
@@ -185,101 +280,817 @@ class TemperatureSensorAlexaEndpoint(DomoticzEndpoint):
 
 @ENDPOINT_ADAPTERS.register('Thermostat')
 class ThermostatAlexaEndpoint(DomoticzEndpoint):
+    __slots__ = ()
 
     def __init__(self, endpointId, friendlyName="", description="", manufacturerName=""):
         super().__init__(endpointId, friendlyName, description, manufacturerName)
-        self.addCapability(AlexaTemperatureSensor(self, 'Alexa.TemperatureSensor',[{'name': 'temperature'}]))
-        thermostatCapability = AlexaThermostatController(self, 'Alexa.ThermostatController',[{'name': 'targetSetpoint'}, {'name': 'thermostatMode'}])
-        thermostatCapability.setModesSupported(["HEAT","COOL","AUTO","ECO","OFF"])
-        self.addCapability(thermostatCapability)
+        self.addCapability(AlexaTemperatureSensor.shared())
+        self.addCapability(AlexaThermostatController.shared(modesSupported=["HEAT","COOL","AUTO","ECO","OFF"]))
 
     def setTargetSetPoint(self, targetSetPoint):
-        self.handler.setTemp(self._endpointId, targetSetPoint)
+        return self.handler.setTemp(self._endpointId, targetSetPoint)
 
     def setThermostatMode(self, mode):
         pass
 
 @ENDPOINT_ADAPTERS.register('SelectorThermostat')
 class SelectorThermostatAlexaEndpoint(DomoticzEndpoint):
+    __slots__ = ()
 
     def setTargetSetPoint(self, targetSetPoint):
         #self.handler.setTemp(self._endpointId, targetSetPoint)
         pass
 
     def setThermostatMode(self, mode):
-        self.handler.setLevelByName(self._endpointId, mode)
+        return self.withDevice(lambda device: self.handler.setLevelByName(self._endpointId, mode, device),
+                               ('LevelNames', 'LevelInt'))
+
+# AlexaInterface properties argument of the capabilities not defining their own
+CAPABILITY_PROPERTIES = {
+    'Alexa.PercentageController': [{'name': 'percentage'}],
+    'Alexa.BrightnessController': [{'name': 'brightness'}],
+}
+
+@lru_cache(maxsize=None)
+def createCapability(interface):
+    """Return the shared capability instance of an interface name."""
+    return INTERFACES[interface].shared(properties=CAPABILITY_PROPERTIES.get(interface, []))
+
+# Endpoint descriptor cookie: "<version>;<capabilities>;<MaxDimLevel>;<LevelInt>;<LevelNames>"
+# capabilities are the codes of the ones the classification added (the
+# adapter class adds the others), empty fields are unknown. Descriptors of
+# another version are ignored.
+DESCRIPTOR_COOKIE = 'descriptor'
+DESCRIPTOR_VERSION = '1'
+DESCRIPTOR_CAPABILITIES = {
+    'P': 'Alexa.PercentageController',
+    'B': 'Alexa.BrightnessController',
+    'C': 'Alexa.ColorController',
+    'T': 'Alexa.ColorTemperatureController',
+}
+_DESCRIPTOR_CODES = dict((interface, code) for code, interface in DESCRIPTOR_CAPABILITIES.items())
+DESCRIPTOR_FIELDS = (('MaxDimLevel', int), ('LevelInt', int), ('LevelNames', str))
+
+def endpointDescriptor(spec, device):
+    """The descriptor cookie of the endpoint spec built for device."""
+    fields = [DESCRIPTOR_VERSION, ''.join(_DESCRIPTOR_CODES[interface] for interface in spec.capabilities)]
+    for name, kind in DESCRIPTOR_FIELDS:
+        value = device.get(name)
+        fields.append('' if value is None else str(value))
+    return ';'.join(fields)
+
+@lru_cache(maxsize=1024)
+def descriptorCookies(descriptor, whiteTemperature):
+    """The cookies of the endpoints of descriptor, one dict shared by all of them."""
+    cookies = {DESCRIPTOR_COOKIE: descriptor}
+    if whiteTemperature:
+        cookies[WHITE_TEMPERATURE_COOKIE] = 'true'
+    return cookies
+
+@lru_cache(maxsize=1024)
+def parseEndpointDescriptor(descriptor):
+    """Return (capabilities, static device fields) of a descriptor cookie, None
+    if it is missing or can't be used."""
+    if not descriptor:
+        return None
+    fields = descriptor.split(';', len(DESCRIPTOR_FIELDS) + 1)
+    if fields[0] != DESCRIPTOR_VERSION or len(fields) != len(DESCRIPTOR_FIELDS) + 2:
+        return None
+    try:
+        capabilities = tuple(DESCRIPTOR_CAPABILITIES[code] for code in fields[1])
+        static = dict((name, kind(value)) for (name, kind), value in zip(DESCRIPTOR_FIELDS, fields[2:]) if value)
+    except (KeyError, ValueError):
+        return None
+    return capabilities, static
+
+class EndpointSpec(object):
+    """How to build the Alexa endpoint of one class of Domoticz devices."""
+
+    def __init__(self, adapter, idPrefix, categories, capabilities):
+        self.adapter = adapter
+        self.idPrefix = idPrefix
+        self.categories = categories
+        self.capabilities = capabilities
+
+    def createEndpoint(self, idx, friendlyName, description, manufacturerName):
+        endpoint = ENDPOINT_ADAPTERS[self.adapter](self.idPrefix+"-"+idx, friendlyName, description, manufacturerName)
+        for category in self.categories:
+            endpoint.addDisplayCategories(category)
+        for interface in self.capabilities:
+            endpoint.addCapability(createCapability(interface))
+        return endpoint
+
+class DeviceRule(object):
+    """One row of the device classification table.
+
+    A rule applies to the devices of its family whose SwitchType starts with
+    one of switchTypes (any SwitchType if None). dimmer capabilities are added
+    when the device has a dimmer, rgb capabilities/categories when its SubType
+    starts with RGB, white capabilities (and rgb categories) when it is a
+    white temperature only one (WW).
+    """
+
+    def __init__(self, family, adapter, categories, switchTypes=None, requiresExtra=False,
+                 idPrefix=None, dimmer=(), rgb=(), rgbCategories=(), white=()):
+        self.family = family
+        self.adapter = adapter
+        self.idPrefix = idPrefix or adapter
+        self.categories = categories
+        self.switchTypes = switchTypes
+        self.requiresExtra = requiresExtra
+        self.dimmer = dimmer
+        self.rgb = rgb
+        self.rgbCategories = rgbCategories
+        self.white = white
+
+    def matches(self, switchType, hasExtra):
+        if self.requiresExtra and not hasExtra:
+            return False
+        return self.switchTypes is None or (switchType or '').startswith(self.switchTypes)
+
+    def compile(self, hasDimmer, isRGB, isWhite=False):
+        categories = self.categories + (self.rgbCategories if isRGB or isWhite else ())
+        capabilities = (self.dimmer if hasDimmer else ()) + (self.rgb if isRGB else self.white if isWhite else ())
+        return EndpointSpec(self.adapter, self.idPrefix, categories, capabilities)
+
+DIMMER_CAPABILITIES = ('Alexa.PercentageController', 'Alexa.BrightnessController')
+COLOR_CAPABILITIES = ('Alexa.ColorController', 'Alexa.ColorTemperatureController')
+WHITE_CAPABILITIES = ('Alexa.ColorTemperatureController',)
+
+# Domoticz device Type prefix -> rule family
+DEVICE_FAMILIES = (
+    ('Lighting', 'Light'),
+    ('Color Switch', 'Light'),
+    ('Light/Switch', 'Switch'),
+    ('Blind', 'Blind'),
+    ('RFY', 'RFY'),
+    ('Lock', 'Lock'),
+    ('Contact', 'Contact'),
+    ('Temp', 'Temp'),
+    ('Therm', 'Therm'),
+)
+
+# Domoticz scene Type prefix -> rule family
+SCENE_FAMILIES = (
+    ('Scene', 'Scene'),
+    ('Group', 'Group'),
+)
+
+# First matching rule of the device family wins
+DEVICE_RULES = (
+    DeviceRule('Light', 'SwitchLight', ('SWITCH',), switchTypes=('On/Off',), dimmer=DIMMER_CAPABILITIES),
+    DeviceRule('Light', 'SwitchLight', ('LIGHT',), dimmer=DIMMER_CAPABILITIES, rgb=COLOR_CAPABILITIES,
+               white=WHITE_CAPABILITIES),
+    # Special case to implement a "virtual thermostat"
+    # extra must contain { "OFF": 0, CONFORT": idx, "ECONOMIE"; idx...}
+    DeviceRule('Switch', 'Thermostat', ('THERMOSTAT',), switchTypes=('Selector',), requiresExtra=True, idPrefix='SelectorThermostat'),
+    DeviceRule('Switch', 'Lock', ('SWITCH',), switchTypes=('Door',)),
+    DeviceRule('Switch', 'Contact', ('CONTACT_SENSOR',), switchTypes=('Contact', 'Motion Sensor')),
+    DeviceRule('Switch', 'SwitchLight', ('SWITCH',), dimmer=DIMMER_CAPABILITIES, rgb=COLOR_CAPABILITIES,
+               white=WHITE_CAPABILITIES, rgbCategories=('LIGHT',)),
+    DeviceRule('Blind', 'Blind', ('SWITCH',), dimmer=('Alexa.PercentageController',)),
+    DeviceRule('RFY', 'RFY', ('SWITCH',), dimmer=('Alexa.PercentageController',)),
+    DeviceRule('Lock', 'Lock', ('SWITCH',)),
+    DeviceRule('Contact', 'Contact', ('CONTACT_SENSOR',)),
+    DeviceRule('Temp', 'TemperatureSensor', ('TEMPERATURE_SENSOR',)),
+    DeviceRule('Therm', 'Thermostat', ('THERMOSTAT', 'TEMPERATURE_SENSOR')),
+    DeviceRule('Scene', 'Scene', ('SCENE_TRIGGER',)),
+    DeviceRule('Group', 'Group', ('SCENE_TRIGGER',)),
+)
+
+def _indexRules(rules):
+    """Build the dispatch index of the rule table.
+
+    Returns rules by family and, per endpointId prefix, the capabilities an
+    endpoint may have been discovered with (used to rebuild it at directive time).
+    """
+    familyRules = {}
+    adapterCapabilities = {}
+    for rule in rules:
+        familyRules.setdefault(rule.family, []).append(rule)
+        capabilities = adapterCapabilities.setdefault(rule.idPrefix, [])
+        capabilities.extend(i for i in rule.dimmer + rule.rgb + rule.white if i not in capabilities)
+    return familyRules, adapterCapabilities
+
+FAMILY_RULES, ADAPTER_CAPABILITIES = _indexRules(DEVICE_RULES)
+
+TYPE_FAMILIES = {'device': DEVICE_FAMILIES, 'scene': SCENE_FAMILIES}
+
+# (kind, Type, SwitchType, SubType, HaveDimmer, has extra) -> EndpointSpec or None
+_CLASSIFICATIONS = {}
+
+def _classify(kind, devType, switchType, subType, hasDimmer, hasExtra):
+    family = next((f for prefix, f in TYPE_FAMILIES[kind] if devType.startswith(prefix)), None)
+    for rule in FAMILY_RULES.get(family, ()):
+        if rule.matches(switchType, hasExtra):
+            isRGB = (subType or '').startswith('RGB')
+            return rule.compile(bool(hasDimmer), isRGB, not isRGB and subType in WHITE_TEMPERATURE_SUBTYPES)
+    return None
+
+def classifyDevice(device, hasExtra=False, kind='device'):
+    """Return the EndpointSpec of a Domoticz device, None if it is not exposed."""
+    key = (kind, device['Type'], device.get('SwitchType'), device.get('SubType'), device.get('HaveDimmer'), hasExtra)
+    try:
+        return _CLASSIFICATIONS[key]
+    except KeyError:
+        spec = _CLASSIFICATIONS[key] = _classify(*key)
+        return spec
+
+def classifyScene(scene):
+    """Return the EndpointSpec of a Domoticz scene or group, None if it is not exposed."""
+    return classifyDevice(scene, kind='scene')
+
+def timeLeft(deadline, default=None):
+    """Seconds left before deadline (time.monotonic()), default without deadline.
+    socket.timeout is raised once the deadline passed."""
+    if deadline is None:
+        return default
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise socket.timeout('Domoticz call deadline exceeded')
+    return left
+
+class _ResponseBody(object):
+    """Body of an HTTP response, each read given the time left before deadline."""
+    __slots__ = ('response', 'sock', 'deadline')
+
+    def __init__(self, response, sock, deadline):
+        self.response = response
+        self.sock = sock
+        self.deadline = deadline
+
+    def read(self, size=-1):
+        """Read up to size bytes (one socket read at most), the whole body if size is -1."""
+        if size >= 0:
+            if self.deadline is not None:
+                self.sock.settimeout(timeLeft(self.deadline))
+            return self.response.read1(size)
+        chunks = []
+        while True:
+            chunk = self.read(LISTING_CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        data = b''.join(chunks)
+        if self.response.length:
+            # The server closed the connection before the end of the body
+            raise http.client.IncompleteRead(data, self.response.length)
+        # Done with the response (read() does it), the connection can send the next request
+        self.response.close()
+        return data
+
+def serverAddress(url):
+    """(host, port, base path, ssl context) of a Domoticz server url, no context for http."""
+    parts = urlsplit(url)
+    context = None
+    if parts.scheme == 'https':
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return parts.hostname, parts.port, parts.path or '/', context
+
+class DomoticzSession(object):
+    """Bounded pool of persistent HTTP/1.1 (keep-alive) connections to a Domoticz server.
+
+    Connections are reused across calls (and across warm lambda invocations as long
+    as the session lives), a connection found stale when reused is reopened once.
+    """
+
+    # Errors raised by http.client when the server closed an idle keep-alive socket
+    STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                    BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+    def __init__(self, url, headers=None, maxConnections=4, timeout=None):
+        self.url = url
+        self.host, self.port, self.basePath, self.context = serverAddress(url)
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.maxConnections = maxConnections
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxConnections)
+
+    def _connect(self):
+        if self.context is not None:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self.context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _request(self, conn, path, deadline, parse):
+        # Connecting and sending get the time left, the response gets it again
+        # before each read (a server trickling its answer can't stretch the call)
+        timeout = timeLeft(deadline, self.timeout)
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        conn.request('GET', self.basePath + path, headers=self.headers)
+        sock = conn.sock
+        sock.settimeout(timeLeft(deadline, self.timeout))
+        response = conn.getresponse()
+        body = _ResponseBody(response, sock, deadline)
+        if response.status >= 400:
+            body.read()
+            conn.close()
+            raise HTTPError(self.url + path, response.status, response.reason, response.headers, None)
+        if parse is None:
+            payload = body.read()
+        else:
+            payload = parse(body)
+            # Whatever follows the JSON value, the connection is reused
+            body.read()
+        if response.will_close:
+            conn.close()
+        return payload
+
+    def get(self, path, timeout=None, parse=None):
+        """GET path (relative to the server url) and return the response body,
+        or what parse(stream) returns (it reads the body as a stream).
+
+        timeout (seconds, the session one by default) bounds the whole call:
+        the wait for a connection, connecting, sending, each read of the
+        response and the retry on a stale connection. socket.timeout is
+        raised once it is over.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        if not self._slots.acquire(timeout=timeout):
+            raise socket.timeout('No Domoticz connection available')
+        try:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect()
+            try:
+                try:
+                    payload = self._request(conn, path, deadline, parse)
+                except self.STALE_ERRORS:
+                    conn.close()
+                    if not reused:
+                        raise
+                    _LOGGER.debug("Domoticz stale connection, reconnecting")
+                    conn = self._connect()
+                    payload = self._request(conn, path, deadline, parse)
+            except Exception:
+                conn.close()
+                raise
+            if conn.sock is not None:
+                with self._lock:
+                    self._idle.append(conn)
+            return payload
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+class DeviceCache(object):
+    """In-memory snapshot of Domoticz devices, indexed by idx.
+
+    A device is served from memory for ttl seconds after it was last fetched.
+    Device listings (type=devices queries) remember the Domoticz ActTime they
+    were taken at, so a stale listing is brought up to date with a
+    lastupdate=<ActTime> delta query instead of being downloaded again.
+    Deltas can't tell a device was deleted (or is no longer used): a listing
+    is downloaded again in full every fullRefresh seconds, the devices it
+    lost are forgotten. A ttl of 0 disables the cache.
+    """
+
+    def __init__(self, ttl=0, fullRefresh=300):
+        self.ttl = ttl
+        self.fullRefresh = fullRefresh
+        self._devices = {}
+        self._stamps = {}
+        self._seen = {}
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def get(self, idx):
+        """Return the device if its snapshot is still fresh, None otherwise."""
+        stamp = self._stamps.get(idx)
+        if stamp is None or time.monotonic() - stamp >= self.ttl:
+            return None
+        return self._devices.get(idx)
+
+    def put(self, idx, device):
+        now = time.monotonic()
+        with self._lock:
+            self._devices[idx] = device
+            self._stamps[idx] = now
+            self._seen[idx] = now
+
+    def lastKnown(self, idx):
+        """Return (device, age in seconds) of the last snapshot of idx, fresh or not, or None."""
+        seen = self._seen.get(idx)
+        if seen is None:
+            return None
+        return self._devices[idx], time.monotonic() - seen
+
+    def listing(self, query):
+        """Return [actTime, refreshedAt, idxs, fullAt] for a known listing, or None."""
+        return self._listings.get(query)
+
+    def listingOf(self, idx):
+        """Return the query of a listing idx belongs to, or None."""
+        for query, listing in self._listings.items():
+            if idx in listing[2]:
+                return query
+        return None
+
+    def isFresh(self, listing):
+        return time.monotonic() - listing[1] < self.ttl
+
+    def needsFullRefresh(self, listing):
+        return time.monotonic() - listing[3] >= self.fullRefresh
+
+    def storeListing(self, query, response, delta=False):
+        now = time.monotonic()
+        with self._lock:
+            previous = self._listings.get(query)
+            listing = previous if delta else None
+            if listing is None:
+                listing = self._listings[query] = [None, now, {}, now]
+            listing[0] = response.get('ActTime')
+            listing[1] = now
+            idxs = listing[2]
+            for device in response.get('result', ()):
+                idx = device['idx']
+                self._devices[idx] = device
+                idxs[idx] = True
+            for idx in idxs:
+                self._stamps[idx] = now
+                self._seen[idx] = now
+            if previous is not None and listing is not previous:
+                self._forget(idx for idx in previous[2] if idx not in idxs)
+
+    def _forget(self, idxs):
+        # Called with the lock held: devices gone from a listing, unless another one has them
+        for idx in idxs:
+            if not any(idx in listing[2] for listing in self._listings.values()):
+                self._devices.pop(idx, None)
+                self._stamps.pop(idx, None)
+                self._seen.pop(idx, None)
+
+    def devicesOf(self, query):
+        return [self._devices[idx] for idx in self._listings[query][2]]
+
+    def invalidate(self, idx=None):
+        """Forget freshness of one device (or all), the snapshot is kept for deltas."""
+        with self._lock:
+            if idx is None:
+                self._stamps.clear()
+                for listing in self._listings.values():
+                    listing[1] = 0
+            else:
+                self._stamps.pop(idx, None)
+
+class OptimisticState(object):
+    """Device states assumed after the commands sent to Domoticz, by idx.
+
+    A successful command applies its fields (Level, Status, SetPoint) to the
+    last known device, the result is served instead of reading the device for
+    window seconds: a relative adjustment and the ReportState following a
+    command need no read. A window of 0 disables it.
+
+    The time of the last command sent to each device is logged whatever the
+    window, see lastCommand().
+    """
+
+    def __init__(self, window=0):
+        self.window = window
+        self._known = {}
+        self._states = {}
+        self._commands = {}
+        self._lock = threading.Lock()
+
+    def commanded(self, idx=None):
+        """Log a command sent to device idx (None: to devices we can't tell, a scene)."""
+        self._commands[idx] = time.monotonic()
+
+    def lastCommand(self, idx):
+        """Monotonic time of the last command that may have changed device idx, None if none."""
+        stamps = [stamp for stamp in (self._commands.get(idx), self._commands.get(None)) if stamp is not None]
+        return max(stamps) if stamps else None
+
+    def get(self, idx):
+        """Return the assumed device if assumed less than window seconds ago, None otherwise."""
+        state = self._states.get(idx)
+        if state is None or time.monotonic() - state[1] >= self.window:
+            return None
+        return state[0]
+
+    def observe(self, idx, device):
+        """Remember a device read from Domoticz, commands are applied to it."""
+        if self.window > 0:
+            with self._lock:
+                self._known[idx] = device
+                self._states.pop(idx, None)
+
+    def update(self, idx, fields):
+        if self.window <= 0:
+            return
+        with self._lock:
+            device = self.get(idx) or self._known.get(idx)
+            if device is None:
+                return
+            device = dict(device)
+            device.update(fields)
+            self._states[idx] = (device, time.monotonic())
+
+    def invalidate(self, idx=None):
+        """Forget the assumed states of one device (or all)."""
+        with self._lock:
+            if idx is None:
+                self._states.clear()
+            else:
+                self._states.pop(idx, None)
+
+# Domoticz calls not answered: past the deadline, or not tried (breaker open)
+UNAVAILABLE_ERRORS = (DeadlineExceeded, BridgeUnreachable)
+
+def isBridgeFailure(error):
+    """Whether error tells Domoticz could not be reached (an HTTP error status is an answer).
+
+    Timeouts are not judged here, see CircuitBreaker.timedOut().
+    """
+    # HTTPError is an OSError
+    return isinstance(error, (OSError, http.client.HTTPException)) and not isinstance(error, HTTPError)
+
+class CircuitBreaker(object):
+    """Fails Domoticz calls fast while Domoticz is down.
+
+    The breaker opens after failures consecutive calls could not reach
+    Domoticz: calls are then refused (BridgeUnreachable) for resetTimeout
+    seconds. After that a single probe call is let through (half-open), its
+    success closes the breaker, its failure opens it again. A failures of 0
+    disables it. A call timing out only counts as a failure when it had at
+    least callTimeout seconds: a slow Domoticz or a spent directive budget
+    does not open the breaker.
+    """
+
+    def __init__(self, failures=5, resetTimeout=30.0, callTimeout=5.0):
+        self.failures = failures
+        self.resetTimeout = resetTimeout
+        self.callTimeout = callTimeout
+        self._count = 0
+        self._openedAt = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def isOpen(self):
+        return self._openedAt is not None
+
+    def allow(self):
+        """Whether a call may be tried, the caller must then record() its outcome."""
+        if self._openedAt is None:
+            return True
+        with self._lock:
+            if self._openedAt is None:
+                return True
+            if self._probing or time.monotonic() - self._openedAt < self.resetTimeout:
+                return False
+            self._probing = True
+            _LOGGER.info("Domoticz circuit breaker half-open, probing")
+            return True
+
+    def record(self, success):
+        """Record a call outcome: success, failure, or None (interrupted, no verdict)."""
+        if self.failures <= 0:
+            return
+        with self._lock:
+            if success:
+                if self._openedAt is not None:
+                    _LOGGER.warning("Domoticz circuit breaker closed")
+                self._count = 0
+                self._openedAt = None
+            elif success is not None:
+                self._count += 1
+                if self._probing or (self._openedAt is None and self._count >= self.failures):
+                    _LOGGER.warning("Domoticz circuit breaker open (%d failures)", self._count)
+                    self._openedAt = time.monotonic()
+            self._probing = False
+
+    def timedOut(self, timeout):
+        """Record a call that timed out after timeout seconds (None: no deadline)."""
+        self.record(None if timeout is not None and timeout < self.callTimeout else False)
+
+class AsyncDomoticzSession(object):
+    """Bounded pool of persistent HTTP/1.1 connections to a Domoticz server on
+    asyncio streams (a minimal client), the asyncio counterpart of DomoticzSession.
+
+    The connections and the pool belong to the event loop the session is
+    first used in.
+    """
+
+    # asyncio.IncompleteReadError is an EOFError
+    STALE_ERRORS = (ConnectionError, EOFError)
+
+    def __init__(self, url, headers=None, maxConnections=4, timeout=None):
+        self.url = url
+        self.host, self.port, self.basePath, self.context = serverAddress(url)
+        self.timeout = timeout
+        self.maxConnections = maxConnections
+        self._requestHead = ''.join('%s: %s\r\n' % (k, v.decode('latin-1') if isinstance(v, bytes) else v)
+                                    for k, v in (headers or {}).items())
+        self._idle = []
+        # Created on first use, inside the event loop
+        self._slots = None
+
+    async def _connect(self):
+        import asyncio
+        port = self.port or (443 if self.context is not None else 80)
+        return await asyncio.open_connection(self.host, port, ssl=self.context)
+
+    async def _request(self, conn, path):
+        reader, writer = conn
+        writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\n%s\r\n' %
+                      (self.basePath + path, self.host, self._requestHead)).encode('latin-1'))
+        await writer.drain()
+        statusLine = await reader.readline()
+        if not statusLine:
+            raise ConnectionResetError('Domoticz closed the connection')
+        version, status, reason = (statusLine.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        keepAlive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            payload = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                payload += await reader.readexactly(size)
+                await reader.readexactly(2)
+            payload = bytes(payload)
+        elif 'content-length' in headers:
+            payload = await reader.readexactly(int(headers['content-length']))
+        else:
+            payload = await reader.read()
+            keepAlive = False
+        if int(status) >= 400:
+            raise HTTPError(self.url + path, int(status), reason, headers, None)
+        return payload, keepAlive
+
+    async def get(self, path, timeout=None):
+        """GET path (relative to the server url) and return the response body.
+
+        timeout (seconds, the session one by default) bounds the whole call,
+        socket.timeout is raised, as by DomoticzSession.get().
+        """
+        import asyncio
+        try:
+            return await asyncio.wait_for(self._get(path), timeout if timeout is not None else self.timeout)
+        except asyncio.TimeoutError as e:
+            raise socket.timeout('Domoticz call timed out') from e
+
+    async def _get(self, path):
+        import asyncio
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.maxConnections)
+        async with self._slots:
+            conn = self._idle.pop() if self._idle else None
+            reused = conn is not None
+            if conn is None:
+                conn = await self._connect()
+            try:
+                try:
+                    payload, keepAlive = await self._request(conn, path)
+                except self.STALE_ERRORS:
+                    conn[1].close()
+                    if not reused:
+                        raise
+                    _LOGGER.debug("Domoticz stale connection, reconnecting")
+                    conn = await self._connect()
+                    payload, keepAlive = await self._request(conn, path)
+            except BaseException:
+                conn[1].close()
+                raise
+            if keepAlive:
+                self._idle.append(conn)
+            else:
+                conn[1].close()
+            return payload
+
+    def close(self):
+        idle, self._idle = self._idle, []
+        for reader, writer in idle:
+            writer.close()
+
+DEVICES_QUERY = 'type=devices&used=true'
+SCENES_QUERY = 'type=scenes'
+DEVICE_QUERY = 'type=devices&rid=%s'
+
+# Commands, by idx and value(s)
+SET_TEMP_QUERY = 'type=command&param=udevice&idx=%s&nvalue=0&svalue=%s'
+SET_LEVEL_QUERY = 'type=command&param=switchlight&idx=%s&switchcmd=Set%%20Level&level=%s'
+SET_COLOR_QUERY = 'type=command&param=setcolbrightnessvalue&idx=%s&hex=%0.2X%0.2X%0.2X&brightness=%s&iswhite=false'
+SET_KELVIN_QUERY = 'type=command&param=setkelvinlevel&idx=%s&kelvin=%s'
+SWITCH_QUERY = 'type=command&param=switchlight&idx=%s&switchcmd=%s'
+SCENE_SWITCH_QUERY = 'type=command&param=switchscene&idx=%s&switchcmd=%s'
+
+def levelOfName(device, levelName):
+    """The selector level of levelName (one of the device LevelNames)."""
+    levels = device['LevelNames'].upper().split("|")
+    return levels.index(levelName.upper()) * int(device['LevelInt'])
 
 class Domoticz(object):
 
+    # The methods reading or commanding devices are blocking (AsyncDomoticz: coroutines)
+    isAsync = False
+
     def __init__(self,url,username=None,password=None):
         self.url = os.path.join(url, '')
 
-        if url.startswith("https"):
-            context = ssl.create_default_context()
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE
-            httpsHandler = urllib.request.HTTPSHandler(context = context)
-            opener = urllib.request.build_opener(httpsHandler)
-            urllib.request.install_opener(opener)
-
         self.authorization = None
         if username is not None:
             credentials = '%s:%s' % (username, password)
             encoded_credentials = base64.b64encode(credentials.encode())
             self.authorization = b'Basic ' + encoded_credentials
 
+        headers = { 'Content-Type': 'application/json' }
+        if self.authorization is not None:
+            headers['Authorization'] = self.authorization
+        self.session = DomoticzSession(self.url, headers)
+        self.deviceCache = DeviceCache()
+        self.optimistic = OptimisticState()
+        self.breaker = CircuitBreaker()
+        self._discovery = None
+
         self.planID = -1
         self.includeScenesGroups = False
         self.prefixName = None
+        self.directiveTimeout = DIRECTIVE_TIMEOUT
+        self.streamDevices = False
         self.config = None
 
     def configure(self, config):
         self.includeScenesGroups = config.includeScenesGroups
         self.planID = config.planID
         self.prefixName = config.prefixName
+        self.deviceCache.ttl = config.deviceCacheTTL
+        self.deviceCache.fullRefresh = config.deviceCacheFullRefresh
+        self.optimistic.window = config.optimisticWindow
+        self.directiveTimeout = config.directiveTimeout
+        self.streamDevices = config.streamDevices
+        self.breaker.failures = config.breakerFailures
+        self.breaker.resetTimeout = config.breakerResetTimeout
+        self.breaker.callTimeout = config.breakerCallTimeout
         self.config = config
 
-    def api(self, query):
-        url = self.url + "json.htm?" + query
-        print("Domoticz API call %s", url)
-        _LOGGER.debug("Domoticz API call %s", url)
-        headers = { 'Content-Type': 'application/json' }
-        if self.authorization is not None:
-            headers['Authorization'] = self.authorization
-        payload = urlopen(Request(url, None, headers)).read()
-        return json.loads(payload.decode('utf-8'))
+    def close(self):
+        self.session.close()
+
+    def getEndpoint(self, request, allowStale=False, handler=None):
+        """The endpoint of a directive, allowStale: see DeviceContext.
 
-    def getEndpoint(self, request):
+        The endpoint descriptor cookie gives its exact capabilities and static
+        device fields, without it the endpoint gets every capability of its class.
+        handler (this client by default) is the one the endpoint calls.
+        """
         endpointId = request['endpoint']['endpointId']
         items = endpointId.split("-")
         className = items[0]
         id = items[1]
         endpoint = ENDPOINT_ADAPTERS[className](id)
-        if className == 'SwitchLight':
-            endpoint.addCapability(AlexaPercentageController(endpoint, 'Alexa.PercentageController',[{'name': 'percentage'}]))
-            endpoint.addCapability(AlexaBrightnessController(endpoint, 'Alexa.BrightnessController',[{'name': 'brightness'}]))
-            endpoint.addCapability(AlexaColorController(endpoint, 'Alexa.ColorController'))
-            endpoint.addCapability(AlexaColorTemperatureController(endpoint, 'Alexa.ColorTemperatureController'))
-        elif className == 'Blind' or className == 'RFY':
-            endpoint.addCapability(AlexaPercentageController(endpoint, 'Alexa.PercentageController',[{'name': 'percentage'}]))
         cookies = request['endpoint']['cookie']
+        descriptor = parseEndpointDescriptor(cookies.get(DESCRIPTOR_COOKIE)) if cookies else None
+        if descriptor is not None:
+            capabilities, static = descriptor
+        else:
+            capabilities, static = ADAPTER_CAPABILITIES.get(className, ()), None
+        for interface in capabilities:
+            endpoint.addCapability(createCapability(interface))
         if cookies is not None:
             endpoint.addCookie(cookies)
-        endpoint.setHandler(self)
+        handler = handler or self
+        endpoint.setHandler(handler, DeviceContext(handler, allowStale=allowStale,
+                                                   static={id: static} if static else None))
         return endpoint
 
-    def getEndpoints(self):
-        endpoints = []
+    def getPlanIDs(self):
+        """Configured room plans (planID is one id or a list of ids), () for all plans."""
+        planIDs = self.planID if isinstance(self.planID, (list, tuple)) else [self.planID]
+        return tuple(int(planID) for planID in planIDs if planID is not None and int(planID) >= 0)
+
+    def getEndpoints(self, devices=None, scenes=None):
+        """Yield the Alexa endpoints of the Domoticz devices (and scenes)."""
 
         # Devices
-        response = self.api('type=devices&used=true')
-        devices= response['result']
+        if devices is None:
+            devices, scenes = self.getDiscoveryItems()
         for device in devices:
             endpoint = None
 
-            if (device['PlanID'] == "0" or device['PlanID'] == ""): continue
-            if (self.planID >= 0 and (not (self.planID in device['PlanIDs']))): continue
-
             devType = device['Type']
 
             friendlyName = device['Name']
@@ -290,103 +1101,30 @@ class Domoticz(object):
             manufacturerName = device['HardwareName']
             description = devType
 
-            matchObj = re.match( r'.*Alexa_Name:\s*([^\n]*)', device['Description'], re.M|re.I|re.DOTALL)
-            if matchObj:  friendlyName = matchObj.group(1)
-            matchObj = re.match( r'.*Alexa_Description:\s*([^\n]*)', device['Description'], re.M|re.I|re.DOTALL)
-            if matchObj:  description = matchObj.group(1)
-            extra = None
-            matchObj = re.match( r'.*Alexa_extra:\s*([^\n]*)', device['Description'], re.M|re.I|re.DOTALL)
-            if matchObj:  extra = matchObj.group(1)
+            metadata = parseAlexaMetadata(device['Description'])
+            if metadata.name is not None:  friendlyName = metadata.name
+            if metadata.description is not None:  description = metadata.description
+            extra = metadata.extra
 
             if self.prefixName is not None:
                 #friendlyName = self.prefixName + friendlyName
                 description = self.prefixName + description
 
-            if (devType.startswith('Lighting') or devType.startswith('Color Switch')):
-                switchType = device['SwitchType']
-                if switchType == 'On/Off':
-                    # Usual switch case
-                    endpoint = SwitchLightAlexaEndpoint("SwitchLight-"+endpointId, friendlyName, description, manufacturerName)
-                    endpoint.addDisplayCategories("SWITCH")
-                    hasDimmer = deviceHasDimmer(device)
-                    if (hasDimmer):
-                        endpoint.addCapability(AlexaPercentageController(self, 'Alexa.PercentageController',[{'name': 'percentage'}]))
-                        endpoint.addCapability(AlexaBrightnessController(self, 'Alexa.BrightnessController',[{'name': 'brightness'}]))
-                else:
-                    # Usual switch case
-                    endpoint = SwitchLightAlexaEndpoint("SwitchLight-"+endpointId, friendlyName, description, manufacturerName)
-                    endpoint.addDisplayCategories("LIGHT")
-                    hasDimmer = deviceHasDimmer(device)
-                    if (hasDimmer):
-                        endpoint.addCapability(AlexaPercentageController(self, 'Alexa.PercentageController',[{'name': 'percentage'}]))
-                        endpoint.addCapability(AlexaBrightnessController(self, 'Alexa.BrightnessController',[{'name': 'brightness'}]))              
-                    subType = device['SubType']
-                    if (subType.startswith("RGB")):
-                        endpoint.addCapability(AlexaColorController(self, 'Alexa.ColorController'))              
-                        endpoint.addCapability(AlexaColorTemperatureController(self, 'Alexa.ColorTemperatureController'))
-
-            elif (devType.startswith('Light/Switch')):
-                switchType = device['SwitchType']
-                # Special case to implement a "virtual thermostat"
-                if switchType == 'Selector' and (extra is not None):
-                    # extra must contain { "OFF": 0, CONFORT": idx, "ECONOMIE"; idx...}
-                    endpoint = ThermostatAlexaEndpoint("SelectorThermostat-"+endpointId, friendlyName, description, manufacturerName)
-                    endpoint.addDisplayCategories("THERMOSTAT")
-                elif (switchType.startswith('Door')):
-                    endpoint = LockAlexaEndpoint("Lock-"+endpointId, friendlyName, description, manufacturerName)
-                    endpoint.addDisplayCategories("SWITCH")
-                elif (switchType.startswith('Contact') or switchType.startswith('Motion Sensor')):
-                    endpoint = ContactAlexaEndpoint("Contact-"+endpointId, friendlyName, description, manufacturerName)
-                    endpoint.addDisplayCategories("CONTACT_SENSOR")
-                else:
-                    # Usual switch case
-                    endpoint = SwitchLightAlexaEndpoint("SwitchLight-"+endpointId, friendlyName, description, manufacturerName)
-                    endpoint.addDisplayCategories("SWITCH")
-                    hasDimmer = deviceHasDimmer(device)
-                    if (hasDimmer):
-                        endpoint.addCapability(AlexaPercentageController(self, 'Alexa.PercentageController',[{'name': 'percentage'}]))
-                        endpoint.addCapability(AlexaBrightnessController(self, 'Alexa.BrightnessController',[{'name': 'brightness'}]))              
-                    subType = device['SubType']
-                    if (subType.startswith("RGB")):
-                        endpoint.addDisplayCategories("LIGHT")
-                        endpoint.addCapability(AlexaColorController(self, 'Alexa.ColorController'))              
-                        endpoint.addCapability(AlexaColorTemperatureController(self, 'Alexa.ColorTemperatureController')) 						
-
-            elif (devType.startswith('Blind') or devType.startswith('RFY')):
-                if   devType.startswith('Blind'): endpoint = BlindAlexaEndpoint("Blind-"+endpointId, friendlyName, description, manufacturerName)
-                elif devType.startswith('RFY'):   endpoint = RFYAlexaEndpoint("RFY-"+endpointId, friendlyName, description, manufacturerName)
-                endpoint.addDisplayCategories("SWITCH")
-                hasDimmer = deviceHasDimmer(device)
-                if (hasDimmer):
-                    endpoint.addCapability(AlexaPercentageController(self, 'Alexa.PercentageController',[{'name': 'percentage'}]))
-
-            elif (devType.startswith('Lock')):
-                endpoint = LockAlexaEndpoint("Lock-"+endpointId, friendlyName, description, manufacturerName)
-                endpoint.addDisplayCategories("SWITCH")
-
-            elif (devType.startswith('Contact')):
-                endpoint = ContactAlexaEndpoint("Contact-"+endpointId, friendlyName, description, manufacturerName)
-                endpoint.addDisplayCategories("CONTACT_SENSOR")
-
-            elif (devType.startswith('Temp')):
-                endpoint = TemperatureSensorAlexaEndpoint("TemperatureSensor-"+endpointId, friendlyName, description, manufacturerName)
-                endpoint.addDisplayCategories("TEMPERATURE_SENSOR")
-
-            elif (devType.startswith('Therm')):
-                endpoint = ThermostatAlexaEndpoint("Thermostat-"+endpointId, friendlyName, description, manufacturerName)
-                endpoint.addDisplayCategories("THERMOSTAT")
-                endpoint.addDisplayCategories("TEMPERATURE_SENSOR")
+            spec = classifyDevice(device, extra is not None)
+            if spec is not None:
+                endpoint = spec.createEndpoint(endpointId, friendlyName, description, manufacturerName)
 
             if (endpoint is not None):
+                # Most devices have the same descriptor: their endpoints share its cookies
+                endpoint.shareCookies(descriptorCookies(endpointDescriptor(spec, device),
+                    device.get('SubType') in WHITE_TEMPERATURE_SUBTYPES and isinstance(endpoint, SwitchLightAlexaEndpoint)))
                 if extra is not None:
                     endpoint.addCookie({ "extra": extra} )
                 #print(endpoint.displayCategories())
-                endpoints.append(endpoint)
+                yield endpoint
 
         # Scenes/Groups
         if self.includeScenesGroups:
-            response = self.api('type=scenes')
-            scenes= response['result']
             for scene in scenes:
                 endpoint = None
 
@@ -396,75 +1134,606 @@ class Domoticz(object):
                 manufacturerName = SKILL_NAME
                 description = sceneType
 
-                matchObj = re.match( r'.*Alexa_Name:\s*([^\n]*)', scene['Description'], re.M|re.I|re.DOTALL)
-                if matchObj:  friendlyName = matchObj.group(1)
-                matchObj = re.match( r'.*Alexa_Description:\s*([^\n]*)', scene['Description'], re.M|re.I|re.DOTALL)
-                if matchObj:  description = matchObj.group(1)
-                extra = None
-                matchObj = re.match( r'.*Alexa_extra:\s*([^\n]*)', scene['Description'], re.M|re.I|re.DOTALL)
-                if matchObj:  extra = matchObj.group(1)
+                metadata = parseAlexaMetadata(scene['Description'])
+                if metadata.name is not None:  friendlyName = metadata.name
+                if metadata.description is not None:  description = metadata.description
+                extra = metadata.extra
 
                 if self.prefixName is not None:
                     friendlyName = self.prefixName + friendlyName
 
-                if (sceneType.startswith('Scene') or sceneType.startswith('Group')):
-                    if sceneType.startswith('Scene')  : 
-                        endpoint = SceneAlexaEndpoint('Scene-'+endpointId, friendlyName, description, manufacturerName)
-                        endpoint.addDisplayCategories("SCENE_TRIGGER")
-                    elif sceneType.startswith('Group'): 
-                        endpoint = GroupAlexaEndpoint('Group-'+endpointId, friendlyName, description, manufacturerName)
-                        endpoint.addDisplayCategories("SCENE_TRIGGER")
+                spec = classifyScene(scene)
+                if spec is not None:
+                    endpoint = spec.createEndpoint(endpointId, friendlyName, description, manufacturerName)
 
                 if (endpoint is not None):
                     if extra is not None:
                         endpoint.addCookie({ "extra": extra} )
-                    endpoints.append(endpoint)
-
-        return endpoints
+                    yield endpoint
 
     #
     #  Domoticz API
     #
+    #  api() checks, the circuit breaker and the decoding of the responses are
+    #  shared by the blocking transport (session) and the asyncio one
+    #  (AsyncDomoticz): startCall(), callFailed(), callSucceeded()
+    #
+    def api(self, query):
+        timeout = self.startCall(query)
+        # Device listings are parsed while they are read, keeping the fields used only
+        parse = parseDeviceListing if self.streamDevices and query.startswith('type=devices') else None
+        with span('domoticz.api'):
+            try:
+                payload = self.session.get("json.htm?" + query, timeout, parse)
+            except BaseException as e:
+                self.callFailed(query, timeout, e)
+                raise
+            return self.callSucceeded(payload, parse is not None)
+
+    def startCall(self, query):
+        """Return the time (seconds, None: no deadline) the api() call of query
+        has, raise DeadlineExceeded or BridgeUnreachable if it can't be tried."""
+        _LOGGER.debug("Domoticz API call %s", self.url + "json.htm?" + query)
+        timeout = remainingTime()
+        if timeout is not None and timeout <= 0:
+            raise DeadlineExceeded(query)
+        if not self.breaker.allow():
+            mark('breaker.open')
+            raise BridgeUnreachable(query)
+        return timeout
+
+    def callFailed(self, query, timeout, error):
+        """Record the api() call of query failing with error, raise the error it
+        stands for (a timeout, Domoticz unreachable), return if error stands."""
+        if isinstance(error, socket.timeout):
+            self.breaker.timedOut(timeout)
+            if timeout is None:
+                raise BridgeUnreachable(query) from error
+            raise DeadlineExceeded(query) from error
+        if not isinstance(error, Exception):
+            # Interrupted, no verdict
+            self.breaker.record(None)
+            return
+        failure = isBridgeFailure(error)
+        self.breaker.record(not failure)
+        if failure:
+            raise BridgeUnreachable(query) from error
+
+    def callSucceeded(self, payload, parsed=False):
+        """Record an api() call Domoticz answered, return its decoded response
+        (payload is the body, or the response already parsed)."""
+        self.breaker.record(True)
+        if parsed:
+            return payload
+        return json.loads(payload.decode('utf-8'))
+
+    def apiMany(self, queries):
+        """Return the api() responses of queries, fetched in parallel."""
+        if len(queries) <= 1:
+            return [self.api(query) for query in queries]
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(len(queries), self.session.maxConnections)) as executor:
+            return list(executor.map(bindContext(self.api), queries))
+
+    #
+    #  Domoticz calls
+    #
+    #  Each call is written once, as steps: a generator yielding the api()
+    #  queries it needs (a list, fetched concurrently), sent their responses
+    #  (or thrown their error) and returning the call result. run() does the
+    #  queries with blocking calls, AsyncDomoticz.run() awaits them.
+    #
+    def run(self, steps):
+        """Run the steps of a Domoticz call, return its result."""
+        try:
+            queries = next(steps)
+            while True:
+                try:
+                    responses = self.apiMany(queries)
+                except BaseException as e:
+                    queries = steps.throw(e)
+                else:
+                    queries = steps.send(responses)
+        except StopIteration as e:
+            return e.value
+
+    def getDiscoveryEndpoints(self):
+        return self.run(self.getDiscoveryEndpointsSteps())
+
+    def getDiscoveryItems(self):
+        return self.run(self.getDiscoveryItemsSteps())
+
+    def getScenes(self):
+        return self.run(self.getScenesSteps())
+
+    def getDevices(self, query=DEVICES_QUERY):
+        return self.run(self.getDevicesSteps(query))
+
+    def getDeviceLists(self, queries, others=()):
+        return self.run(self.getDeviceListsSteps(queries, others))
+
     def getDevice(self, idx):
-        return self.api('type=devices&rid=%s'%idx)['result'][0]
+        return self.run(self.getDeviceSteps(idx))
+
+    def command(self, idx, query, **fields):
+        return self.run(self.commandSteps(idx, query, **fields))
 
     def setTemp(self, idx, value):
+        return self.run(self.setTempSteps(idx, value))
+
+    def setLevel(self, idx, level):
+        return self.run(self.setLevelSteps(idx, level))
+
+    def setLevelByName(self, idx, levelName, device=None):
+        return self.run(self.setLevelByNameSteps(idx, levelName, device))
+
+    def setColor(self, idx, rgb, brightness):
+        return self.run(self.setColorSteps(idx, rgb, brightness))
+
+    def setKelvinLevel(self, idx, kelvin):
+        return self.run(self.setKelvinLevelSteps(idx, kelvin))
+
+    def setSwitch(self, idx, value):
+        return self.run(self.setSwitchSteps(idx, value))
+
+    def setSceneSwitch(self, idx, value):
+        return self.run(self.setSceneSwitchSteps(idx, value))
+
+    def getDiscoveryEndpointsSteps(self):
+        """Return the Discover endpoints, JSON encoded (RawJSON).
+
+        Endpoints are classified and encoded one at a time, they are only
+        rebuilt when the devices/scenes fields they derive from (or the
+        configuration) changed since the previous Discover. The previous
+        endpoints are returned while Domoticz is unavailable.
+        """
+        try:
+            devices, scenes = yield from self.getDiscoveryItemsSteps()
+        except UNAVAILABLE_ERRORS as e:
+            if self._discovery is None:
+                raise
+            mark('stale.discovery')
+            _LOGGER.warning("Domoticz unavailable (%s), discovery from the last snapshot", type(e).__name__)
+            return self._discovery[1]
+        fingerprint = discoveryFingerprint(devices, scenes,
+            (self.getPlanIDs(), self.prefixName, self.includeScenesGroups))
+        discovery = self._discovery
+        if discovery is not None and discovery[0] == fingerprint:
+            return discovery[1]
+        encoded = bytearray(b'[')
+        for discovery_endpoint in iterDiscovery(self.getEndpoints(devices, scenes)):
+            if len(encoded) > 1:
+                encoded += b','
+            write_json(encoded, discovery_endpoint)
+        encoded += b']'
+        discovery = self._discovery = (fingerprint, RawJSON(encoded))
+        return discovery[1]
+
+    def getDiscoveryItemsSteps(self):
+        """Return the (devices, scenes) to be discovered.
+
+        Devices are fetched per configured plan (filtered by Domoticz) and
+        merged, scenes are fetched at the same time.
+        """
+        planIDs = self.getPlanIDs()
+        if planIDs:
+            queries = ['%s&plan=%d'%(DEVICES_QUERY,planID) for planID in planIDs]
+        else:
+            queries = [DEVICES_QUERY]
+        others = [SCENES_QUERY] if self.includeScenesGroups else []
+        lists, responses = yield from self.getDeviceListsSteps(queries, others)
+        devices = {}
+        for deviceList in lists:
+            for device in deviceList:
+                if planIDs or not (device['PlanID'] == "0" or device['PlanID'] == ""):
+                    devices.setdefault(device['idx'], device)
+        scenes = responses[0].get('result', []) if responses else []
+        return list(devices.values()), scenes
+
+    def getScenesSteps(self):
+        response, = yield [SCENES_QUERY]
+        return response.get('result', [])
+
+    def getDevicesSteps(self, query=DEVICES_QUERY):
+        lists, _ = yield from self.getDeviceListsSteps([query])
+        return lists[0]
+
+    def getDeviceListsSteps(self, queries, others=()):
+        """Return the device lists of queries and the api() responses of others.
+
+        Device lists come from the device cache when enabled (fresh, or
+        refreshed with a lastupdate delta, or periodically in full), everything that has to be fetched
+        is fetched in parallel.
+        """
+        cache = self.deviceCache
+        fetches = []
+        for query in queries:
+            listing = cache.listing(query) if cache.ttl > 0 else None
+            if cache.ttl <= 0 or listing is None or listing[0] is None or cache.needsFullRefresh(listing):
+                fetches.append((query, query, False))
+            elif not cache.isFresh(listing):
+                fetches.append((query, '%s&lastupdate=%s'%(query,listing[0]), True))
+        fetchQueries = [fetch[1] for fetch in fetches] + list(others)
+        responses = (yield fetchQueries) if fetchQueries else []
+        fetched = {}
+        for (query, _, delta), response in zip(fetches, responses):
+            if cache.ttl > 0:
+                cache.storeListing(query, response, delta)
+            else:
+                fetched[query] = response.get('result', [])
+        lists = [fetched[query] if query in fetched else cache.devicesOf(query) for query in queries]
+        return lists, responses[len(fetches):]
+
+    def getDeviceSteps(self, idx):
+        device = self.optimistic.get(idx)
+        if device is not None:
+            return device
+        cache = self.deviceCache
+        if cache.ttl > 0:
+            device = cache.get(idx)
+            if device is None:
+                query = cache.listingOf(idx)
+                if query is not None:
+                    yield from self.getDevicesSteps(query)
+                    device = cache.get(idx)
+        if device is None:
+            response, = yield [DEVICE_QUERY%idx]
+            device = response['result'][0]
+            # Kept even without cache: the last known state, see DeviceContext
+            cache.put(idx, device)
+        self.optimistic.observe(idx, device)
+        return device
+
+    def commandSteps(self, idx, query, **fields):
+        """Send the command query of device idx (None: a scene).
+
+        The device is no longer fresh, it is assumed in the state fields if
+        Domoticz accepted the command (read again without fields, if Domoticz
+        refused it, or if the command was not answered: it may have been applied).
+        """
+        response = None
+        try:
+            response, = yield [query]
+        finally:
+            self.deviceCache.invalidate(idx)
+            self.optimistic.commanded(idx)
+            if fields and response is not None and response.get('status') == 'OK':
+                self.optimistic.update(idx, fields)
+            else:
+                self.optimistic.invalidate(idx)
+        return response
+
+    def setTempSteps(self, idx, value):
         # Ignore exception ???
         try:
-            self.api('type=command&param=udevice&idx=%s&nvalue=0&svalue=%s'%(idx,value))
+            yield from self.commandSteps(idx, SET_TEMP_QUERY%(idx,value), SetPoint=value)
+        except UNAVAILABLE_ERRORS:
+            raise
         except Exception:
             pass
 
-    def setLevel(self, idx, level):
-        self.api('type=command&param=switchlight&idx=%s&switchcmd=Set%%20Level&level=%s'%(idx,level))
+    def setLevelSteps(self, idx, level):
+        yield from self.commandSteps(idx, SET_LEVEL_QUERY%(idx,level), Level=level)
 
-    def setLevelByName(self, idx, levelName):
-        device = self.getDevice(idx)
-        levels = device['LevelNames'].upper().split("|")
-        ilevel = levels.index(levelName.upper())
-        self.setLevel(idx,ilevel*int(device['LevelInt']))
+    def setLevelByNameSteps(self, idx, levelName, device=None):
+        if device is None:
+            device = yield from self.getDeviceSteps(idx)
+        yield from self.setLevelSteps(idx, levelOfName(device, levelName))
 
-    def setColor(self, idx, rgb, brightness):
+    def setColorSteps(self, idx, rgb, brightness):
         #self.api('type=command&param=setcolbrightnessvalue&idx=%s&hex=%s&brightness=%s&iswhite=false'%(idx,hue,brightness))
-        self.api('type=command&param=setcolbrightnessvalue&idx=%s&hex=%0.2X%0.2X%0.2X&brightness=%s&iswhite=false'%(idx,rgb[0],rgb[1],rgb[2],brightness))
+        yield from self.commandSteps(idx, SET_COLOR_QUERY%(idx,rgb[0],rgb[1],rgb[2],brightness), Level=brightness)
         #self.api('type=command&param=setcolbrightnessvalue&idx=%s&color={"m":3,"r":%s,"g":%s,"b":%s}&brightness=%s'%(idx,rgb[0],rgb[1],rgb[2],brightness))
 
-    def setKelvinLevel(self, idx, kelvin):
-        self.api('type=command&param=setkelvinlevel&idx=%s&kelvin=%s'%(idx,kelvin))
+    def setKelvinLevelSteps(self, idx, kelvin):
+        # The white temperature is no device field we know: the device is read again
+        yield from self.commandSteps(idx, SET_KELVIN_QUERY%(idx,kelvin))
+
+    def setSwitchSteps(self, idx, value):
+        yield from self.commandSteps(idx, SWITCH_QUERY%(idx,value), Status=value)
+
+    def setSceneSwitchSteps(self, idx, value):
+        # A scene/group switches devices we can't tell
+        yield from self.commandSteps(None, SCENE_SWITCH_QUERY%(idx,value))
+
+AlexaMetadata = namedtuple('AlexaMetadata', ['name', 'description', 'extra'])
+
+NO_ALEXA_METADATA = AlexaMetadata(None, None, None)
+
+# "Alexa_<key>: value" entries of a device/scene description, last occurrence
+# wins. A value ends with its line or where the next key starts
+ALEXA_METADATA_RE = re.compile(r'Alexa_(Name|Description|extra):\s*(.*?)'
+                               r'(?:[ \t]*(?=Alexa_(?:Name|Description|extra):)|$)', re.I | re.M)
+
+@lru_cache(maxsize=1024)
+def parseAlexaMetadata(text):
+    """Extract Alexa_Name / Alexa_Description / Alexa_extra from a description in one pass."""
+    if not text:
+        return NO_ALEXA_METADATA
+    values = {}
+    for matchObj in ALEXA_METADATA_RE.finditer(text):
+        values[matchObj.group(1).lower()] = matchObj.group(2)
+    if not values:
+        return NO_ALEXA_METADATA
+    return AlexaMetadata(values.get('name'), values.get('description'), values.get('extra'))
+
+class AsyncDomoticz(object):
+    """asyncio Domoticz client, the Domoticz methods reading or commanding
+    devices are coroutines.
+
+    The calls are the steps of the wrapped Domoticz client (domoticz), their
+    queries sent on an asyncio session: configuration, api() checks, caches,
+    assumed states and circuit breaker are the Domoticz ones.
+    """
 
-    def setSwitch(self, idx, value):
-        self.api('type=command&param=switchlight&idx=%s&switchcmd=%s'%(idx,value))
+    isAsync = True
 
-    def setSceneSwitch(self, idx, value):
-        self.api('type=command&param=switchscene&idx=%s&switchcmd=%s'%(idx,value))
+    def __init__(self, url, username=None, password=None):
+        self.domoticz = Domoticz(url, username, password)
+        self.session = AsyncDomoticzSession(self.domoticz.url, self.domoticz.session.headers)
+
+    def configure(self, config):
+        self.domoticz.configure(config)
+
+    @property
+    def directiveTimeout(self):
+        return self.domoticz.directiveTimeout
+
+    @property
+    def deviceCache(self):
+        return self.domoticz.deviceCache
+
+    @property
+    def optimistic(self):
+        return self.domoticz.optimistic
+
+    def close(self):
+        self.session.close()
+        self.domoticz.close()
+
+    def getEndpoint(self, request, allowStale=False):
+        return self.domoticz.getEndpoint(request, allowStale, handler=self)
+
+    async def api(self, query):
+        domoticz = self.domoticz
+        timeout = domoticz.startCall(query)
+        with span('domoticz.api'):
+            try:
+                payload = await self.session.get("json.htm?" + query, timeout)
+            except BaseException as e:
+                domoticz.callFailed(query, timeout, e)
+                raise
+            return domoticz.callSucceeded(payload)
+
+    async def apiMany(self, queries):
+        """Return the api() responses of queries, fetched concurrently."""
+        if len(queries) <= 1:
+            return [await self.api(query) for query in queries]
+        import asyncio
+        responses = await asyncio.gather(*(self.api(query) for query in queries), return_exceptions=True)
+        for response in responses:
+            if isinstance(response, BaseException):
+                raise response
+        return responses
+
+    async def run(self, steps):
+        """Run the steps of a Domoticz call (see Domoticz.run), return its result."""
+        try:
+            queries = next(steps)
+            while True:
+                try:
+                    responses = await self.apiMany(queries)
+                except BaseException as e:
+                    queries = steps.throw(e)
+                else:
+                    queries = steps.send(responses)
+        except StopIteration as e:
+            return e.value
+
+    async def getDiscoveryEndpoints(self):
+        return await self.run(self.domoticz.getDiscoveryEndpointsSteps())
+
+    async def getDiscoveryItems(self):
+        return await self.run(self.domoticz.getDiscoveryItemsSteps())
+
+    async def getEndpoints(self):
+        devices, scenes = await self.getDiscoveryItems()
+        return list(self.domoticz.getEndpoints(devices, scenes))
+
+    async def getScenes(self):
+        return await self.run(self.domoticz.getScenesSteps())
+
+    async def getDevices(self, query=DEVICES_QUERY):
+        return await self.run(self.domoticz.getDevicesSteps(query))
+
+    async def getDeviceLists(self, queries, others=()):
+        return await self.run(self.domoticz.getDeviceListsSteps(queries, others))
+
+    async def getDevice(self, idx):
+        return await self.run(self.domoticz.getDeviceSteps(idx))
+
+    async def command(self, idx, query, **fields):
+        return await self.run(self.domoticz.commandSteps(idx, query, **fields))
+
+    async def setTemp(self, idx, value):
+        return await self.run(self.domoticz.setTempSteps(idx, value))
+
+    async def setLevel(self, idx, level):
+        return await self.run(self.domoticz.setLevelSteps(idx, level))
+
+    async def setLevelByName(self, idx, levelName, device=None):
+        return await self.run(self.domoticz.setLevelByNameSteps(idx, levelName, device))
+
+    async def setColor(self, idx, rgb, brightness):
+        return await self.run(self.domoticz.setColorSteps(idx, rgb, brightness))
+
+    async def setKelvinLevel(self, idx, kelvin):
+        return await self.run(self.domoticz.setKelvinLevelSteps(idx, kelvin))
+
+    async def setSwitch(self, idx, value):
+        return await self.run(self.domoticz.setSwitchSteps(idx, value))
+
+    async def setSceneSwitch(self, idx, value):
+        return await self.run(self.domoticz.setSceneSwitchSteps(idx, value))
+
+# Device/scene fields the discovery endpoints are built from (descriptor included)
+DISCOVERY_DEVICE_FIELDS = ('idx', 'Name', 'Description', 'Type', 'SwitchType', 'SubType',
+                           'PlanID', 'PlanIDs', 'HaveDimmer', 'HardwareName',
+                           'MaxDimLevel', 'LevelInt', 'LevelNames')
+DISCOVERY_SCENE_FIELDS = ('idx', 'Name', 'Description', 'Type')
+
+# Device fields the endpoints read their state from
+STATE_DEVICE_FIELDS = ('Status', 'Level', 'Temp', 'SetPoint', 'LastUpdate')
+
+# Device fields kept by parseDeviceListing
+DEVICE_FIELDS = DISCOVERY_DEVICE_FIELDS + STATE_DEVICE_FIELDS
+
+LISTING_CHUNK_SIZE = 65536
+
+_jsonDecoder = json.JSONDecoder()
+
+# JSON whitespace, and what may follow a value (a number is only over where
+# one of these follows it, it may go on in the next chunk)
+_skipSpace = re.compile(r'[ \t\n\r]*').match
+VALUE_DELIMITERS = frozenset(' \t\n\r,:]}')
+
+class _JSONStream(object):
+    """Text of a binary stream, read as needed to decode one JSON value at a time."""
+    __slots__ = ('stream', 'decoder', 'buffer', 'pos', 'eof')
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Append the next chunk to the buffer (dropping what was consumed), False at the end."""
+        if self.eof:
+            return False
+        chunk = self.stream.read(LISTING_CHUNK_SIZE)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(chunk, final=self.eof)
+        self.pos = 0
+        return not self.eof
+
+    def peek(self):
+        """Skip whitespace, return the next character ('' at the end)."""
+        while True:
+            buffer = self.buffer
+            pos = self.pos = _skipSpace(buffer, self.pos).end()
+            if pos < len(buffer) or not self.fill():
+                return buffer[pos:pos + 1]
+
+    def expect(self, chars):
+        # Called once per device: the buffer is looked at first, peek() when it ran out
+        buffer = self.buffer
+        pos = _skipSpace(buffer, self.pos).end()
+        char = buffer[pos:pos + 1]
+        if not char:
+            self.pos = pos
+            char = self.peek()
+            pos = self.pos
+        if not char or char not in chars:
+            raise ValueError('Expecting one of %r at %d' % (chars, pos))
+        self.pos = pos + 1
+        return char
+
+    def value(self):
+        """Decode the next JSON value, reading as many chunks as it needs."""
+        while True:
+            buffer = self.buffer
+            pos = _skipSpace(buffer, self.pos).end()
+            if pos < len(buffer):
+                try:
+                    value, end = _jsonDecoder.raw_decode(buffer, pos)
+                    if (self.eof or isinstance(value, (dict, list, str)) or
+                            (end < len(buffer) and buffer[end] in VALUE_DELIMITERS)):
+                        self.pos = end
+                        return value
+                except ValueError:
+                    # Cut at the end of the buffer (or invalid)
+                    if self.eof:
+                        raise
+            elif self.eof:
+                raise ValueError('Expecting a value at %d' % pos)
+            self.pos = pos
+            self.fill()
+
+def parseDeviceListing(stream, fields=DEVICE_FIELDS):
+    """Decode a type=devices response read from stream (a binary file).
+
+    The result devices are decoded one at a time, as the response arrives,
+    and only their fields are kept: the whole body, its text and the complete
+    devices never are in memory at once.
+    """
+    reader = _JSONStream(stream)
+    response = {}
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.pos += 1
+        return response
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'result' and reader.peek() == '[':
+            reader.pos += 1
+            devices = response[key] = []
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    device = reader.value()
+                    if not isinstance(device, dict):
+                        raise ValueError('Expecting a device object at %d' % reader.pos)
+                    devices.append({field: device[field] for field in fields if field in device})
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            response[key] = reader.value()
+        if reader.expect(',}') == '}':
+            return response
+
+def discoveryFingerprint(devices, scenes, options):
+    """Hash of everything the discovery endpoints depend on."""
+    import hashlib
+    digest = hashlib.sha1(repr(options).encode())
+    for items, fields in ((devices, DISCOVERY_DEVICE_FIELDS), (scenes, DISCOVERY_SCENE_FIELDS)):
+        digest.update(b'\x1d')
+        for item in items:
+            digest.update(repr(tuple(item.get(field) for field in fields)).encode())
+    return digest.digest()
 
 # philchillbill comment
 def deviceHasDimmer(device):
     #return (device['HaveDimmer'] and (device['DimmerType'] != 'none')) or device['SwitchType'].endswith('Percentage')
     return device['HaveDimmer']
 
-def color_hsb_to_RGB(fH: float, fS: float, fB: float) -> Tuple[int, int, int]:
-    """Convert a hsb into its rgb representation."""
+# Color switch SubTypes with a white temperature (setkelvinlevel), flagged in
+# the endpoint cookie so SetColorTemperature needs no device read
+WHITE_TEMPERATURE_SUBTYPES = frozenset(('WW', 'RGBWW', 'RGBWWZ'))
+WHITE_TEMPERATURE_COOKIE = 'whiteTemperature'
+
+# White temperature range mapped to the setkelvinlevel 0 (coldest) .. 100 (warmest) level
+KELVIN_COLDEST = 6500
+KELVIN_WARMEST = 2700
+
+def kelvin_to_level(kelvin):
+    """setkelvinlevel level (0..100, 100 warmest) of a color temperature."""
+    level = (KELVIN_COLDEST - kelvin) * 100.0 / (KELVIN_COLDEST - KELVIN_WARMEST)
+    return int(min(max(level, 0), 100) + 0.5)
+
+@lru_cache(maxsize=256)
+def color_hsb_to_RGB(fH: float, fS: float, fB: float):
+    """Convert a hsb into its (r, g, b) representation (memoized, Alexa colors are few)."""
+    return _color_hsb_to_RGB(fH, fS, fB)
+
+def color_hsb_to_RGB_many(colors):
+    """(r, g, b) list of a sequence of (h, s, b) colors (scene fades...)."""
+    return [color_hsb_to_RGB(h, s, b) for h, s, b in colors]
+
+def _color_hsb_to_RGB(fH, fS, fB):
     if fS == 0:
         fV = int(fB * 255)
         return fV, fV, fV
@@ -503,7 +1772,26 @@ def color_hsb_to_RGB(fH: float, fS: float, fB: float) -> Tuple[int, int, int]:
 
     return (r, g, b)
 
+# Kelvin -> (r, g, b) table, KELVIN_TABLE_STEP resolution (built on first use)
+KELVIN_TABLE_MIN = 1000
+KELVIN_TABLE_MAX = 40000
+KELVIN_TABLE_STEP = 100
+_kelvinTable = None
+
 def convert_K_to_RGB(colour_temperature):
+    """Convert a color temperature to (r, g, b), rounded to the table resolution."""
+    global _kelvinTable
+    if _kelvinTable is None:
+        _kelvinTable = tuple(_convert_K_to_RGB(kelvin) for kelvin in
+                             range(KELVIN_TABLE_MIN, KELVIN_TABLE_MAX + 1, KELVIN_TABLE_STEP))
+    kelvin = min(max(colour_temperature, KELVIN_TABLE_MIN), KELVIN_TABLE_MAX)
+    return _kelvinTable[int((kelvin - KELVIN_TABLE_MIN) / float(KELVIN_TABLE_STEP) + 0.5)]
+
+def convert_K_to_RGB_many(colour_temperatures):
+    """(r, g, b) list of a sequence of color temperatures."""
+    return [convert_K_to_RGB(kelvin) for kelvin in colour_temperatures]
+
+def _convert_K_to_RGB(colour_temperature):
     """
     Converts from K to RGB, algorithm courtesy of 
     https://gist.github.com/petrklus/b1f427accdf7438606a6 and
@@ -0,0 +1,192 @@
+#
+# Several households served by one skill: each directive is handled by the
+# Domoticz client of the tenant its bearer token belongs to
+#
+# configdz.json:
+# "tenants": {
+#     "home1": {"url": "http://home1:8080/", "username": "...", "password": "...",
+#               "tokens": ["..."], "userId": "amzn1.account...."},
+#     ...
+# },
+# "maxTenants": 16, "tenantConcurrency": 4, "tenantQueueTimeout": 0.5, "profileLookup": false
+#
+# Tenant options default to the top level ones (includeScenesGroups, deviceCacheTTL...)
+#
+
+import json, threading, time
+import logging
+from collections import OrderedDict
+
+import AlexaSmartHome, DomoticzHandler
+from AlexaSmartHome import API_DIRECTIVE, API_ENDPOINT, API_PAYLOAD
+
+LWA_PROFILE_URL = 'https://api.amazon.com/user/profile'
+
+_LOGGER = logging.getLogger(__name__)
+
+def bearerToken(request):
+    """The bearer token of a directive (endpoint scope, payload scope or grantee)."""
+    for scope in (request.get(API_ENDPOINT, {}).get('scope'),
+                  request.get(API_PAYLOAD, {}).get('scope'),
+                  request.get(API_PAYLOAD, {}).get('grantee')):
+        if scope and scope.get('type') == 'BearerToken':
+            return scope.get('token')
+    return None
+
+class ProfileLookup(object):
+    """Login with Amazon user_id of access tokens, cached ttl seconds (at most size tokens)."""
+
+    def __init__(self, url=LWA_PROFILE_URL, ttl=3600, failureTtl=60, size=1024, timeout=2):
+        self.url = url
+        self.ttl = ttl
+        self.failureTtl = failureTtl
+        self.size = size
+        self.timeout = timeout
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def userId(self, token):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._users.get(token)
+            if cached is not None and cached[1] > now:
+                self._users.move_to_end(token)
+                return cached[0]
+        userId = self.fetch(token)
+        with self._lock:
+            self._users[token] = (userId, now + (self.ttl if userId is not None else self.failureTtl))
+            self._users.move_to_end(token)
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+        return userId
+
+    def fetch(self, token):
+        import urllib.request
+        request = urllib.request.Request(self.url, headers={'Authorization': 'Bearer %s' % token})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read()).get('user_id')
+        except Exception as e:
+            _LOGGER.warning("Profile lookup failed: %s", e)
+            return None
+
+class Tenant(object):
+    """A tenant client, and the number of its directives in progress."""
+
+    def __init__(self, name, remote, concurrency):
+        self.name = name
+        self.remote = remote
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.active = 0
+
+class TenantRegistry(object):
+    """Domoticz clients of the tenants, picked by the directive bearer token.
+
+    Clients (connection pool, device cache) are built on first use, at most
+    maxTenants are kept: the least recently used idle one is closed when
+    another is needed. A tenant handles at most concurrency directives at
+    once, the others wait queueTimeout seconds for a slot then get a
+    RATE_LIMIT_EXCEEDED error.
+    """
+
+    def __init__(self, config, maxTenants=16, concurrency=4, queueTimeout=0.5, profileLookup=None):
+        self.config = config
+        self.maxTenants = maxTenants
+        self.concurrency = concurrency
+        self.queueTimeout = queueTimeout
+        self.profileLookup = profileLookup
+        self._tokens = {}
+        self._users = {}
+        for name, tenant in config.tenants.items():
+            for token in tenant.get('tokens', ()):
+                self._tokens[token] = name
+            if tenant.get('userId'):
+                self._users[tenant['userId']] = name
+        self._tenants = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def fromConfiguration(cls, config):
+        return cls(config, config.maxTenants, config.tenantConcurrency, config.tenantQueueTimeout,
+                   ProfileLookup() if config.profileLookup else None)
+
+    def tenantName(self, request):
+        token = bearerToken(request)
+        if token is None:
+            return None
+        name = self._tokens.get(token)
+        if name is None and self.profileLookup is not None:
+            name = self._users.get(self.profileLookup.userId(token))
+        return name
+
+    def makeRemote(self, name):
+        config = self.config.tenant(name)
+        remote = DomoticzHandler.Domoticz(config.url, config.username, config.password)
+        remote.configure(config)
+        return remote
+
+    def acquire(self, name):
+        """The tenant, with one more directive in progress."""
+        with self._lock:
+            tenant = self._tenants.get(name)
+            if tenant is None:
+                concurrency = self.config.tenants[name].get('maxConcurrency', self.concurrency)
+                tenant = self._tenants[name] = Tenant(name, self.makeRemote(name), concurrency)
+            self._tenants.move_to_end(name)
+            tenant.active += 1
+            self._evict()
+        return tenant
+
+    def release(self, tenant):
+        with self._lock:
+            tenant.active -= 1
+            self._evict()
+
+    def _evict(self):
+        # Called with the lock held, busy tenants are kept (over the limit) until idle
+        excess = len(self._tenants) - self.maxTenants
+        for name in list(self._tenants):
+            if excess <= 0:
+                break
+            tenant = self._tenants[name]
+            if tenant.active == 0:
+                del self._tenants[name]
+                tenant.remote.close()
+                _LOGGER.info("Tenant %s evicted", name)
+                excess -= 1
+
+    def dispatch(self, message, handle):
+        """handle(remote, message) with the client of the message tenant, or an error response."""
+        request = message[API_DIRECTIVE]
+        name = self.tenantName(request)
+        if name is None:
+            return AlexaSmartHome.api_error(request, error_type='INVALID_AUTHORIZATION_CREDENTIAL',
+                                            error_message="Unknown tenant")
+        tenant = self.acquire(name)
+        try:
+            if not tenant.slots.acquire(timeout=self.queueTimeout):
+                return AlexaSmartHome.api_error(request, error_type='RATE_LIMIT_EXCEEDED',
+                                                error_message="Too many requests for %s" % name)
+            try:
+                return handle(tenant.remote, message)
+            finally:
+                tenant.slots.release()
+        finally:
+            self.release(tenant)
+
+    def handle_message(self, message):
+        return self.dispatch(message, AlexaSmartHome.handle_message)
+
+    def encode_message(self, message):
+        response = self.dispatch(message, AlexaSmartHome.encode_message)
+        if isinstance(response, dict):
+            out = bytearray()
+            AlexaSmartHome.write_json(out, response)
+            return out
+        return response
+
+    def close(self):
+        with self._lock:
+            tenants, self._tenants = self._tenants, OrderedDict()
+        for tenant in tenants.values():
+            tenant.remote.close()
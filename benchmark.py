@@ -0,0 +1,262 @@
+#!/usr/bin/python3
+#
+# Directive latency/throughput benchmark, against the local fake Domoticz (fake_domoticz.py)
+#
+# python3 benchmark.py --devices 10,500,10000 --latency 5 --jitter 2
+# python3 benchmark.py --save benchmark_baseline.json     (store a new baseline)
+# python3 benchmark.py --devices ''                        (cold start import time and endpoint footprint only)
+#
+# Results are compared with the stored baseline (if any), the exit status is 1
+# when a metric regressed more than --tolerance
+# CPU time is the whole process, it includes the fake Domoticz serving the calls
+#
+
+import os, sys, json, time, subprocess, tracemalloc
+
+import AlexaSmartHome, DomoticzHandler
+from fake_domoticz import FakeDomoticz, makeDevices
+
+BASELINE_FILE = 'benchmark_baseline.json'
+
+# name, namespace, directive, target interface, payload
+DIRECTIVES = (
+    ('Discover', 'Alexa.Discovery', 'Discover', None, {'scope': {'type': 'BearerToken', 'token': 'bench'}}),
+    ('ReportState', 'Alexa', 'ReportState', 'Alexa.BrightnessController', {}),
+    ('TurnOn', 'Alexa.PowerController', 'TurnOn', 'Alexa.PowerController', {}),
+    ('SetBrightness', 'Alexa.BrightnessController', 'SetBrightness', 'Alexa.BrightnessController', {'brightness': 42}),
+    ('AdjustPercentage', 'Alexa.PercentageController', 'AdjustPercentage', 'Alexa.PercentageController', {'percentageDelta': 5}),
+    ('SetColor', 'Alexa.ColorController', 'SetColor', 'Alexa.ColorController',
+     {'color': {'hue': 350, 'saturation': 0.71, 'brightness': 0.65}}),
+)
+
+# Modules a cold start (import lambda) does not load: imported where used
+# (asyncio client, Discover fingerprint, parallel fetches) or not used at all
+COLD_START_LAZY_MODULES = ('asyncio', 'concurrent.futures', 'hashlib', 'colorsys', 'typing')
+
+# Run in a fresh interpreter by importTime(), prints the import duration and modules
+IMPORT_SCRIPT = '''
+import sys, time, importlib
+startup = set(sys.modules)
+start = time.perf_counter()
+importlib.import_module('lambda')
+import json
+print(json.dumps({'ms': (time.perf_counter() - start) * 1000,
+                  'startup': sorted(startup), 'modules': sorted(set(sys.modules) - startup)}))
+'''
+
+# Metrics compared with the baseline, and their unit (calls are compared exactly,
+# timings get an absolute slack on top of the relative tolerance)
+COMPARED_METRICS = (('p50', 'ms'), ('p95', 'ms'), ('cpu', 'ms'), ('calls', 'count'), ('peak', 'KiB'))
+
+def directive(namespace, name, endpoint=None, payload=None):
+    message = {'directive': {
+        'header': {'namespace': namespace, 'name': name, 'payloadVersion': '3',
+                   'messageId': 'bench-message', 'correlationToken': 'bench-token'},
+        'payload': payload or {}}}
+    if endpoint is not None:
+        message['directive']['endpoint'] = {'endpointId': endpoint['endpointId'],
+            'cookie': endpoint.get('cookie', {}), 'scope': {'type': 'BearerToken', 'token': 'bench'}}
+    return message
+
+def findEndpoint(endpoints, interface):
+    for endpoint in endpoints:
+        if any(capability['interface'] == interface for capability in endpoint['capabilities']):
+            return endpoint
+    raise LookupError('No endpoint with %s' % interface)
+
+def percentile(values, pct):
+    values = sorted(values)
+    rank = (len(values) - 1) * pct / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+def measure(fake, dz, message, iterations):
+    """Run message iterations times, return its metrics (milliseconds, calls, KiB)."""
+    AlexaSmartHome.handle_message(dz, message)
+    latencies, calls, errors = [], 0, 0
+    cpu = time.process_time()
+    for i in range(iterations):
+        fake.reset()
+        start = time.perf_counter()
+        response = AlexaSmartHome.handle_message(dz, message)
+        latencies.append((time.perf_counter() - start) * 1000.0)
+        calls += fake.calls
+        if response['event']['header']['name'] == 'ErrorResponse':
+            errors += 1
+    cpu = (time.process_time() - cpu) * 1000.0 / iterations
+
+    tracemalloc.start()
+    AlexaSmartHome.handle_message(dz, message)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'p50': round(percentile(latencies, 50), 3),
+        'p95': round(percentile(latencies, 95), 3),
+        'p99': round(percentile(latencies, 99), 3),
+        'cpu': round(cpu, 3),
+        'calls': round(float(calls) / iterations, 2),
+        'peak': round(peak / 1024.0, 1),
+        'errors': errors,
+    }
+
+def runSize(devices, args):
+    fake = FakeDomoticz(devices, args.scenes, args.latency / 1000.0, args.jitter / 1000.0).start()
+    dz = DomoticzHandler.Domoticz(fake.url)
+    dz.includeScenesGroups = args.scenes > 0
+    dz.deviceCache.ttl = args.ttl
+    dz.optimistic.window = args.optimistic
+    dz.streamDevices = args.stream
+    try:
+        discover = AlexaSmartHome.handle_message(dz, directive(*DIRECTIVES[0][1:3], payload=DIRECTIVES[0][4]))
+        endpoints = discover['event']['payload']['endpoints']
+        results = {}
+        for name, namespace, directiveName, interface, payload in DIRECTIVES:
+            endpoint = findEndpoint(endpoints, interface) if interface is not None else None
+            message = directive(namespace, directiveName, endpoint, payload)
+            iterations = args.iterations if name != 'Discover' else max(1, args.iterations // 5)
+            results[name] = measure(fake, dz, message, iterations)
+        return results
+    finally:
+        dz.close()
+        fake.stop()
+
+def importTime(runs=5, top=8):
+    """Cold start import of the lambda module: best duration of runs fresh
+    interpreters and the -X importtime breakdown (top modules, cumulative ms)."""
+    best = None
+    for i in range(runs):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', IMPORT_SCRIPT],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, check=True)
+        result = json.loads(process.stdout)
+        if best is None or result['ms'] < best[0]['ms']:
+            best = (result, process.stderr)
+    result, importtime = best
+    startup = set(result['startup'])
+    breakdown = []
+    for line in importtime.splitlines()[1:]:
+        self_us, cumulative_us, name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if name.strip() not in startup and depth <= 1:
+            breakdown.append((int(cumulative_us) / 1000.0, name.rstrip()[1:]))
+    return {
+        'ms': round(result['ms'], 3),
+        'modules': len(result['modules']),
+        'lazy': [name for name in COLD_START_LAZY_MODULES if name in result['modules']],
+        'breakdown': sorted(breakdown, reverse=True)[:top],
+    }
+
+def endpointFootprint(count=1000):
+    """Memory held per endpoint (bytes) by getEndpoints() on count devices,
+    the shared caches (classification, capabilities, metadata) warmed first."""
+    devices = makeDevices(count)
+    dz = DomoticzHandler.Domoticz('http://127.0.0.1:8080/')
+    list(dz.getEndpoints(devices, []))
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    endpoints = list(dz.getEndpoints(devices, []))
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return {'bytes': round(float(held) / len(endpoints), 1), 'endpoints': len(endpoints)}
+
+def reportFootprint(footprint, baseline, tolerance):
+    """Print the endpoint footprint, return the list of regressions."""
+    print('endpoint footprint: %.1f bytes (%d endpoints)' % (footprint['bytes'], footprint['endpoints']))
+    if 'bytes' in baseline:
+        before = baseline['bytes']
+        print('  baseline %.1f bytes (%+.0f%%)' % (before, (footprint['bytes'] - before) * 100.0 / before))
+        if footprint['bytes'] > before * (1 + tolerance):
+            return ['endpoint footprint: %s -> %s bytes' % (before, footprint['bytes'])]
+    return []
+
+def reportImports(imports, baseline, tolerance, slack):
+    """Print the cold start import results, return the list of regressions."""
+    regressions = []
+    print('import lambda: %.3f ms, %d modules' % (imports['ms'], imports['modules']))
+    for ms, name in imports['breakdown']:
+        print('  %-32s %9.3f ms' % (name, ms))
+    for name in imports['lazy']:
+        regressions.append('cold start imports %s' % name)
+    if 'ms' in baseline:
+        before = baseline['ms']
+        print('  baseline %.3f ms (%+.0f%%)' % (before, (imports['ms'] - before) * 100.0 / before))
+        if imports['ms'] > before * (1 + tolerance) + slack:
+            regressions.append('import lambda: %s -> %s ms' % (before, imports['ms']))
+    return regressions
+
+def report(size, results, baseline, tolerance, slack):
+    """Print the results of one size, return the list of regressions."""
+    regressions = []
+    print('%d devices' % size)
+    print('  %-17s %9s %9s %9s %9s %7s %10s %6s' % ('directive', 'p50 ms', 'p95 ms', 'p99 ms', 'cpu ms', 'calls', 'peak KiB', 'errors'))
+    for name, _, _, _, _ in DIRECTIVES:
+        metrics = results[name]
+        print('  %-17s %9.3f %9.3f %9.3f %9.3f %7.2f %10.1f %6d' % (name, metrics['p50'], metrics['p95'],
+            metrics['p99'], metrics['cpu'], metrics['calls'], metrics['peak'], metrics['errors']))
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        changes = []
+        for metric, unit in COMPARED_METRICS:
+            if metric not in reference:
+                continue
+            before, after = reference[metric], metrics[metric]
+            if before:
+                changes.append('%s %+.0f%%' % (metric, (after - before) * 100.0 / before))
+            if unit == 'count':
+                limit = before
+            else:
+                limit = before * (1 + tolerance) + (slack if unit == 'ms' else 0)
+            if after > limit:
+                regressions.append('%d devices %s %s: %s -> %s' % (size, name, metric, before, after))
+        print('  %-17s %s' % ('', ', '.join(changes)))
+    return regressions
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark Alexa directives against a fake Domoticz')
+    parser.add_argument('--devices', default='10,500,10000', help='comma separated device set sizes')
+    parser.add_argument('--scenes', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every Domoticz request')
+    parser.add_argument('--jitter', type=float, default=0, help='+/- milliseconds of random latency')
+    parser.add_argument('--ttl', type=float, default=0, help='device cache TTL (deviceCacheTTL)')
+    parser.add_argument('--optimistic', type=float, default=0, help='optimistic state window (optimisticWindow)')
+    parser.add_argument('--footprint', type=int, default=1000, help='devices of the per endpoint memory measure (0 to skip)')
+    parser.add_argument('--stream', action='store_true', help='parse device listings while they are read (streamDevices true)')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline to compare with')
+    parser.add_argument('--save', metavar='FILE', help='store the results as a new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression of timings/memory')
+    parser.add_argument('--slack', type=float, default=0.5, help='allowed absolute regression of timings (milliseconds)')
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.baseline and not args.save:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            pass
+
+    imports = importTime()
+    results = {'imports': {'ms': imports['ms'], 'modules': imports['modules']}}
+    regressions = reportImports(imports, baseline.get('imports', {}), args.tolerance, args.slack)
+    if args.footprint:
+        results['footprint'] = endpointFootprint(args.footprint)
+        regressions += reportFootprint(results['footprint'], baseline.get('footprint', {}), args.tolerance)
+    for size in [int(size) for size in args.devices.split(',') if size]:
+        results[str(size)] = runSize(size, args)
+        regressions += report(size, results[str(size)], baseline.get(str(size), {}), args.tolerance, args.slack)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+#
+# Local stand-in for the Domoticz json.htm API, for tests and benchmarks
+# It serves a synthetic set of devices/scenes and applies the commands it receives
+#
+# python3 fake_domoticz.py --devices 500 --latency 20 --jitter 5
+#
+
+import sys, json, random, threading, time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qsl
+
+# Synthetic device kinds, cycled through to build the device set
+DEVICE_TEMPLATES = (
+    {'Type': 'Color Switch', 'SubType': 'RGBWW', 'SwitchType': 'Dimmer', 'HaveDimmer': True, 'Status': 'On', 'Level': 60},
+    {'Type': 'Light/Switch', 'SubType': 'Switch', 'SwitchType': 'On/Off', 'HaveDimmer': False, 'Status': 'Off', 'Level': 0},
+    {'Type': 'Lighting 2', 'SubType': 'AC', 'SwitchType': 'Dimmer', 'HaveDimmer': True, 'Status': 'On', 'Level': 30},
+    {'Type': 'Temp', 'SubType': 'LaCrosse TX3', 'Temp': 19.5},
+    {'Type': 'RFY', 'SubType': 'RFY', 'SwitchType': 'Venetian Blinds EU', 'HaveDimmer': True, 'Status': 'Open', 'Level': 50},
+    {'Type': 'Light/Switch', 'SubType': 'Switch', 'SwitchType': 'Door Contact', 'HaveDimmer': False, 'Status': 'Closed'},
+    {'Type': 'Thermostat', 'SubType': 'SetPoint', 'SetPoint': '20.5'},
+    {'Type': 'Light/Switch', 'SubType': 'Switch', 'SwitchType': 'Motion Sensor', 'HaveDimmer': False, 'Status': 'Off'},
+    {'Type': 'Light/Switch', 'SubType': 'Selector Switch', 'SwitchType': 'Selector', 'HaveDimmer': True, 'Status': 'On',
+     'Level': 10, 'LevelInt': 10, 'LevelNames': 'Off|Heat|Eco', 'Description': 'Alexa_extra: {"OFF": 0}'},
+    {'Type': 'General', 'SubType': 'kWh', 'Data': '1234.5 kWh'},
+)
+
+# Fields of a real Domoticz device not used by the skill (response size realism)
+DEVICE_PADDING = {
+    'AddjMulti': 1.0, 'AddjMulti2': 1.0, 'AddjValue': 0.0, 'AddjValue2': 0.0, 'BatteryLevel': 255,
+    'CustomImage': 0, 'Data': 'On', 'DimmerType': 'abs', 'Favorite': 0, 'HardwareID': 3,
+    'HardwareType': 'Dummy (Does nothing, use for virtual switches only)', 'HardwareTypeVal': 15,
+    'ID': '00014051', 'Image': 'Light', 'IsSubDevice': False, 'Notifications': 'false',
+    'Protected': False, 'ShowNotifications': True, 'SignalLevel': '-', 'StrParam1': '', 'StrParam2': '',
+    'Timers': 'false', 'TypeImg': 'lightbulb', 'Unit': 1, 'Used': 1, 'XOffset': '0', 'YOffset': '0',
+}
+
+def makeDevices(count, plans=(2, 3, 4)):
+    devices = []
+    for i in range(count):
+        device = dict(DEVICE_PADDING)
+        device.update(DEVICE_TEMPLATES[i % len(DEVICE_TEMPLATES)])
+        plan = plans[i % len(plans)]
+        device.update({
+            'idx': str(i + 1),
+            'Name': 'Device %d' % (i + 1),
+            'Description': device.get('Description', 'Alexa_Name: device %d' % (i + 1) if i % 4 == 0 else ''),
+            'HardwareName': 'Virtual',
+            'PlanID': str(plan),
+            'PlanIDs': [plan],
+            'MaxDimLevel': 100,
+            'LastUpdate': '2026-01-01 00:00:00',
+            '_ts': 0,
+        })
+        devices.append(device)
+    return devices
+
+def makeScenes(count):
+    return [{'idx': str(i + 1), 'Name': 'Scene %d' % (i + 1), 'Description': '',
+             'Type': 'Group' if i % 2 else 'Scene', 'Status': 'Off', '_ts': 0} for i in range(count)]
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, don't let Nagle delay the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server.fake
+        server.delay()
+        parts = urlsplit(self.path)
+        if not parts.path.endswith('/json.htm'):
+            self.send_error(404)
+            return
+        body = json.dumps(server.query(dict(parse_qsl(parts.query))), separators=(',', ':')).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients give up on slow requests (timeouts), that is not an error here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class FakeDomoticz(object):
+    """Synthetic Domoticz json.htm server.
+
+    latency/jitter (seconds) are added to every request, calls counts the
+    queries received (see reset()).
+    """
+
+    def __init__(self, devices=500, scenes=10, latency=0.0, jitter=0.0, host='127.0.0.1', port=0, seed=0):
+        self.devices = makeDevices(devices)
+        self.devicesByIdx = dict((device['idx'], device) for device in self.devices)
+        self.scenes = makeScenes(scenes)
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.queries = []
+        self.lock = threading.Lock()
+        self.httpd = _Server((host, port), _Handler)
+        self.httpd.fake = self
+        self.url = 'http://%s:%d/' % self.httpd.server_address[:2]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.calls = 0
+            self.queries = []
+
+    def delay(self):
+        if self.latency or self.jitter:
+            with self.lock:
+                pause = self.latency + self.random.uniform(-self.jitter, self.jitter)
+            if pause > 0:
+                time.sleep(pause)
+
+    def query(self, params):
+        with self.lock:
+            self.calls += 1
+            self.queries.append(params)
+        kind = params.get('type')
+        if kind == 'devices':
+            return self.queryDevices(params)
+        if kind == 'scenes':
+            return {'result': self.scenes, 'status': 'OK', 'title': 'Scenes'}
+        if kind == 'command':
+            return self.command(params)
+        return {'status': 'ERR', 'title': kind}
+
+    def queryDevices(self, params):
+        devices = self.devices
+        if 'rid' in params:
+            device = self.devicesByIdx.get(params['rid'])
+            devices = [device] if device is not None else []
+        if 'plan' in params:
+            plan = int(params['plan'])
+            devices = [device for device in devices if plan in device['PlanIDs']]
+        if 'lastupdate' in params:
+            since = int(params['lastupdate'])
+            devices = [device for device in devices if device['_ts'] >= since]
+        response = {'ActTime': int(time.time()), 'status': 'OK', 'title': 'Devices'}
+        if devices:
+            response['result'] = devices
+        return response
+
+    def command(self, params):
+        param = params.get('param')
+        if param == 'switchscene':
+            return {'status': 'OK', 'title': 'SwitchScene'}
+        device = self.devicesByIdx.get(params.get('idx'))
+        if device is None:
+            return {'status': 'ERR', 'title': param}
+        with self.lock:
+            if param == 'switchlight':
+                switchcmd = params.get('switchcmd')
+                if switchcmd == 'Set Level':
+                    device['Level'] = int(params.get('level', 0))
+                    device['Status'] = 'On' if device['Level'] > 0 else 'Off'
+                else:
+                    device['Status'] = switchcmd
+            elif param == 'setcolbrightnessvalue':
+                device['Level'] = int(params.get('brightness', device.get('Level', 0)))
+                device['Color'] = params.get('hex')
+                device['Status'] = 'On'
+            elif param == 'setkelvinlevel':
+                device['Kelvin'] = params.get('kelvin')
+            elif param == 'udevice':
+                device['SetPoint'] = params.get('svalue')
+            device['_ts'] = int(time.time())
+        return {'status': 'OK', 'title': param}
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Fake Domoticz json.htm server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--devices', type=int, default=500)
+    parser.add_argument('--scenes', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0, help='+/- milliseconds of random latency')
+    args = parser.parse_args()
+    fake = FakeDomoticz(args.devices, args.scenes, args.latency / 1000.0, args.jitter / 1000.0, args.host, args.port)
+    print('Fake Domoticz (%d devices) on %s' % (args.devices, fake.url))
+    try:
+        fake.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
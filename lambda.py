@@ -1,3 +1,4 @@
+import os
 import json
 import logging
 
@@ -5,6 +6,8 @@ import AlexaSmartHome, DomoticzHandler
 
 logger = logging.getLogger()
 
+CONFIG_FILE = 'configdz.json'
+
 class Configuration(object):
     def __init__(self, filename=None, optsDict=None):
         self._json = {}
@@ -22,7 +25,30 @@ class Configuration(object):
         opts['includeScenesGroups'] = self.get(['includeScenesGroups'], default=False)
         opts['planID'] = self.get(['planID'], default=None)
         opts['prefixName'] = self.get(['prefixName'], default=None)
+        opts['deviceCacheTTL'] = self.get(['deviceCacheTTL'], default=0)
+        opts['deviceCacheFullRefresh'] = self.get(['deviceCacheFullRefresh'], default=300)
+        opts['optimisticWindow'] = self.get(['optimisticWindow'], default=0)
         opts['debug'] = self.get(['debug'], default=False)
+        opts['trace'] = self.get(['trace'], default=False)
+        opts['directiveTimeout'] = self.get(['directiveTimeout'], default=AlexaSmartHome.DIRECTIVE_TIMEOUT)
+        opts['streamDevices'] = self.get(['streamDevices'], default=False)
+        opts['breakerFailures'] = self.get(['breakerFailures'], default=5)
+        opts['breakerResetTimeout'] = self.get(['breakerResetTimeout'], default=30)
+        opts['breakerCallTimeout'] = self.get(['breakerCallTimeout'], default=5)
+        opts['tenants'] = self.get(['tenants'], default=None)
+        opts['maxTenants'] = self.get(['maxTenants'], default=16)
+        opts['tenantConcurrency'] = self.get(['tenantConcurrency'], default=4)
+        opts['tenantQueueTimeout'] = self.get(['tenantQueueTimeout'], default=0.5)
+        opts['profileLookup'] = self.get(['profileLookup'], default=False)
+        # ChangeReport.py
+        opts['eventGateway'] = self.get(['eventGateway'], default=None)
+        opts['eventToken'] = self.get(['eventToken'], default=None)
+        opts['eventClientId'] = self.get(['eventClientId'], default=None)
+        opts['eventClientSecret'] = self.get(['eventClientSecret'], default=None)
+        opts['eventRefreshToken'] = self.get(['eventRefreshToken'], default=None)
+        opts['changeReportInterval'] = self.get(['changeReportInterval'], default=2.0)
+        opts['changeReportDebounce'] = self.get(['changeReportDebounce'], default=1.0)
+        opts['changeReportRefresh'] = self.get(['changeReportRefresh'], default=300)
         self.opts = opts
 
     def __getattr__(self, name):
@@ -34,19 +60,65 @@ class Configuration(object):
                 return self._json[key]
         return default
 
+    def tenant(self, name):
+        """The configuration of tenant name, defaulting to this one."""
+        opts = dict(self._json)
+        del opts['tenants']
+        opts.update(self.tenants[name])
+        return Configuration(optsDict=opts)
+
     def dump(self):
         return json.dumps(self.opts, indent=2, separators=(',', ': '))
 
+# Built once per container and reused by warm invocations
+_remote = None
+_remoteStamp = None
+
+def getRemote(filename=CONFIG_FILE):
+    """Return the Domoticz client configured from filename (a
+    TenantRegistry.TenantRegistry when it has tenants).
+
+    The configuration is only parsed again (and the client rebuilt) when the
+    file stat signature changes.
+    """
+    global _remote, _remoteStamp
+    st = os.stat(filename)
+    stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+    if _remote is None or stamp != _remoteStamp:
+        config = Configuration(filename)
+        if config.debug:
+            logger.setLevel(logging.DEBUG)
+        AlexaSmartHome.enableTracing(config.trace)
+        if config.tenants:
+            import TenantRegistry
+            remote = TenantRegistry.TenantRegistry.fromConfiguration(config)
+        else:
+            remote = DomoticzHandler.Domoticz(config.url, config.username, config.password)
+            remote.configure(config)
+        if _remote is not None:
+            _remote.close()
+        _remote, _remoteStamp = remote, stamp
+    return _remote
+
+# Seconds kept to return a response before the lambda times out
+LAMBDA_MARGIN = 0.5
+
 def event_handler(request, context):
-    config = Configuration('configdz.json')
-    if config.debug:
-        logger.setLevel(logging.DEBUG)
+    dzRemote = getRemote()
 
     logger.debug("Lambda invocation %s", repr(request))
 
-    dzRemote = DomoticzHandler.Domoticz(config.url, config.username, config.password)
-    dzRemote.configure(config)
-    response =  AlexaSmartHome.handle_message(dzRemote, request)
+    # The directive deadline is the earliest of directiveTimeout and the lambda one
+    deadline = None
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        deadline = AlexaSmartHome.startDeadline(context.get_remaining_time_in_millis() / 1000.0 - LAMBDA_MARGIN)
+    try:
+        if isinstance(dzRemote, DomoticzHandler.Domoticz):
+            response =  AlexaSmartHome.handle_message(dzRemote, request)
+        else:
+            response = dzRemote.handle_message(request)
+    finally:
+        AlexaSmartHome.endDeadline(deadline)
 
     logger.debug("Skill response %s", response)
 
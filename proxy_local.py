@@ -1,45 +1,333 @@
 #!/usr/bin/python3
 #
-# This source is provided for tests purpose
-# You can run a local web server answering tests Alexa queries (Postman for example)
+# Local server answering Alexa Smart Home queries (lambda smart home proxy, Postman...)
 # Requests are forwarded to AlexaSmartHome handler, the same used by the final lambda
 #
-# Require python 3 and flask to be installed
-# sudo apt-get install python3 pip3
-# pip3 install flask
-# ... and perhaps some missings ...
+# Require python 3 (flask only for the --flask development server)
+#
+# python3 proxy_local.py --config configdz.json --workers 2 --threads 16
+# python3 proxy_local.py --url http://127.0.0.1:8080 --flask     (flask development server)
+# python3 proxy_local.py --load-test 10 --devices 500             (against a local fake domoticz)
+#
+# The server is a pre-forked HTTP/1.1 keep-alive server: each worker process
+# has its own domoticz client (connection pool, caches) and a bounded pool of
+# threads. SIGTERM (or Ctrl-C) stops accepting connections and lets the
+# requests in progress finish.
 #
 # To be used with lambda smart home proxy, you must use some nginx/apache proxy configuration to forward your requests
 #
 
-from flask import Flask, request
-from flask_restful import Resource, Api
-import json
-
-from pathlib import Path
+import os, sys, json, signal, threading, time
+import importlib
+import logging
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 import AlexaSmartHome, DomoticzHandler
 
-app = Flask(__name__)
-api = Api(app)
+SMART_HOME_PATH = '/alexa/smart_home'
+
+_LOGGER = logging.getLogger(__name__)
+
+class SmartHomeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, don't let Nagle delay the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        _LOGGER.debug("%s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        if self.path != SMART_HOME_PATH:
+            self.reply(404, b'{}')
+        else:
+            self.reply(200, b'{}')
+
+    def do_POST(self):
+        if self.path != SMART_HOME_PATH:
+            self.reply(404, b'{}')
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            message = json.loads(body)
+            message[AlexaSmartHome.API_DIRECTIVE][AlexaSmartHome.API_HEADER]
+        except (ValueError, KeyError, TypeError):
+            self.reply(400, b'{}')
+            return
+        try:
+            response = encode_message(self.server.remote(), message)
+        except Exception:
+            _LOGGER.exception("Can't handle %s", body)
+            self.reply(500, b'{}')
+            return
+        self.reply(200, response)
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if self.server.stopping:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+class PooledHTTPServer(HTTPServer):
+    """HTTP server handling connections with a bounded pool of threads.
+
+    Connections accepted while every thread is busy wait for a free one.
+    Idle keep-alive connections are closed after keepalive seconds.
+    """
+
+    def __init__(self, address, handler, threads=16, keepalive=5.0):
+        super().__init__(address, handler)
+        self.threads = threads
+        self.keepalive = keepalive
+        self.stopping = False
+        self.remote = None
+        self._pool = None
+
+    def process_request(self, request, client_address):
+        if self._pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._pool = ThreadPoolExecutor(max_workers=self.threads)
+        self._pool.submit(self._processRequest, request, client_address)
+
+    def _processRequest(self, request, client_address):
+        request.settimeout(self.keepalive)
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        _LOGGER.debug("Connection from %s closed", client_address, exc_info=True)
+
+    def drain(self):
+        """Wait for the connections in progress."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+def encode_message(remote, message):
+    if isinstance(remote, DomoticzHandler.Domoticz):
+        return AlexaSmartHome.encode_message(remote, message)
+    return remote.encode_message(message)
+
+def remoteFactory(args):
+    """Return a function giving the domoticz client (or tenant registry) of
+    the current worker (built in the worker, after the fork)."""
+    awslambda = importlib.import_module('lambda')
+    if args.url is None:
+        return lambda: awslambda.getRemote(args.config)
+    remotes = []
+    def remote():
+        if not remotes:
+            dz = DomoticzHandler.Domoticz(args.url, args.username, args.password)
+            dz.configure(awslambda.Configuration(optsDict={'url': args.url, 'includeScenesGroups': args.scenes}))
+            remotes.append(dz)
+        return remotes[0]
+    return remote
+
+def runWorker(server, remote):
+    """Serve until SIGTERM/SIGINT, then finish the requests in progress."""
+    def stop(signum, frame):
+        server.stopping = True
+        # shutdown() waits for serve_forever(), running in this thread
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server.remote = remote
+    # Build the client before the first request
+    remote()
+    try:
+        server.serve_forever()
+    finally:
+        server.drain()
+        server.server_close()
+        remote().close()
+
+def forkWorker(server, remote):
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            runWorker(server, remote)
+        except Exception:
+            _LOGGER.exception("Worker %d failed", os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+    return pid
+
+def serve(args):
+    server = PooledHTTPServer((args.host, args.port), SmartHomeHandler, args.threads, args.keepalive)
+    remote = remoteFactory(args)
+    _LOGGER.info("Serving on http://%s:%d%s (%d workers, %d threads)",
+                 args.host, server.server_address[1], SMART_HOME_PATH, args.workers, args.threads)
+    if args.workers <= 1:
+        runWorker(server, remote)
+        return
+
+    workers = set(forkWorker(server, remote) for i in range(args.workers))
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        workers.discard(pid)
+        if not stopping:
+            _LOGGER.warning("Worker %d exited (%d), restarting it", pid, status)
+            workers.add(forkWorker(server, remote))
+    server.server_close()
+
+def flaskServer(args):
+    """The flask development server (debugger, reloader...)."""
+    from flask import Flask, request, Response
+
+    app = Flask(__name__)
+    remote = remoteFactory(args)
+
+    @app.route(SMART_HOME_PATH, methods=['GET'])
+    def get():
+        return Response(b'{}', mimetype='application/json')
+
+    @app.route(SMART_HOME_PATH, methods=['POST'])
+    def post():
+        response = encode_message(remote(), json.loads(request.get_data()))
+        return Response(bytes(response), mimetype='application/json')
+
+    app.run(host=args.host, port=args.port)
+
+def freePort(host):
+    import socket
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+def waitPort(host, port, timeout=10.0):
+    import socket
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+def loadTest(args):
+    """Run the server against a fake domoticz (both in their own process) and
+    load it with args.clients keep-alive clients for args.load_test seconds.
+
+    Return the number of failed requests."""
+    import http.client, random, subprocess
+    from benchmark import directive, findEndpoint, percentile
+
+    host = '127.0.0.1'
+    dzPort, port = freePort(host), freePort(host)
+    here = os.path.dirname(os.path.abspath(__file__))
+    fake = subprocess.Popen([sys.executable, os.path.join(here, 'fake_domoticz.py'), '--port', str(dzPort),
+                             '--devices', str(args.devices), '--latency', str(args.latency)])
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--host', host, '--port', str(port),
+                               '--url', 'http://%s:%d/' % (host, dzPort),
+                               '--workers', str(args.workers), '--threads', str(args.threads)])
+    try:
+        waitPort(host, dzPort)
+        waitPort(host, port)
+
+        def post(conn, message):
+            conn.request('POST', SMART_HOME_PATH, body=json.dumps(message).encode(),
+                         headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+
+        conn = http.client.HTTPConnection(host, port)
+        status, discover = post(conn, directive('Alexa.Discovery', 'Discover',
+                                                payload={'scope': {'type': 'BearerToken', 'token': 'load'}}))
+        conn.close()
+        endpoints = discover['event']['payload']['endpoints']
+        messages = [
+            directive('Alexa', 'ReportState', findEndpoint(endpoints, 'Alexa.BrightnessController')),
+            directive('Alexa.PowerController', 'TurnOn', findEndpoint(endpoints, 'Alexa.PowerController')),
+            directive('Alexa.BrightnessController', 'SetBrightness',
+                      findEndpoint(endpoints, 'Alexa.BrightnessController'), {'brightness': 42}),
+        ]
 
-# To adjust depending on your local domoticz server
-dz = DomoticzHandler.Domoticz("http://127.0.0.1:8080")
-#dz = DomoticzHandler.Domoticz(url=...,username=...,password=...)
-#dz.includeScenesGroups = True
-#dz.planID = 12
+        latencies, errors = [], []
+        deadline = time.monotonic() + args.load_test
+        def client(seed):
+            rand = random.Random(seed)
+            conn = http.client.HTTPConnection(host, port, timeout=10)
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                try:
+                    status, response = post(conn, rand.choice(messages))
+                    if status != 200 or response['event']['header']['name'] == 'ErrorResponse':
+                        errors.append(status)
+                except Exception as e:
+                    errors.append(repr(e))
+                    conn.close()
+                latencies.append((time.perf_counter() - start) * 1000.0)
+            conn.close()
 
-class SmartHome(Resource):
+        start = time.monotonic()
+        clients = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.monotonic() - start
+    finally:
+        server.send_signal(signal.SIGTERM)
+        serverStatus = server.wait(30)
+        fake.terminate()
+        fake.wait()
 
-    def get(self):
-        return {}
+    print('%d devices, %d workers x %d threads, %d clients, %.0f s' %
+          (args.devices, args.workers, args.threads, args.clients, elapsed))
+    print('  %d directives, %.0f/s, p50 %.2f ms, p95 %.2f ms, p99 %.2f ms, %d errors' %
+          (len(latencies), len(latencies) / elapsed, percentile(latencies, 50),
+           percentile(latencies, 95), percentile(latencies, 99), len(errors)))
+    print('  server exit status %d' % serverStatus)
+    return len(errors) + (1 if serverStatus else 0)
 
-    def post(self):
-        message = json.loads(request.data.decode('utf-8'))
-        response = AlexaSmartHome.handle_message(dz, message)
-        return response
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Local Alexa Smart Home server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5002)
+    parser.add_argument('--config', default='configdz.json', help='skill configuration (reloaded when changed)')
+    parser.add_argument('--url', help='domoticz url, instead of the configuration file')
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--scenes', action='store_true', help='include scenes and groups (with --url)')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes')
+    parser.add_argument('--threads', type=int, default=16, help='threads (connections served at once) per worker')
+    parser.add_argument('--keepalive', type=float, default=5.0, help='idle keep-alive connections timeout (seconds)')
+    parser.add_argument('--flask', action='store_true', help='run the flask development server')
+    parser.add_argument('--load-test', type=float, metavar='SECONDS', help='load test against a fake domoticz')
+    parser.add_argument('--devices', type=int, default=500, help='fake domoticz devices (load test)')
+    parser.add_argument('--latency', type=float, default=0, help='fake domoticz latency in milliseconds (load test)')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients (load test)')
+    args = parser.parse_args(argv)
 
-api.add_resource(SmartHome, '/alexa/smart_home')
+    logging.basicConfig(level=logging.INFO)
+    if args.load_test:
+        return 1 if loadTest(args) else 0
+    if args.flask:
+        flaskServer(args)
+    else:
+        serve(args)
+    return 0
 
 if __name__ == '__main__':
-     app.run(host='0.0.0.0', port='5002')
+    sys.exit(main())
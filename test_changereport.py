@@ -0,0 +1,208 @@
+#
+# ChangeReport events sent for the device changes of the local fake Domoticz (fake_domoticz.py)
+#
+# python3 -m pytest test_changereport.py    (or python3 -m unittest test_changereport)
+#
+
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+import ChangeReport, DomoticzHandler
+from fake_domoticz import FakeDomoticz
+
+class _AmazonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        status, answer = stub.answer(self.path, self.headers.get('Authorization'), body)
+        data = json.dumps(answer).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class FakeAmazon(object):
+    """Stand-in for the LWA token endpoint (/auth/o2/token) and the event gateway (/v3/events).
+
+    Each grant is a new access token, the gateway only accepts the last one.
+    """
+
+    def __init__(self, expiresIn=3600):
+        self.expiresIn = expiresIn
+        self.grants = []
+        self.events = []
+        # The refresh of a token the gateway refused goes along the kept-alive gateway connection
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), _AmazonHandler)
+        self.httpd.stub = self
+        self.url = 'http://%s:%d' % self.httpd.server_address[:2]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def token(self):
+        return 'access-%d' % len(self.grants)
+
+    def answer(self, path, authorization, body):
+        if path == '/auth/o2/token':
+            self.grants.append(dict(parse_qsl(body.decode())))
+            return 200, {'access_token': self.token(), 'refresh_token': 'refresh-%d' % len(self.grants),
+                         'token_type': 'bearer', 'expires_in': self.expiresIn}
+        if path == '/v3/events':
+            if authorization != 'Bearer %s' % self.token():
+                return 401, {'header': {'name': 'ErrorResponse'}, 'payload': {'code': 'INVALID_ACCESS_TOKEN_EXCEPTION'}}
+            self.events.append(json.loads(body.decode()))
+            return 202, {}
+        return 404, {}
+
+class ChangeReporterTest(unittest.TestCase):
+    """Device changes Domoticz reports in lastupdate deltas become ChangeReport events."""
+
+    def setUp(self):
+        self.fake = FakeDomoticz(devices=8, scenes=0).start()
+        self.domoticz = DomoticzHandler.Domoticz(self.fake.url)
+        self.sink = ChangeReport.ListSink()
+        self.source = ChangeReport.LastUpdateSource(self.domoticz)
+        self.reporter = ChangeReport.ChangeReporter(self.domoticz, self.source, self.sink,
+                                                    debounce=0, token='test', refreshInterval=0)
+        self.reporter.prime()
+
+    def tearDown(self):
+        self.domoticz.close()
+        self.fake.stop()
+
+    def change(self, idx, **fields):
+        """A device change done outside of the skill (switch, remote, Domoticz UI)."""
+        device = self.fake.devicesByIdx[idx]
+        device.update(fields)
+        device['_ts'] = int(time.time())
+
+    def poll(self):
+        return self.reporter.process(self.source.poll())
+
+    def test_physical_change(self):
+        self.change('3', Level=80)
+        events = self.poll()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(self.sink.events, events)
+        event = events[0]['event']
+        self.assertEqual(event['header']['name'], 'ChangeReport')
+        self.assertEqual(event['endpoint'], {'scope': {'type': 'BearerToken', 'token': 'test'},
+                                             'endpointId': 'SwitchLight-3'})
+        change = event['payload']['change']
+        self.assertEqual(change['cause'], {'type': 'PHYSICAL_INTERACTION'})
+        self.assertEqual(sorted((prop['namespace'], prop['name'], prop['value']) for prop in change['properties']),
+                         [('Alexa.BrightnessController', 'brightness', 80),
+                          ('Alexa.PercentageController', 'percentage', 80)])
+        # The unchanged properties go to the context
+        self.assertEqual([(prop['name'], prop['value']) for prop in events[0]['context']['properties']],
+                         [('powerState', 'ON')])
+        # Reported once
+        self.assertEqual(self.poll(), [])
+
+    def test_no_change(self):
+        # A device updated with the same state (a sensor refreshed)
+        self.change('4')
+        self.assertEqual(self.poll(), [])
+        self.assertEqual(self.sink.events, [])
+
+    def test_change_following_command(self):
+        self.domoticz.setLevel('3', 80)
+        self.assertEqual(self.fake.devicesByIdx['3']['Level'], 80)
+        self.assertEqual(self.poll(), [])
+        # The change is recorded all the same, a later physical change only has what changed since
+        self.reporter.commandWindow = 0
+        self.change('3', Status='Off')
+        events = self.poll()
+        self.assertEqual(len(events), 1)
+        self.assertEqual([prop['name'] for prop in events[0]['event']['payload']['change']['properties']],
+                         ['powerState'])
+
+    def test_debounce(self):
+        self.reporter.debounce = 0.2
+        for level in (10, 20, 40):
+            self.change('3', Level=level)
+            self.change('1', Status='Off')
+            self.assertEqual(self.poll(), [])
+        time.sleep(self.reporter.debounce)
+        events = self.reporter.flush()
+        self.assertEqual(sorted(event['event']['endpoint']['endpointId'] for event in events),
+                         ['SwitchLight-1', 'SwitchLight-3'])
+        # The last state of each device, once
+        event = [event for event in events if event['event']['endpoint']['endpointId'] == 'SwitchLight-3'][0]
+        self.assertEqual(set(prop['value'] for prop in event['event']['payload']['change']['properties']), {40})
+        self.assertEqual(self.sink.events, events)
+
+    def test_deleted_device(self):
+        device = self.fake.devicesByIdx.pop('3')
+        self.fake.devices.remove(device)
+        self.domoticz.deviceCache.invalidate()
+        self.reporter.refreshEndpoints()
+        self.assertNotIn('3', self.reporter.endpoints)
+        self.assertFalse([key for key in self.reporter._reported if key[0] == 'SwitchLight-3'])
+        # A change of it still in flight is dropped
+        device['Level'] = 80
+        self.assertEqual(self.reporter.process([device]), [])
+
+class EventTokenTest(unittest.TestCase):
+    """Event gateway access tokens are refreshed from the LWA grant of the skill."""
+
+    def setUp(self):
+        self.amazon = FakeAmazon().start()
+        self.token = ChangeReport.EventToken(None, 'client', 'secret', 'refresh-0',
+                                             url=self.amazon.url + '/auth/o2/token')
+
+    def tearDown(self):
+        self.amazon.stop()
+
+    def test_refresh(self):
+        self.assertEqual(self.token.get(), 'access-1')
+        self.assertEqual(self.amazon.grants, [{'grant_type': 'refresh_token', 'refresh_token': 'refresh-0',
+                                               'client_id': 'client', 'client_secret': 'secret'}])
+        # Valid until TOKEN_MARGIN seconds before it expires
+        self.assertEqual(self.token.get(), 'access-1')
+        self.assertEqual(len(self.amazon.grants), 1)
+        self.token.expiresAt = time.monotonic()
+        self.assertEqual(self.token.get(), 'access-2')
+        # With the refresh token handed out with the last grant
+        self.assertEqual(self.amazon.grants[-1]['refresh_token'], 'refresh-1')
+
+    def test_short_lived(self):
+        self.amazon.expiresIn = ChangeReport.TOKEN_MARGIN
+        self.token.get()
+        self.assertEqual(self.token.get(), 'access-2')
+
+    def test_static(self):
+        token = ChangeReport.EventToken('static')
+        self.assertFalse(token.refreshable())
+        self.assertEqual(token.get(), 'static')
+
+    def test_gateway_refuses_expired(self):
+        sink = ChangeReport.GatewaySink(self.amazon.url + '/v3/events', self.token)
+        self.token.get()
+        # Revoked before its expiry: the gateway only takes the token of a new grant
+        self.amazon.grants.append({})
+        event = {'event': {'header': {'name': 'ChangeReport'},
+                           'endpoint': {'scope': {'type': 'BearerToken', 'token': None}, 'endpointId': 'SwitchLight-3'},
+                           'payload': {}}}
+        sink.send([event])
+        self.assertEqual(len(self.amazon.grants), 3)
+        self.assertEqual(len(self.amazon.events), 1)
+        self.assertEqual(self.amazon.events[0]['event']['endpoint']['scope']['token'], 'access-3')
+
+if __name__ == '__main__':
+    unittest.main()
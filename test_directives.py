@@ -0,0 +1,171 @@
+#
+# Domoticz calls made by each directive, against the local fake Domoticz (fake_domoticz.py)
+#
+# python3 -m pytest test_directives.py    (or python3 -m unittest test_directives)
+#
+
+import asyncio
+import unittest
+
+import AlexaSmartHome, DomoticzHandler
+from fake_domoticz import FakeDomoticz
+
+def directive(namespace, name, endpoint=None, payload=None):
+    message = {'directive': {
+        'header': {'namespace': namespace, 'name': name, 'payloadVersion': '3',
+                   'messageId': 'test-message', 'correlationToken': 'test-token'},
+        'payload': payload or {}}}
+    if endpoint is not None:
+        message['directive']['endpoint'] = {'endpointId': endpoint['endpointId'],
+            'cookie': endpoint.get('cookie', {}), 'scope': {'type': 'BearerToken', 'token': 'test'}}
+    return message
+
+def command(idx, param, **params):
+    query = {'type': 'command', 'param': param, 'idx': str(idx)}
+    query.update(params)
+    return query
+
+def device(idx):
+    return {'type': 'devices', 'rid': str(idx)}
+
+class DirectiveCallsTest(unittest.TestCase):
+    """Each directive reads a device at most once, and only when it needs its state."""
+
+    def setUp(self):
+        self.fake = FakeDomoticz(devices=20, scenes=2).start()
+        self.domoticz = self.client(self.fake.url)
+        response = self.handle('Alexa.Discovery', 'Discover', payload={'scope': {'type': 'BearerToken', 'token': 'test'}})
+        self.endpoints = dict((endpoint['endpointId'], endpoint) for endpoint in response['event']['payload']['endpoints'])
+
+    def tearDown(self):
+        self.domoticz.close()
+        self.fake.stop()
+
+    def client(self, url):
+        domoticz = DomoticzHandler.Domoticz(url)
+        domoticz.includeScenesGroups = True
+        return domoticz
+
+    def send(self, message):
+        return AlexaSmartHome.handle_message(self.domoticz, message)
+
+    def handle(self, namespace, name, endpointId=None, payload=None, endpoint=None):
+        if endpointId is not None and endpoint is None:
+            endpoint = self.endpoints[endpointId]
+        self.fake.reset()
+        return self.send(directive(namespace, name, endpoint, payload))
+
+    def assertCalls(self, response, name, queries):
+        self.assertEqual(response['event']['header']['name'], name)
+        self.assertEqual(self.fake.queries, queries)
+        self.assertEqual(self.fake.calls, len(queries))
+
+    def test_discover(self):
+        response = self.handle('Alexa.Discovery', 'Discover', payload={'scope': {'type': 'BearerToken', 'token': 'test'}})
+        # The device and scene lists are fetched concurrently
+        self.fake.queries.sort(key=lambda query: query['type'])
+        self.assertCalls(response, 'Discover.Response', [{'type': 'devices', 'used': 'true'}, {'type': 'scenes'}])
+
+    def test_turn_on_off(self):
+        response = self.handle('Alexa.PowerController', 'TurnOn', 'SwitchLight-2')
+        self.assertCalls(response, 'Response', [command(2, 'switchlight', switchcmd='On')])
+        response = self.handle('Alexa.PowerController', 'TurnOff', 'SwitchLight-2')
+        self.assertCalls(response, 'Response', [command(2, 'switchlight', switchcmd='Off')])
+
+    def test_report_state(self):
+        response = self.handle('Alexa', 'ReportState', 'SwitchLight-3')
+        self.assertCalls(response, 'StateReport', [device(3)])
+
+    def test_set_brightness(self):
+        response = self.handle('Alexa.BrightnessController', 'SetBrightness', 'SwitchLight-3', {'brightness': 42})
+        self.assertCalls(response, 'Response', [command(3, 'switchlight', switchcmd='Set Level', level='42')])
+
+    def test_adjust_brightness(self):
+        level = self.fake.devicesByIdx['3']['Level']
+        response = self.handle('Alexa.BrightnessController', 'AdjustBrightness', 'SwitchLight-3', {'brightnessDelta': 10})
+        self.assertCalls(response, 'Response',
+            [device(3), command(3, 'switchlight', switchcmd='Set Level', level=str(level + 10))])
+
+    def test_adjust_percentage(self):
+        level = self.fake.devicesByIdx['5']['Level']
+        response = self.handle('Alexa.PercentageController', 'AdjustPercentage', 'RFY-5', {'percentageDelta': 10})
+        self.assertCalls(response, 'Response',
+            [device(5), command(5, 'switchlight', switchcmd='Set Level', level=str(level + 10))])
+
+    def test_set_color(self):
+        response = self.handle('Alexa.ColorController', 'SetColor', 'SwitchLight-1',
+            {'color': {'hue': 350, 'saturation': 0.71, 'brightness': 0.65}})
+        # The color keeps the device brightness: it is read first
+        level = str(self.fake.devicesByIdx['1']['Level'])
+        self.assertCalls(response, 'Response',
+            [device(1), command(1, 'setcolbrightnessvalue', hex='A53043', brightness=level, iswhite='false')])
+
+    def test_set_color_temperature(self):
+        response = self.handle('Alexa.ColorTemperatureController', 'SetColorTemperature', 'SwitchLight-1',
+            {'colorTemperatureInKelvin': 2700})
+        self.assertCalls(response, 'Response', [command(1, 'setkelvinlevel', kelvin='100')])
+
+    def test_set_thermostat_mode(self):
+        response = self.handle('Alexa.ThermostatController', 'SetThermostatMode', 'SelectorThermostat-9',
+            {'thermostatMode': {'value': 'ECO'}})
+        self.assertCalls(response, 'Response', [command(9, 'switchlight', switchcmd='Set Level', level='20')])
+
+    def test_set_thermostat_mode_without_descriptor(self):
+        # An endpoint discovered by an older version: the level names are read from the device
+        endpoint = dict(self.endpoints['SelectorThermostat-9'])
+        endpoint['cookie'] = {}
+        response = self.handle('Alexa.ThermostatController', 'SetThermostatMode', payload={'thermostatMode': {'value': 'ECO'}},
+            endpoint=endpoint)
+        self.assertCalls(response, 'Response', [device(9), command(9, 'switchlight', switchcmd='Set Level', level='20')])
+
+    def test_activate_scene(self):
+        response = self.handle('Alexa.SceneController', 'Activate', 'Scene-1')
+        self.assertCalls(response, 'ActivationStarted', [command(1, 'switchscene', switchcmd='On')])
+
+    def test_optimistic_state(self):
+        # A command leaves a device read before in a known state
+        self.domoticz.optimistic.window = 60
+        self.handle('Alexa', 'ReportState', 'SwitchLight-3')
+        self.handle('Alexa.BrightnessController', 'SetBrightness', 'SwitchLight-3', {'brightness': 42})
+        response = self.handle('Alexa.BrightnessController', 'AdjustBrightness', 'SwitchLight-3', {'brightnessDelta': 10})
+        self.assertCalls(response, 'Response', [command(3, 'switchlight', switchcmd='Set Level', level='52')])
+        response = self.handle('Alexa', 'ReportState', 'SwitchLight-3')
+        self.assertCalls(response, 'StateReport', [])
+
+    def test_refused_command(self):
+        # A command Domoticz refuses only forgets the state assumed for its device
+        self.domoticz.optimistic.window = 60
+        for endpointId in ('SwitchLight-3', 'SwitchLight-13'):
+            self.handle('Alexa', 'ReportState', endpointId)
+            self.handle('Alexa.BrightnessController', 'SetBrightness', endpointId, {'brightness': 42})
+        del self.fake.devicesByIdx['13']
+        self.handle('Alexa.BrightnessController', 'SetBrightness', 'SwitchLight-13', {'brightness': 50})
+        response = self.handle('Alexa', 'ReportState', 'SwitchLight-3')
+        self.assertCalls(response, 'StateReport', [])
+        response = self.handle('Alexa', 'ReportState', 'SwitchLight-13')
+        self.assertCalls(response, 'ErrorResponse', [device(13)])
+
+class AsyncDirectiveCallsTest(DirectiveCallsTest):
+    """The same calls with the asyncio handler."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        super().setUp()
+
+    def tearDown(self):
+        # The idle connections belong to the loop
+        self.domoticz.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        self.fake.stop()
+
+    def client(self, url):
+        client = DomoticzHandler.AsyncDomoticz(url)
+        client.domoticz.includeScenesGroups = True
+        return client
+
+    def send(self, message):
+        return self.loop.run_until_complete(AlexaSmartHome.async_handle_message(self.domoticz, message))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,292 @@
+#
+# Domoticz client internals: device listing parsing, device cache, circuit breaker
+#
+# python3 -m pytest test_domoticz.py    (or python3 -m unittest test_domoticz)
+#
+
+import json
+import random
+import time
+import unittest
+from urllib.error import HTTPError
+
+import AlexaSmartHome, DomoticzHandler
+from AlexaSmartHome import BridgeUnreachable, DeadlineExceeded
+from fake_domoticz import FakeDomoticz, makeDevices
+from test_directives import directive
+
+class ChunkedStream(object):
+    """Binary stream of data, read in chunks of the given sizes (cycled)."""
+
+    def __init__(self, data, sizes):
+        self.data = data
+        self.sizes = sizes
+        self.pos = 0
+        self.reads = 0
+
+    def read(self, size=-1):
+        chunk = min(self.sizes[self.reads % len(self.sizes)], size)
+        self.reads += 1
+        data = self.data[self.pos:self.pos + chunk]
+        self.pos += len(data)
+        return data
+
+def expectedListing(text, fields=DomoticzHandler.DEVICE_FIELDS):
+    """What parseDeviceListing returns for text, from json.loads."""
+    response = json.loads(text)
+    if isinstance(response.get('result'), list):
+        response['result'] = [{field: device[field] for field in fields if field in device}
+                              for device in response['result']]
+    return response
+
+LISTINGS = [
+    '{}',
+    '{"result": []}',
+    '{"a": 1.0}',
+    '{"a": 1e5, "b": -2.5E-3, "c": true, "d": null, "e": "x", "f": 12}',
+    '{"status": "OK", "ActTime": 1700000000, "result": [{"idx": "1", "Level": 1.5e1}], "z": -0.25}',
+    ' { "ActTime" : 1700000000 ,\n "result" : [ ] , "title" : "Devices" } ',
+    json.dumps({'ActTime': 1700000000, 'ServerTime': '2026-10-18 17:00:00', 'status': 'OK',
+                'title': 'Devices', 'result': makeDevices(20)}, indent=1),
+    json.dumps({'result': [{'idx': '1', 'Name': 'Séjour ☃', 'Level': 30, 'Temp': 19.5}],
+                'ratio': 0.125, 'big': 1.5e300}, ensure_ascii=False),
+]
+
+class ParseDeviceListingTest(unittest.TestCase):
+    """parseDeviceListing gives json.loads results whatever the chunks the response comes in."""
+
+    def assertParsed(self, text, sizes):
+        data = text.encode('utf-8')
+        parsed = DomoticzHandler.parseDeviceListing(ChunkedStream(data, sizes))
+        self.assertEqual(parsed, expectedListing(text), 'chunk sizes %r' % (sizes,))
+
+    def test_whole(self):
+        for text in LISTINGS:
+            self.assertParsed(text, [DomoticzHandler.LISTING_CHUNK_SIZE])
+
+    def test_one_byte_chunks(self):
+        for text in LISTINGS:
+            self.assertParsed(text, [1])
+
+    def test_random_chunks(self):
+        rand = random.Random(0)
+        for text in LISTINGS:
+            for i in range(50):
+                self.assertParsed(text, [rand.randint(1, 16) for j in range(8)])
+
+    def test_number_cut_at_chunk(self):
+        # The number goes on in the next chunk: after the point, the exponent, its sign
+        for text in ('{"a": 1.0}', '{"a": 1e5}', '{"a": 1E-5, "b": 2}', '{"a": -12}'):
+            for cut in range(1, len(text)):
+                self.assertParsed(text, [cut, len(text)])
+
+    def test_invalid(self):
+        for text in ('', '{"a": 1', '{"a": 1,}', '{"result": [1]}', '[]'):
+            with self.assertRaises(ValueError):
+                DomoticzHandler.parseDeviceListing(ChunkedStream(text.encode('utf-8'), [3]))
+
+class DeviceCacheTest(unittest.TestCase):
+    """Device listings are refreshed with lastupdate deltas, downloaded again in full periodically."""
+
+    def setUp(self):
+        self.fake = FakeDomoticz(devices=10, scenes=0).start()
+        self.domoticz = DomoticzHandler.Domoticz(self.fake.url)
+        self.cache = self.domoticz.deviceCache
+        self.cache.ttl = 60
+
+    def tearDown(self):
+        self.domoticz.close()
+        self.fake.stop()
+
+    def expire(self):
+        # Freshness only, the snapshot is kept for the deltas
+        self.cache.invalidate()
+
+    def change(self, idx, **fields):
+        """A device change Domoticz reports in the next lastupdate delta."""
+        device = self.fake.devicesByIdx[idx]
+        device.update(fields)
+        device['_ts'] = int(time.time())
+
+    def delete(self, idx):
+        self.fake.devices.remove(self.fake.devicesByIdx.pop(idx))
+
+    def queries(self):
+        queries, self.fake.queries = self.fake.queries, []
+        return queries
+
+    def test_fresh_listing(self):
+        devices = self.domoticz.getDevices()
+        self.assertEqual(len(devices), 10)
+        self.assertEqual(self.queries(), [{'type': 'devices', 'used': 'true'}])
+        # A device of a fresh listing is not read again
+        self.assertEqual(self.domoticz.getDevice('3')['idx'], '3')
+        self.domoticz.getDevices()
+        self.assertEqual(self.queries(), [])
+
+    def test_delta_refresh(self):
+        self.domoticz.getDevices()
+        actTime = self.cache.listing(DomoticzHandler.DEVICES_QUERY)[0]
+        self.queries()
+        self.change('3', Level=77)
+        self.expire()
+        devices = dict((device['idx'], device) for device in self.domoticz.getDevices())
+        self.assertEqual(self.queries(), [{'type': 'devices', 'used': 'true', 'lastupdate': str(actTime)}])
+        self.assertEqual(devices['3']['Level'], 77)
+        self.assertEqual(len(devices), 10)
+
+    def test_device_read_through_listing(self):
+        # A stale device of a listing is brought up to date with the listing delta, not read alone
+        self.domoticz.getDevices()
+        self.queries()
+        self.change('5', Level=12)
+        self.expire()
+        self.assertEqual(self.domoticz.getDevice('5')['Level'], 12)
+        queries = self.queries()
+        self.assertEqual(len(queries), 1)
+        self.assertIn('lastupdate', queries[0])
+        self.assertNotIn('rid', queries[0])
+
+    def test_deleted_device_evicted_by_full_refresh(self):
+        self.domoticz.getDevices()
+        self.delete('3')
+        # A delta can't tell a device was deleted
+        self.expire()
+        self.assertIn('3', [device['idx'] for device in self.domoticz.getDevices()])
+        # The periodic full listing drops it
+        self.cache.fullRefresh = 0
+        self.expire()
+        self.queries()
+        self.assertNotIn('3', [device['idx'] for device in self.domoticz.getDevices()])
+        self.assertEqual(self.queries(), [{'type': 'devices', 'used': 'true'}])
+        self.assertIsNone(self.cache.lastKnown('3'))
+        self.assertIsNone(self.cache.listingOf('3'))
+
+    def test_disabled(self):
+        self.cache.ttl = 0
+        self.domoticz.getDevices()
+        self.domoticz.getDevices()
+        self.domoticz.getDevice('3')
+        self.assertEqual(self.queries(), [{'type': 'devices', 'used': 'true'}] * 2 + [{'type': 'devices', 'rid': '3'}])
+
+class CircuitBreakerTest(unittest.TestCase):
+    """The breaker opens after failures calls could not reach Domoticz, a probe closes it."""
+
+    def setUp(self):
+        self.fake = FakeDomoticz(devices=10, scenes=0).start()
+        self.port = self.fake.httpd.server_address[1]
+        self.domoticz = DomoticzHandler.Domoticz(self.fake.url)
+        self.breaker = self.domoticz.breaker
+        self.breaker.failures = 2
+        self.breaker.resetTimeout = 0.2
+
+    def tearDown(self):
+        self.domoticz.close()
+        if self.fake is not None:
+            self.fake.stop()
+
+    def down(self):
+        self.fake.stop()
+        self.fake = None
+        # The keep-alive connections are gone with the server
+        self.domoticz.session.close()
+
+    def up(self):
+        self.fake = FakeDomoticz(devices=10, scenes=0, port=self.port).start()
+
+    def open(self):
+        self.down()
+        for i in range(self.breaker.failures):
+            self.assertFalse(self.breaker.isOpen())
+            with self.assertRaises(BridgeUnreachable):
+                self.domoticz.getDevice('3')
+        self.assertTrue(self.breaker.isOpen())
+
+    def handle(self, namespace, name, endpointId):
+        return AlexaSmartHome.handle_message(self.domoticz,
+            directive(namespace, name, {'endpointId': endpointId, 'cookie': {}}))
+
+    def test_cycle(self):
+        self.open()
+        # Open: Domoticz is back, but no call is tried before resetTimeout
+        self.up()
+        with self.assertRaises(BridgeUnreachable):
+            self.domoticz.getDevice('3')
+        self.assertEqual(self.fake.calls, 0)
+        # Half-open: one probe, its success closes the breaker
+        time.sleep(self.breaker.resetTimeout)
+        self.assertEqual(self.domoticz.getDevice('3')['idx'], '3')
+        self.assertFalse(self.breaker.isOpen())
+        self.domoticz.getDevice('4')
+        self.assertEqual(self.fake.calls, 2)
+
+    def test_failed_probe(self):
+        self.open()
+        time.sleep(self.breaker.resetTimeout)
+        with self.assertRaises(BridgeUnreachable):
+            self.domoticz.getDevice('3')
+        # Open again, for a whole resetTimeout
+        self.assertTrue(self.breaker.isOpen())
+        self.up()
+        with self.assertRaises(BridgeUnreachable):
+            self.domoticz.getDevice('3')
+        self.assertEqual(self.fake.calls, 0)
+
+    def test_answer_is_no_failure(self):
+        # Domoticz answering an error (ERR status, HTTP error status) was reached
+        self.breaker.failures = 1
+        for i in range(3):
+            response = self.domoticz.api('type=command&param=switchlight&idx=99&switchcmd=On')
+            self.assertEqual(response['status'], 'ERR')
+        self.assertFalse(self.breaker.isOpen())
+        self.assertFalse(DomoticzHandler.isBridgeFailure(HTTPError(self.fake.url, 500, 'Error', {}, None)))
+        self.assertTrue(DomoticzHandler.isBridgeFailure(ConnectionRefusedError()))
+
+    def test_timeouts(self):
+        # Only a call timing out with the whole callTimeout counts
+        self.breaker.failures = 1
+        self.breaker.callTimeout = 0.2
+        self.fake.latency = 0.4
+        for timeout in (0.1, 0.1, 0.1):
+            previous = AlexaSmartHome.startDeadline(timeout)
+            try:
+                with self.assertRaises(DeadlineExceeded):
+                    self.domoticz.api(DomoticzHandler.DEVICE_QUERY % 3)
+            finally:
+                AlexaSmartHome.endDeadline(previous)
+        self.assertFalse(self.breaker.isOpen())
+        previous = AlexaSmartHome.startDeadline(0.25)
+        try:
+            with self.assertRaises(DeadlineExceeded):
+                self.domoticz.api(DomoticzHandler.DEVICE_QUERY % 3)
+        finally:
+            AlexaSmartHome.endDeadline(previous)
+        self.assertTrue(self.breaker.isOpen())
+
+    def test_stale_state_while_open(self):
+        self.domoticz.getDevice('3')
+        self.open()
+        self.up()
+        # State reports answer the last known state, commands fail at once
+        response = self.handle('Alexa', 'ReportState', 'SwitchLight-3')
+        self.assertEqual(response['event']['header']['name'], 'StateReport')
+        properties = response['context']['properties']
+        self.assertTrue(properties)
+        self.assertTrue(all(prop['uncertaintyInMilliseconds'] > 0 for prop in properties))
+        response = self.handle('Alexa.PowerController', 'TurnOn', 'SwitchLight-3')
+        self.assertEqual(response['event']['payload']['type'], 'BRIDGE_UNREACHABLE')
+        # A device never read can't be reported
+        response = self.handle('Alexa', 'ReportState', 'SwitchLight-1')
+        self.assertEqual(response['event']['payload']['type'], 'BRIDGE_UNREACHABLE')
+        self.assertEqual(self.fake.calls, 0)
+
+    def test_disabled(self):
+        self.breaker.failures = 0
+        self.down()
+        for i in range(5):
+            with self.assertRaises(BridgeUnreachable):
+                self.domoticz.getDevice('3')
+        self.assertFalse(self.breaker.isOpen())
+
+if __name__ == '__main__':
+    unittest.main()
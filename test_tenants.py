@@ -0,0 +1,137 @@
+#
+# Directives of several households dispatched to their Domoticz through TenantRegistry.py
+#
+# python3 -m pytest test_tenants.py    (or python3 -m unittest test_tenants)
+#
+
+import importlib
+import threading
+import unittest
+
+import TenantRegistry
+from fake_domoticz import FakeDomoticz
+from test_directives import directive
+
+Configuration = importlib.import_module('lambda').Configuration
+
+class StubProfileLookup(TenantRegistry.ProfileLookup):
+    """Login with Amazon profiles of the given token -> user_id, the others are invalid tokens."""
+
+    def __init__(self, users, **kwargs):
+        super().__init__(**kwargs)
+        self.users = users
+        self.fetched = []
+
+    def fetch(self, token):
+        self.fetched.append(token)
+        return self.users.get(token)
+
+def discover(token):
+    return directive('Alexa.Discovery', 'Discover', payload={'scope': {'type': 'BearerToken', 'token': token}})
+
+def errorType(response):
+    return response['event']['payload']['type']
+
+class TenantRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fakes = [FakeDomoticz(devices=devices, scenes=0).start() for devices in (2, 3, 4)]
+        self.config = Configuration(optsDict={
+            'maxTenants': 2, 'tenantConcurrency': 1, 'tenantQueueTimeout': 0.1,
+            'tenants': dict(('home%d' % i, {'url': fake.url, 'tokens': ['token%d' % i], 'userId': 'user%d' % i})
+                            for i, fake in enumerate(self.fakes)),
+        })
+        self.profiles = StubProfileLookup({'other0': 'user0', 'stranger': 'user9'})
+        self.registry = TenantRegistry.TenantRegistry(self.config, self.config.maxTenants, self.config.tenantConcurrency,
+                                                      self.config.tenantQueueTimeout, self.profiles)
+
+    def tearDown(self):
+        self.registry.close()
+        for fake in self.fakes:
+            fake.stop()
+
+    def remoteOf(self, token):
+        """The client a directive with token is handled with."""
+        return self.registry.dispatch(discover(token), lambda remote, message: remote)
+
+    def test_dispatch(self):
+        for i, fake in enumerate(self.fakes):
+            response = self.registry.handle_message(discover('token%d' % i))
+            self.assertEqual(len(response['event']['payload']['endpoints']), len(fake.devices))
+            self.assertEqual(fake.calls, 1)
+        self.assertIs(self.remoteOf('token0'), self.remoteOf('token0'))
+
+    def test_lru_eviction(self):
+        remote0 = self.remoteOf('token0')
+        remote1 = self.remoteOf('token1')
+        self.remoteOf('token0')
+        # home1 is the least recently used
+        self.remoteOf('token2')
+        self.assertEqual(list(self.registry._tenants), ['home0', 'home2'])
+        self.assertIs(self.remoteOf('token0'), remote0)
+        # Built again when needed
+        self.assertIsNot(self.remoteOf('token1'), remote1)
+        self.assertEqual(list(self.registry._tenants), ['home0', 'home1'])
+
+    def test_busy_tenant_kept(self):
+        started, done = threading.Event(), threading.Event()
+        def handle(remote, message):
+            started.set()
+            done.wait()
+            return remote
+        thread = threading.Thread(target=self.registry.dispatch, args=(discover('token0'), handle))
+        thread.start()
+        try:
+            started.wait()
+            self.remoteOf('token1')
+            self.remoteOf('token2')
+            # Over the limit while home0 is handling a directive
+            self.assertEqual(list(self.registry._tenants), ['home0', 'home2'])
+        finally:
+            done.set()
+            thread.join()
+        self.remoteOf('token1')
+        self.assertEqual(list(self.registry._tenants), ['home2', 'home1'])
+
+    def test_rate_limit(self):
+        started, done = threading.Event(), threading.Event()
+        def handle(remote, message):
+            started.set()
+            done.wait()
+            return remote
+        thread = threading.Thread(target=self.registry.dispatch, args=(discover('token0'), handle))
+        thread.start()
+        try:
+            started.wait()
+            self.assertEqual(errorType(self.registry.handle_message(discover('token0'))), 'RATE_LIMIT_EXCEEDED')
+            self.assertEqual(self.fakes[0].calls, 0)
+            # The other tenants have their own slots
+            self.assertIn('endpoints', self.registry.handle_message(discover('token1'))['event']['payload'])
+        finally:
+            done.set()
+            thread.join()
+        self.assertIn('endpoints', self.registry.handle_message(discover('token0'))['event']['payload'])
+
+    def test_invalid_token(self):
+        for message in (discover('stranger'), discover('invalid'), directive('Alexa.Discovery', 'Discover')):
+            self.assertEqual(errorType(self.registry.handle_message(message)), 'INVALID_AUTHORIZATION_CREDENTIAL')
+        self.assertEqual(self.registry._tenants, {})
+        self.assertEqual(sum(fake.calls for fake in self.fakes), 0)
+
+    def test_profile_lookup(self):
+        # A token not in the configuration, of the Amazon account of a tenant
+        self.assertIs(self.remoteOf('other0'), self.remoteOf('token0'))
+        self.assertEqual(self.profiles.fetched, ['other0'])
+        # Invalid tokens are looked up again after failureTtl only
+        self.registry.handle_message(discover('invalid'))
+        self.registry.handle_message(discover('invalid'))
+        self.remoteOf('other0')
+        self.assertEqual(self.profiles.fetched, ['other0', 'invalid'])
+
+    def test_no_profile_lookup(self):
+        self.registry.profileLookup = None
+        self.assertEqual(errorType(self.registry.handle_message(discover('other0'))), 'INVALID_AUTHORIZATION_CREDENTIAL')
+        self.assertEqual(self.profiles.fetched, [])
+
+if __name__ == '__main__':
+    unittest.main()